@@ -1,38 +1,60 @@
-import os
 import sqlite3
 import io
-from typing import Union
+import time
+from typing import Dict, Final, Iterable, List, Union
 import discord
-from PIL import Image, ImageDraw, ImageFont
+from database_migrations import Migration, migrate
 
 
 IMG_RES = 320
 
+# Attachment Links of the Discord CDN are signed & expire after 24 Hours,
+# older Links aren't used anymore (the Image is drawn & uploaded again)
+ATTACHMENT_MAX_AGE: Final[float] = 20 * 60 * 60
+
+# Append a new Migration when the Schema or the Format of the Keys changes,
+# Caches are only dropped by a Migration that needs to do so
+MIGRATIONS: Final[List[Migration]] = [
+    ('CREATE TABLE IF NOT EXISTS icons (key text, link text)',
+     'CREATE TABLE IF NOT EXISTS plans (key text, link text, date text)'),
+    # remove duplicate Keys, so they can be unique from now on
+    ('DELETE FROM icons WHERE rowid NOT IN (SELECT MAX(rowid) FROM icons GROUP BY key)',
+     'DELETE FROM plans WHERE rowid NOT IN (SELECT MAX(rowid) FROM plans GROUP BY key)',
+     'CREATE UNIQUE INDEX IF NOT EXISTS icons_key ON icons (key)',
+     'CREATE UNIQUE INDEX IF NOT EXISTS plans_key ON plans (key)'),
+    # Links expire, remember when they were uploaded (the Age of the old ones is unknown)
+    ('DELETE FROM icons',
+     'DELETE FROM plans',
+     'ALTER TABLE icons ADD COLUMN uploaded REAL',
+     'ALTER TABLE plans ADD COLUMN uploaded REAL')
+]
+
 
 class ImageDatabase(object):
     '''A Database, that stores Image Attachment Links'''
 
     def __init__(self, name: str = 'attachments.db'):
-        create_tables = not os.path.exists(name)
         self.database = sqlite3.connect(name)
+        migrate(self.database, MIGRATIONS)
         self.cursor = self.database.cursor()
-
-        if create_tables:
-            self.cursor.execute('CREATE TABLE icons (key text, link text)')
-            self.cursor.execute(
-                'CREATE TABLE plans (key text, link text, date text)')
+        # Filename -> Key of the drawn Icons, until their Link is known
+        self.drawn: Dict[str, str] = {}
 
     def get_icon(self, key: str) -> Union[str, discord.File]:
         '''Request an Icon from the database'''
         key = key.replace(' - ', '-')
 
         self.cursor.execute(
-            'SELECT link FROM icons WHERE key = ?', [f"{key}_icon"])
+            'SELECT link FROM icons WHERE key = ? AND uploaded > ?',
+            [f"{key}_icon", time.time() - ATTACHMENT_MAX_AGE])
         link = self.cursor.fetchone()
         self.cursor = self.database.cursor()
 
         # create the Image
         if link is None:
+            # Pillow is only loaded once an Icon actually has to be drawn
+            from PIL import Image, ImageDraw, ImageFont
+
             img = Image.new("RGBA", (IMG_RES, IMG_RES), (0, 0, 0, 0))
             font = ImageFont.truetype(
                 "fonts/arialrounded.ttf", min(int(105 * (4.5 / (len(key) - key.count('.')))), 210))
@@ -45,22 +67,32 @@ class ImageDatabase(object):
             img.save(buf, format='PNG')
             buf.seek(0)
             file = discord.File(buf, filename=f"{key.replace(' ', '_')}_icon.png")
+            self.drawn[file.filename] = key
 
             return file
         return link[0]
 
+    def remember_icons(self, attachments: Iterable[discord.Attachment]):
+        '''Stores the Links of the uploaded Icons, the next Messages reference
+        them instead of uploading them again (so they can be edited in place)'''
+        for attachment in attachments:
+            key = self.drawn.pop(attachment.filename, None)
+            if key is not None:
+                self.set_attachment(key, attachment.url)
+
     def get_plan(self, key: str, date: str) -> str:
-        '''Request the URL for a plan from the Database'''
+        '''Request the URL for a plan from the Database
+        Links of an older Stand or an expired Upload are deleted'''
         key = [f'{key}_plan']
-        self.cursor.execute('SELECT * FROM plans WHERE key = ?', key)
+        self.cursor.execute('SELECT link, date, uploaded FROM plans WHERE key = ?', key)
         result = self.cursor.fetchone()
         self.cursor = self.database.cursor()
 
         if result is None:
             return None
 
-        if date == result[2]:
-            return result[1]
+        if date == result[1] and time.time() - result[2] < ATTACHMENT_MAX_AGE:
+            return result[0]
 
         self.cursor.execute('DELETE FROM plans WHERE key = ?', key)
         self.database.commit()
@@ -69,10 +101,11 @@ class ImageDatabase(object):
 
     def set_attachment(self, key: str, link: str, date: str = None):
         '''Sets the Attachment Link for the given key'''
-        self.cursor.execute(*('INSERT INTO icons VALUES (?, ?)',
-                            (f'{key}_icon', link)) if date is None else
-                            ('INSERT INTO plans VALUES (?, ?, ?)',
-                            (f'{key}_plan', link, date)))
+        now = time.time()
+        self.cursor.execute(*('REPLACE INTO icons VALUES (?, ?, ?)',
+                            (f'{key}_icon', link, now)) if date is None else
+                            ('REPLACE INTO plans VALUES (?, ?, ?, ?)',
+                            (f'{key}_plan', link, date, now)))
         self.database.commit()
 
     def __del__(self):
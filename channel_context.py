@@ -0,0 +1,339 @@
+'''Sends scheduled Plans straight to a Channel over the REST API
+or through a Webhook of the Channel, optionally editing the last Post'''
+import hashlib
+import io
+import json
+from typing import Final, List, Optional, Tuple
+
+from discord import Attachment, Embed, File, NotFound, Object, Webhook
+from discord.http import HTTPClient, Route
+
+
+# Limits of a single Message
+MAX_EMBEDS: Final[int] = 10
+MAX_EMBED_CHARS: Final[int] = 6000
+MAX_CONTENT: Final[int] = 2000
+MAX_FILES: Final[int] = 10
+
+
+class SentMessage:
+    '''The Parts of a sent Message, that the Bot uses afterwards'''
+    __slots__ = ('id', 'attachments')
+
+    def __init__(self, data: dict):
+        self.id: int = int(data['id'])
+        self.attachments: List[Attachment] = [
+            Attachment(data=attachment, state=None)
+            for attachment in data.get('attachments', [])
+        ]
+
+
+class ChannelContext:
+    '''Stands in for the Command Context of scheduled Events
+    Only the IDs of the Guild & the Channel are needed, so neither a cached
+    nor a fetched Message (or Channel) is required'''
+
+    def __init__(self, http: HTTPClient, guild_id: int, channel_id: int):
+        self.http = http
+        self.guild = Object(id=guild_id)
+        self.channel = Object(id=channel_id)
+
+    async def defer(self, hidden: bool = False):
+        '''Scheduled Messages don't have to acknowledge anything'''
+
+    async def flush(self):
+        '''Every Message is sent right away'''
+
+    async def post(self, content: Optional[str], embeds: List[Embed],
+                   files: List[File]) -> SentMessage:
+        return await self.send(content, embeds=embeds, files=files)
+
+    async def edit(self, message_id: int, content: Optional[str],
+                   embeds: List[Embed]):
+        await self.http.edit_message(
+            self.channel.id, message_id, content=content,
+            embeds=[embed.to_dict() for embed in embeds])
+
+    async def delete(self, message_id: int):
+        await self.http.delete_message(self.channel.id, message_id)
+
+    async def send(self,
+                   content: Optional[str] = None,
+                   *,
+                   embed: Embed = None,
+                   embeds: List[Embed] = None,
+                   file: File = None,
+                   files: List[File] = None,
+                   hidden: bool = False) -> SentMessage:
+        '''Sends a Message with up to 10 Embeds, like the SlashContext does'''
+        payload: dict = {}
+        if content:
+            payload['content'] = content
+        embeds = [embed] if embed is not None else embeds or []
+        if embeds:
+            payload['embeds'] = [embed.to_dict() for embed in embeds]
+
+        route = Route('POST', '/channels/{channel_id}/messages',
+                      channel_id=self.channel.id)
+        files = [file] if file is not None else files or []
+        if not files:
+            return SentMessage(await self.http.request(route, json=payload))
+
+        form: List[dict] = [{'name': 'payload_json', 'value': json.dumps(payload)}]
+        for index, attachment in enumerate(files):
+            form.append({
+                'name': f'file{index}',
+                'value': attachment.fp,
+                'filename': attachment.filename,
+                'content_type': 'application/octet-stream'
+            })
+
+        try:
+            return SentMessage(await self.http.request(route, files=files,
+                                                       form=form))
+        finally:
+            for attachment in files:
+                attachment.close()
+
+
+
+
+class PendingMessage:
+    '''Collects consecutive Messages into one, as long as the Limits allow'''
+
+    def __init__(self):
+        self.content: str = ''
+        self.embeds: List[Embed] = []
+        self.files: List[File] = []
+
+    def __bool__(self) -> bool:
+        return bool(self.content or self.embeds)
+
+    def fits(self, content: str, embeds: List[Embed], files: List[File]) -> bool:
+        '''Whether the Message still fits into this one'''
+        if not self:
+            return True
+        return len(self.embeds) + len(embeds) <= MAX_EMBEDS \
+            and len(self.files) + len(files) <= MAX_FILES \
+            and len(self.content) + len(content) + 2 <= MAX_CONTENT \
+            and sum(map(len, self.embeds + embeds)) + len(self.content) \
+            + len(content) <= MAX_EMBED_CHARS
+
+    def add(self, content: str, embeds: List[Embed], files: List[File]):
+        if content:
+            self.content = f'{self.content}\n\n{content}' if self.content else content
+        self.embeds.extend(embeds)
+        self.files.extend(attachment for attachment in files
+                          if not attachment in self.files)
+
+
+class WebhookContext:
+    '''Delivers scheduled Events through a Webhook of the Channel, so they
+    don't share the Rate Limits of the Bot with the Command Replies
+    Messages are collected & packed into as few Webhook Messages as the
+    Limits allow, call flush() after the last one'''
+
+    def __init__(self, webhook: Webhook, guild_id: int, channel_id: int):
+        self.webhook = webhook
+        self.guild = Object(id=guild_id)
+        self.channel = Object(id=channel_id)
+        self.pending = PendingMessage()
+        # Requests, that went through, the Webhook exists if there are any
+        self.sent: int = 0
+
+    async def defer(self, hidden: bool = False):
+        '''Scheduled Messages don't have to acknowledge anything'''
+
+    async def send(self,
+                   content: Optional[str] = None,
+                   *,
+                   embed: Embed = None,
+                   embeds: List[Embed] = None,
+                   file: File = None,
+                   files: List[File] = None,
+                   hidden: bool = False):
+        '''Adds the Message to the pending one, single Files (the rendered
+        Plans) are sent right away, as their Message is needed afterwards'''
+        embeds = [embed] if embed is not None else embeds or []
+        if file is not None:
+            await self.flush()
+            return await self.post(content, embeds, [file])
+
+        files = files or []
+        if not self.pending.fits(content or '', embeds, files):
+            await self.flush()
+        self.pending.add(content or '', embeds, files)
+        return None
+
+    async def flush(self):
+        '''Sends the pending Message'''
+        if self.pending:
+            pending, self.pending = self.pending, PendingMessage()
+            await self.post(pending.content or None, pending.embeds,
+                            pending.files)
+
+    async def post(self, content: Optional[str], embeds: List[Embed],
+                   files: List[File]):
+        message = await self.webhook.send(content, embeds=embeds,
+                                          files=files or None, wait=True)
+        self.sent += 1
+        return message
+
+    async def edit(self, message_id: int, content: Optional[str],
+                   embeds: List[Embed]):
+        await self.webhook.edit_message(message_id, content=content,
+                                        embeds=embeds)
+        self.sent += 1
+
+    async def delete(self, message_id: int):
+        await self.webhook.delete_message(message_id)
+        self.sent += 1
+
+
+def plan_digest(data) -> str:
+    '''Hash of the Plan Data, that a Post was created from'''
+    return hashlib.sha256(json.dumps(data, sort_keys=True, default=str)
+                          .encode('utf-8')).hexdigest()
+
+
+def message_digest(content: Optional[str], embeds: List[Embed],
+                   files: List[File], source: Optional[str] = None) -> str:
+    '''Hash of what a Message shows, to find the ones that changed
+    With the source (see plan_digest) Images count by the Data they show, as
+    their Link changes from attachment:// to the CDN on the next Post'''
+    embed_dicts = [embed.to_dict() for embed in embeds]
+    if source is not None:
+        for embed in embed_dicts:
+            if 'image' in embed:
+                embed['image'] = source
+        files = []
+    return hashlib.sha256(json.dumps(
+        [content, embed_dicts, [attachment.filename for attachment in files]],
+        sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class EditingContext:
+    '''Edits the Messages of the last Post instead of sending new ones
+    Unchanged Messages are left alone, so a Plan that didn't change sends
+    nothing. posted are the (message_id, digest) Pairs of the last Post,
+    after flush() they are the ones of this Post, source is the plan_digest
+    of the Data, that the Post shows'''
+
+    def __init__(self, target, posted: List[Tuple[int, str]], pack: bool = False,
+                 source: Optional[str] = None):
+        self.target = target
+        self.source = source
+        self.guild = target.guild
+        self.channel = target.channel
+        self.previous: List[Tuple[int, str]] = posted
+        self.posted: List[Tuple[int, str]] = []
+        # Webhooks pack the Messages (see WebhookContext)
+        self.pending: Optional[PendingMessage] = PendingMessage() if pack else None
+
+    async def defer(self, hidden: bool = False):
+        '''Scheduled Messages don't have to acknowledge anything'''
+
+    async def send(self,
+                   content: Optional[str] = None,
+                   *,
+                   embed: Embed = None,
+                   embeds: List[Embed] = None,
+                   file: File = None,
+                   files: List[File] = None,
+                   hidden: bool = False):
+        embeds = [embed] if embed is not None else embeds or []
+        files = [file] if file is not None else files or []
+        if self.pending is None or file is not None:
+            await self.flush_pending()
+            return await self.update(content, embeds, files)
+
+        if not self.pending.fits(content or '', embeds, files):
+            await self.flush_pending()
+        self.pending.add(content or '', embeds, files)
+        return None
+
+    async def update(self, content: Optional[str], embeds: List[Embed],
+                     files: List[File]):
+        '''Sends the next Message of the Post, if it differs from the last one'''
+        digest = message_digest(content, embeds, files, self.source)
+        index = len(self.posted)
+        if index < len(self.previous):
+            message_id, previous = self.previous[index]
+            if digest == previous:
+                self.posted.append((message_id, digest))
+                return None
+            try:
+                if not files:
+                    await self.target.edit(message_id, content, embeds)
+                    self.posted.append((message_id, digest))
+                    return None
+                # new Attachments can't be added by editing, send the Message again
+                await self.target.delete(message_id)
+            except NotFound:
+                # somebody deleted the Message, send it again
+                pass
+
+        message = await self.target.post(content, embeds, files)
+        self.posted.append((message.id, digest))
+        return message
+
+    async def flush_pending(self):
+        if self.pending:
+            pending, self.pending = self.pending, PendingMessage()
+            await self.update(pending.content or None, pending.embeds,
+                              pending.files)
+
+    async def flush(self):
+        '''Sends the rest & deletes the Messages, the Post doesn't need anymore'''
+        await self.flush_pending()
+        for message_id, _ in self.previous[len(self.posted):]:
+            try:
+                await self.target.delete(message_id)
+            except NotFound:
+                pass
+
+
+class RecordingContext:
+    '''Records the Messages of one Render, so they can be sent to several
+    Channels without fetching & rendering the Plan again'''
+
+    def __init__(self, guild_id: int, channel_id: int):
+        self.guild = Object(id=guild_id)
+        self.channel = Object(id=channel_id)
+        self.messages: List[dict] = []
+
+    async def defer(self, hidden: bool = False):
+        '''Nothing is sent yet'''
+
+    async def flush(self):
+        '''Nothing is sent yet'''
+
+    async def send(self,
+                   content: Optional[str] = None,
+                   *,
+                   embed: Embed = None,
+                   embeds: List[Embed] = None,
+                   file: File = None,
+                   files: List[File] = None,
+                   hidden: bool = False):
+        files = [file] if file is not None else files or []
+        self.messages.append({
+            'content': content,
+            'embeds': [embed] if embed is not None else embeds or [],
+            # Files can only be sent once, keep their Data
+            'files': [(attachment.filename, attachment.fp.read())
+                      for attachment in files]
+        })
+        for attachment in files:
+            attachment.close()
+        return None
+
+    async def replay(self, context):
+        '''Sends the recorded Messages to the Context'''
+        for message in self.messages:
+            await context.send(
+                message['content'],
+                embeds=message['embeds'],
+                files=[File(io.BytesIO(data), filename=filename)
+                       for filename, data in message['files']])
+        await context.flush()
@@ -0,0 +1,105 @@
+'''Timeouts, Wiederholungen & Circuit Breaker für die Abfrage der Schulseiten'''
+import random
+import time
+import urllib.error
+from typing import Callable, Final, Optional, Dict, TypeVar
+from urllib.parse import urlsplit
+
+
+# Sekunden, die eine einzelne Anfrage maximal dauern darf
+DEFAULT_TIMEOUT: Final[float] = 10.0
+# zusätzliche Versuche bei vorübergehenden Fehlern
+RETRIES: Final[int] = 2
+# Fehlschläge in Folge, nach denen ein Host pausiert wird
+FAILURE_THRESHOLD: Final[int] = 3
+# Sekunden, die ein Host nach zu vielen Fehlschlägen nicht abgefragt wird
+COOLDOWN: Final[float] = 5 * 60
+
+T = TypeVar('T')
+
+
+class CircuitOpenError(Exception):
+    '''Der Host wird nach zu vielen Fehlschlägen gerade nicht abgefragt'''
+
+
+def is_transient(error: Exception) -> bool:
+    '''Netzwerkfehler, Timeouts & Serverfehler (5xx) lohnen einen neuen Versuch,
+    ein 404 oder falsche Zugangsdaten nicht'''
+    if isinstance(error, urllib.error.HTTPError):
+        return error.code >= 500
+    # requests.HTTPError kennt die Antwort, ihr Status entscheidet
+    status = getattr(getattr(error, 'response', None), 'status_code', None)
+    if status is not None:
+        return status >= 500
+    # URLError, socket.timeout & requests.RequestException sind alle OSErrors
+    return isinstance(error, OSError)
+
+
+def backoff(attempt: int, base: float = 0.5, cap: float = 8.0) -> float:
+    '''Wartezeit vor dem nächsten Versuch, exponentiell mit vollem Jitter'''
+    return random.uniform(0, min(cap, base * 2**attempt))
+
+
+class CircuitBreaker:
+    '''Zählt die Fehlschläge eines Hosts & pausiert ihn, wenn er ausfällt
+    Nach dem Cooldown darf wieder ein Versuch durch (half-open)'''
+
+    def __init__(self,
+                 host: str,
+                 threshold: int = FAILURE_THRESHOLD,
+                 cooldown: float = COOLDOWN):
+        self.host: Final = host
+        self.threshold = threshold
+        self.cooldown = cooldown
+
+        self.failures: int = 0
+        self.opened_at: Optional[float] = None
+
+    @property
+    def is_open(self) -> bool:
+        '''True, solange der Host pausiert ist'''
+        return self.opened_at is not None and \
+            time.monotonic() - self.opened_at < self.cooldown
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.failures >= self.threshold:
+            self.opened_at = time.monotonic()
+
+    def call(self, func: Callable[..., T], *args, retries: int = RETRIES,
+             **kwargs) -> T:
+        '''Ruft func auf & wiederholt es bei vorübergehenden Fehlern
+        Wirft CircuitOpenError, solange der Host pausiert ist'''
+        if self.is_open:
+            raise CircuitOpenError(self.host)
+
+        attempt = 0
+        while True:
+            try:
+                result = func(*args, **kwargs)
+            except Exception as error:
+                if not is_transient(error):
+                    raise
+                if attempt >= retries:
+                    self.record_failure()
+                    raise
+                time.sleep(backoff(attempt))
+                attempt += 1
+            else:
+                self.record_success()
+                return result
+
+
+BREAKERS: Dict[str, CircuitBreaker] = {}
+
+
+def breaker_for(url: str) -> CircuitBreaker:
+    '''Gibt den Circuit Breaker für den Host der URL zurück'''
+    host = urlsplit(url).netloc
+    if not host in BREAKERS:
+        BREAKERS[host] = CircuitBreaker(host)
+    return BREAKERS[host]
@@ -0,0 +1,24 @@
+'''Lädt die Konfiguration der Vertretungspläne'''
+import json
+from datetime import date, datetime
+from functools import lru_cache
+from typing import Final
+from pytz import timezone
+
+
+PAGES_FILE: Final[str] = 'pages.json'
+
+# die Pläne gelten in der Zeitzone der Schulen, nicht in der des Servers
+TIMEZONE: Final = timezone('Europe/Berlin')
+
+
+@lru_cache(maxsize=None)
+def load_pages(path: str = PAGES_FILE) -> dict:
+    '''Liest die pages.json einmalig ein, jeder weitere Aufruf nutzt den Cache'''
+    with open(path, 'r', encoding='utf-8') as page_json:
+        return json.load(page_json)
+
+
+def today() -> date:
+    '''Das heutige Datum in der Zeitzone der Schulen'''
+    return datetime.now(TIMEZONE).date()
@@ -0,0 +1,37 @@
+import sqlite3
+from typing import Final, Sequence
+
+
+# Every Migration is a List of SQL-Statements, its Version is its Index + 1
+Migration = Sequence[str]
+
+VERSION_TABLE: Final[str] = 'schema_version'
+
+
+def get_version(database: sqlite3.Connection) -> int:
+    '''Returns the Schema Version of the Database, 0 if it has none yet'''
+    database.execute(
+        f'CREATE TABLE IF NOT EXISTS {VERSION_TABLE} (version INT NOT NULL)')
+    row = database.execute(
+        f'SELECT MAX(version) FROM {VERSION_TABLE}').fetchone()
+    return 0 if row[0] is None else row[0]
+
+
+def migrate(database: sqlite3.Connection,
+            migrations: Sequence[Migration]) -> int:
+    '''Applies all Migrations newer than the Version of the Database in place
+    Each Migration runs in its own Transaction, returns the new Version'''
+    version = get_version(database)
+    database.commit()
+
+    for new_version, statements in enumerate(migrations[version:],
+                                              version + 1):
+        with database:
+            database.execute('BEGIN')
+            for statement in statements:
+                database.execute(statement)
+            database.execute(f'INSERT INTO {VERSION_TABLE} VALUES (?)',
+                             (new_version, ))
+        print(f'migrated database to schema version {new_version}')
+
+    return max(version, len(migrations))
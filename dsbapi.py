@@ -1,11 +1,14 @@
-from typing import Final, Iterable, List
+from typing import Final, Iterable, Iterator, List, Optional
+import re
 import json
-import requests
+from html import unescape
 import datetime
 import base64
 import uuid
 import gzip
-import bs4
+import binascii
+from circuit_breaker import DEFAULT_TIMEOUT
+from replacement_types import Replacement
 
 
 NONE_CASES: Final = ('\xa0', '+', '---')
@@ -13,20 +16,125 @@ NONE_CASES: Final = ('\xa0', '+', '---')
 DEFAULT_MAPPER: Final[List[str]] = ['type', 'class', 'lesson','subject', 'room',
                                     'new_subject', 'new_teacher', 'teacher']
 
+DATA_URL: Final[str] = "https://app.dsbcontrol.de/JsonHandler.ashx/GetData"
+
+# the Headers can be read without parsing the whole Document,
+# every Day starts with its mon_head table & ends with its mon_list table
+HEAD_PATTERN: Final = re.compile(r'<table class="mon_head">')
+LIST_MARKER: Final[str] = 'class="mon_list"'
+TITLE_PATTERN: Final = re.compile(r'<div class="mon_title">(.*?)</div>', re.S)
+UPDATED_PATTERN: Final = re.compile(r'Stand:\s*([^\n]*)')
+TAG_PATTERN: Final = re.compile(r'<[^>]*>')
+
+
+def strip_tags(html: str) -> str:
+    """
+    @return: str, the text of the HTML fragment, every tag ends a line
+    """
+    return unescape(TAG_PATTERN.sub('\n', html))
+
+
+def is_timetable(url: str) -> bool:
+    """
+    @return: bool, whether the URL is a timetable page (not the news or an image)
+    """
+    return url.endswith(".htm") and not url.endswith(".html") and not url.endswith("news.htm")
+
+
+class DSBError(Exception):
+    """
+    DSBMobile answered, but rejected the request (e.g. wrong credentials)
+    """
+
+
+class DSBUnavailableError(OSError):
+    """
+    DSBMobile answered with an error page or a broken response, worth another try
+    (an OSError, like the network errors, see circuit_breaker.is_transient)
+    """
+
+
+def check_response(response) -> None:
+    """
+    @raise DSBUnavailableError: If the server failed (5xx)
+    @raise requests.HTTPError: If the request was rejected (4xx)
+    """
+    if response.status_code >= 500:
+        raise DSBUnavailableError(f'{response.url} answered {response.status_code}')
+    response.raise_for_status()
+
+
+class DSBDocument:
+    """
+    A fetched DSBMobile timetable page, parsed with bs4 only when needed
+    """
+    def __init__(self, html: str):
+        self.html: str = html
+        self._tables: Optional[list] = None
+
+    @property
+    def tables(self) -> list:
+        """
+        @return: list, the mon_list tables of the page, one per day
+        """
+        if self._tables is None:
+            import bs4
+
+            soup = bs4.BeautifulSoup(self.html, "html.parser")
+            self._tables = soup.find_all('table', {'class': 'mon_list'})
+            self.html = None
+        return self._tables
+
+
+class DSBDay:
+    """
+    Lightweight handle for one day of a DSBMobile timetable
+    Date and "Stand" are read from the headers, the rows are only materialised on the first access of entries
+    """
+    def __init__(self, api: 'DSBApi', document: DSBDocument, index: int,
+                 date: str, day: str, updated: Optional[str]):
+        self.api = api
+        self.document = document
+        self.index: int = index
+        self.date: str = date
+        self.day: str = day
+        self.updated: Optional[str] = updated
+        self._entries: Optional[list] = None
+
+    @property
+    def entries(self) -> list:
+        """
+        @return: list, list of Replacements, one per Row (see Replacement.classes)
+        """
+        if self._entries is None:
+            self._entries = self.api.parse_rows(
+                self.document.tables[self.index], self.date, self.day,
+                self.updated)
+            # the document isn't needed anymore, once all its days are parsed
+            self.document = None
+        return self._entries
+
+    def __repr__(self) -> str:
+        return f'DSBDay({self.date!r}, updated={self.updated!r})'
+
 
 class DSBApi:
     def __init__(self, username: str, password: str,
                  tablemapper: Iterable[str] = DEFAULT_MAPPER,
-                 inline_header: bool = False):
+                 inline_header: bool = False,
+                 timeout: float = DEFAULT_TIMEOUT,
+                 data_url: Optional[str] = None):
         """
         Class constructor for class DSBApi
         @param username: string, the username of the DSBMobile account
         @param password: string, the password of the DSBMobile account
         @param tablemapper: list, the field mapping of the DSBMobile tables (default: ['type','class','lesson','subject','room','new_subject','new_teacher','teacher'])
+        @param timeout: float, seconds a single request may take (default: circuit_breaker.DEFAULT_TIMEOUT)
+        @param data_url: string, the GetData endpoint, e.g. a local stand-in (default: DATA_URL)
         @return: class
         @raise TypeError: If the attribute tablemapper is not of type list
         """
-        self.DATA_URL: str = "https://app.dsbcontrol.de/JsonHandler.ashx/GetData"
+        self.DATA_URL: str = DATA_URL if data_url is None else data_url
         self.username: str = username
         self.password: str = password
 
@@ -35,15 +143,38 @@ class DSBApi:
 
         self.tablemapper: Iterable[str] = tablemapper
         self.inline_header: bool = inline_header
+        self.timeout: float = timeout
 
 
     def fetch_entries(self):
         """
         Fetch all the DSBMobile entries
-        @return: list, containing lists of DSBMobile entries from the tables or only the entries if just one table was received (default: empty list)
-        @raise Exception: If the request to DSBMonile failed
+        @return: list, a DSBDay handle per published day, the rows are parsed on demand (default: empty list)
+        @raise DSBError: If DSBMobile rejected the request
+        @raise requests.RequestException: If the request to DSBMobile failed or timed out
         """
+        final = [item["Detail"] for item in self.detail_items(self.fetch_data())]
+
+        if not final:
+            raise DSBError("Timetable data could not be found")
 
+        output = []
+        for entry in final:
+            if is_timetable(entry):
+                output.extend(self.fetch_days(entry))
+            # elif entry.endswith(".jpg"):
+            #     output.append(self.fetch_img(entry))
+
+        return output
+
+    def fetch_data(self) -> dict:
+        """
+        Request the menu of the DSBMobile account
+        @return: dict, the decompressed GetData response
+        @raise DSBError: If DSBMobile rejected the request
+        @raise DSBUnavailableError: If DSBMobile failed or answered garbage
+        @raise requests.RequestException: If the request to DSBMobile failed or timed out
+        """
         # Iso format is for example 2019-10-29T19:20:31.875466
         current_time: str = datetime.datetime.now().isoformat()
 
@@ -64,6 +195,8 @@ class DSBApi:
             "LastUpdate": current_time
         }
 
+        import requests
+
         # Convert params into the right format
         params_bytestring: bytes = json.dumps(
             params, separators=(',', ':')).encode("UTF-8")
@@ -73,40 +206,38 @@ class DSBApi:
         # Send the request
         json_data: dict[str, dict] = {
             "req": {"Data": params_compressed, "DataType": 1}}
-        timetable_data = requests.post(self.DATA_URL, json=json_data)
+        timetable_data = requests.post(self.DATA_URL, json=json_data,
+                                       timeout=self.timeout)
+        check_response(timetable_data)
 
         # Decompress response
-        data_compressed = json.loads(timetable_data.content)["d"]
-        data = json.loads(gzip.decompress(base64.b64decode(data_compressed)))
+        try:
+            data_compressed = json.loads(timetable_data.content)["d"]
+            data = json.loads(gzip.decompress(base64.b64decode(data_compressed)))
+            result_code = data['Resultcode']
+        except (ValueError, KeyError, TypeError, EOFError, binascii.Error) as error:
+            # e.g. an HTML error page instead of JSON
+            raise DSBUnavailableError(f'invalid GetData response: {error!r}') from error
 
         # validate response before proceed
-        if data['Resultcode'] != 0:
-            raise Exception(data['ResultStatusInfo'])
+        if result_code != 0:
+            raise DSBError(data['ResultStatusInfo'])
 
-        # Find the timetable page, and extract the timetable URL from it
-        final = []
+        return data
+
+    @staticmethod
+    def detail_items(data: dict) -> Iterator[dict]:
+        """
+        Find the timetable pages in a GetData response
+        @param data: dict, the decompressed GetData response
+        @return: generator, the menu items, their "Detail" is the URL of the page
+        """
         for page in data["ResultMenuItems"][0]["Childs"]:
             for child in page["Root"]["Childs"]:
                 if isinstance(child["Childs"], list):
-                    for sub_child in child["Childs"]:
-                        final.append(sub_child["Detail"])
+                    yield from child["Childs"]
                 else:
-                    final.append(child["Childs"]["Detail"])
-
-        if not final:
-            raise Exception("Timetable data could not be found")
-
-        output = []
-        for entry in final:
-            if entry.endswith(".htm") and not entry.endswith(".html") and not entry.endswith("news.htm"):
-                output.append(self.fetch_timetable(entry))
-            # elif entry.endswith(".jpg"):
-            #     output.append(self.fetch_img(entry))
-
-        if len(output) == 1:
-            return output[0]
-        else:
-            return output
+                    yield child["Childs"]
 
     def fetch_img(self, imgurl):
         """
@@ -119,55 +250,96 @@ class DSBApi:
         raise Exception(
             'Extraction of data from images is not implemented yet!')
 
+    def fetch_days(self, timetableurl) -> List[DSBDay]:
+        """
+        fetch the timetableurl HTML page and read date and "Stand" of every day on it
+        @param timetableurl: string, the URL to the timetable in HTML format
+        @return: list, list of DSBDay handles, their rows are parsed on demand
+        """
+        import requests
+
+        response = requests.get(timetableurl, timeout=self.timeout)
+        check_response(response)
+        return self.parse_days(response.text)
+
+    def parse_days(self, html: str) -> List[DSBDay]:
+        """
+        read date and "Stand" of every day on a timetable HTML page
+        @param html: string, the timetable page
+        @return: list, list of DSBDay handles, their rows are parsed on demand
+        """
+        document = DSBDocument(html)
+        blocks = HEAD_PATTERN.split(html)
+        # DSBDay.index counts the mon_list tables of the whole Document
+        index = blocks[0].count(LIST_MARKER)
+
+        days = []
+        for block in blocks[1:]:
+            head, has_list, _ = block.partition(LIST_MARKER)
+            title_match = TITLE_PATTERN.search(head)
+            # title & "Stand" only from this Day's Header, never the next one
+            updated_match = UPDATED_PATTERN.search(strip_tags(head))
+            title = ' '.join(strip_tags(title_match.group(1)).split()) \
+                if title_match is not None else ''
+            parts = title.split(' ')
+            if has_list and len(parts) > 1:
+                date = parts[0]
+                day = parts[1].split(', ')[0].replace(',', '')
+                updated = ' '.join(updated_match.group(1).split()) if updated_match is not None else None
+                days.append(DSBDay(self, document, index, date, day, updated or None))
+            index += block.count(LIST_MARKER)
+
+        return days
+
     def fetch_timetable(self, timetableurl) -> list:
         """
         parse the timetableurl HTML page and return the parsed entries
         @param timetableurl: string, the URL to the timetable in HTML format
-        @return: list, list of dicts
+        @return: list, list of Replacements, one per Row (see Replacement.classes)
+        """
+        return [entry for day in self.fetch_days(timetableurl) for entry in day.entries]
+
+    def parse_rows(self, soup, date: str, day: str, updates: str) -> list:
+        """
+        parse the rows of one mon_list table
+        @param soup: bs4.Tag, the mon_list table of the day
+        @return: list, list of Replacements, one per Row (see Replacement.classes)
         """
         results = []
-        sauce = requests.get(timetableurl).text
-        soupi = bs4.BeautifulSoup(sauce, "html.parser")
-        ind = -1
-        for soup in soupi.find_all('table', {'class': 'mon_list'}):
-            ind += 1
-            updates = [o.p.findAll('span')[-1].next_sibling.split("Stand: ")[1]
-                       for o in soupi.findAll('table', {'class': 'mon_head'})][ind]
-            titles = [o.text for o in soupi.findAll(
-                'div', {'class': 'mon_title'})][ind]
-            date = titles.split(" ")[0]
-            day = titles.split(" ")[1].split(", ")[0].replace(",", "")
-            entries = soup.find_all("tr")
-            entries.pop(0)
-
-            current_class: str = None
-
-            for entry in entries:
-                infos = entry.find_all("td")
-
-                if len(infos) < 2:
-                    current_class = infos[0].text
-                    continue
-
-                for class_ in infos[1].text.split(", "):
-                    new_entry = {'date': date, 'day': day, 'updated': updates}
-
-                    if self.inline_header:
-                        new_entry['class'] = current_class
-
-                    i = 0
-                    while i < len(infos):
-                        if i < len(self.tablemapper):
-                            attribute = self.tablemapper[i]
-                        else:
-                            attribute = 'col' + str(i)
-
-                        if attribute == 'class':
-                            new_entry[attribute] = current_class if self.inline_header else class_ if not infos[i].text in NONE_CASES else None
-                        elif not infos[i].text in NONE_CASES:
-                            new_entry[attribute] = infos[i].text
-                        i += 1
-
-                    results.append(new_entry)
-
-        return results
\ No newline at end of file
+        entries = soup.find_all("tr")
+        entries.pop(0)
+
+        current_class: str = None
+
+        for entry in entries:
+            infos = entry.find_all("td")
+
+            if len(infos) < 2:
+                current_class = infos[0].text
+                continue
+
+            # the Row is stored once & referenced by all of its Classes
+            if self.inline_header:
+                classes = (current_class, )
+            elif infos[1].text in NONE_CASES:
+                classes = (None, )
+            else:
+                classes = infos[1].text.split(", ")
+
+            new_entry = Replacement(date=date, day=day, updated=updates,
+                                    classes=classes)
+
+            i = 0
+            while i < len(infos):
+                if i < len(self.tablemapper):
+                    attribute = self.tablemapper[i]
+                else:
+                    attribute = 'col' + str(i)
+
+                if attribute != 'class' and not infos[i].text in NONE_CASES:
+                    new_entry[attribute] = infos[i].text
+                i += 1
+
+            results.append(new_entry)
+
+        return results
@@ -0,0 +1,74 @@
+'''Eigenständiger Prozess, der alle Pläne abfragt & als Snapshots veröffentlicht
+Die Bot-Shards lesen dann nur noch aus dem SnapshotStore (siehe main.py)'''
+import os
+import time
+from typing import Final, Optional, Dict
+
+from plan_archive import ARCHIVE_INTERVAL, PlanArchive, archive_plan
+from plan_registry import PlanRegistry
+from server_database import PageDatabase
+from snapshot_store import SnapshotStore, SNAPSHOT_DB
+from timetable_parser import Page
+
+
+# Sekunden zwischen zwei Abfragen der Schulseiten
+FETCH_INTERVAL: Final[float] = float(os.environ.get('FETCH_INTERVAL', 300))
+
+# Plan -> Zeitpunkt der letzten Archivierung
+archived_at: Dict[int, float] = {}
+
+
+def fetch_all(registry: PlanRegistry, store: SnapshotStore,
+              archive: Optional[PlanArchive] = None) -> None:
+    '''Fragt alle genutzten Pläne einmal ab & veröffentlicht geänderte Stände
+    Pläne, die kein Shard mehr abfragt, werden pausiert & verworfen.
+    Jeder neue Stand eines Tages landet zusätzlich im Archiv, pausierte Pläne
+    werden dafür noch alle ARCHIVE_INTERVAL Sekunden abgefragt'''
+    for plan_id in list(registry.pages):
+        requested = store.get_requested(plan_id)
+        idle = time.time() - registry.idle_timeout
+        paused = store.get_version(plan_id) is not None and (requested is None
+                                                            or requested < idle)
+        if paused and (archive is None or time.time() - archived_at.get(
+                plan_id, 0.0) < ARCHIVE_INTERVAL):
+            registry.evict(plan_id)
+            continue
+
+        try:
+            plan: Page = registry.get(plan_id)
+            replacements = plan.get_plan_for_all()
+        except Exception as error:
+            print(f'Plan {plan_id} konnte nicht abgefragt werden:', error)
+            continue
+
+        days = plan.get_all_days()
+        version = store.publish(plan_id, plan.times, replacements or {},
+                                days, plan.stale_since)
+        print(f'Plan {plan_id}: Version {version}')
+
+        if archive is not None:
+            archived = archive_plan(archive, plan_id, plan)
+            archived_at[plan_id] = time.time()
+            if archived:
+                print(f'Plan {plan_id}: {len(archived)} Stände archiviert')
+        if paused:
+            registry.evict(plan_id)
+
+
+def run(interval: float = FETCH_INTERVAL, name: str = SNAPSHOT_DB) -> None:
+    '''Fragt die Pläne in einer Endlosschleife ab'''
+    store = SnapshotStore(name)
+    archive = PlanArchive()
+    registry = PlanRegistry(PageDatabase(), lambda url, page_struct: Page(
+        url, page_struct=page_struct))
+
+    while True:
+        started = time.monotonic()
+        # die Shards tragen neue Pläne in die Datenbank ein
+        registry.reload()
+        fetch_all(registry, store, archive)
+        time.sleep(max(0.0, interval - (time.monotonic() - started)))
+
+
+if __name__ == '__main__':
+    run()
@@ -1,15 +1,46 @@
-from flask import Flask
+import hmac
+import os
 from threading import Thread
+from typing import Callable, Dict
+
+# name -> function returning the current Counters, served as JSON on /stats
+STATS: Dict[str, Callable[[], dict]] = {}
 
-app = Flask('')
 
-@app.route('/')
 def home():
     return "Bot is working..."
 
+def stats():
+    return {name: provider() for name, provider in STATS.items()}
+
+def register_stats(name: str, provider: Callable[[], dict]):
+    STATS[name] = provider
+
+def debug_profile():
+    '''Profiles the running Bot, needs the DEBUG_TOKEN as ?token='''
+    from flask import abort, request
+    from sampling_profiler import ProfilerBusyError, profile
+
+    token = os.environ.get('DEBUG_TOKEN')
+    if not token or not hmac.compare_digest(request.args.get('token', ''), token):
+        abort(404)
+
+    try:
+        collapsed = profile(request.args.get('seconds', 10, type=float))
+    except ProfilerBusyError as error:
+        return str(error), 409
+    return collapsed, 200, {'Content-Type': 'text/plain; charset=utf-8'}
+
 def run():
+  # Flask is only needed for the keep-alive server, load it in its Thread
+  from flask import Flask
+
+  app = Flask('')
+  app.route('/')(home)
+  app.route('/stats')(stats)
+  app.route('/debug/profile')(debug_profile)
   app.run(host='0.0.0.0',port=8080)
 
 def keep_alive():
     t = Thread(target=run)
-    t.start()
\ No newline at end of file
+    t.start()
@@ -0,0 +1,458 @@
+'''Lasttest für die Morgenspitze, ohne echten Verkehr
+Lokale Stand-ins spielen aufgenommene Untis-Seiten & DSBMobile-Antworten mit
+einstellbarer Latenz ab, eine Discord-Attrappe zeichnet alle Nachrichten auf &
+simuliert das Rate Limit. N Server schicken gleichzeitig /vplan get & /vplan all.
+
+Aufnehmen (fragt die echten Seiten einmal ab):
+    python loadtest.py record [plan_id ...]
+Abspielen:
+    python loadtest.py run --guilds 200 --commands 3 --latency 0.3
+'''
+import argparse
+import asyncio
+import base64
+import copy
+import gzip
+import json
+import math
+import os
+import random
+import socket
+import tempfile
+import time
+import urllib.request
+from collections import Counter, deque
+from typing import Final, Optional, Deque, Dict, List, Tuple
+
+from discord import Object
+
+import main
+from attachment_database import ImageDatabase
+from plan_registry import PlanRegistry
+from server_database import PageDatabase
+from timetable_parser import Page, DEFAULT_MAPPER, UNTIS_HTML, DSB_MOBILE, load_credentials
+
+RECORDINGS: Final[str] = os.environ.get('LOADTEST_RECORDINGS',
+                                        'loadtest_recordings')
+MANIFEST: Final[str] = 'manifest.json'
+
+# Discord erlaubt etwa 5 Nachrichten pro 5 Sekunden & Channel
+RATE_LIMIT: Final[int] = 5
+RATE_LIMIT_PER: Final[float] = 5.0
+
+
+def fetch(url: str) -> bytes:
+    with urllib.request.urlopen(url, timeout=30) as response:
+        return response.read()
+
+
+def save(directory: str, path: str, data: bytes) -> None:
+    '''Speichert eine Antwort unter ihrem Pfad auf dem Stand-in'''
+    filename = os.path.join(directory, *path.strip('/').split('/'))
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, 'wb') as file:
+        file.write(data)
+
+
+def record_untis(directory: str, plan_id: int, url: str) -> Tuple[str, List[str]]:
+    '''Nimmt die Übersicht & die Seiten aller Klassen eines Untis-Plans auf
+    Gibt den Pfad der Übersicht & die Klassen zurück'''
+    from lxml import html
+
+    base = f'/untis/{plan_id}/'
+    index = fetch(url)
+
+    classes = []
+    tables = html.fromstring(index).findall('.//center//table')
+    for cell in tables[1].iterfind('.//td/a') if len(tables) > 1 else ():
+        link: str = cell.get('href')
+        name = link.rsplit('/', 1)[-1]
+        if link.count('/') == 0:  # wie Page.parse_untis_html_table
+            link = url.rsplit('/', 1)[0] + '/' + link
+        else:
+            # absolute Links zeigen beim Abspielen auf den Stand-in
+            index = index.replace(cell.get('href').encode(), name.encode())
+
+        save(directory, base + name, fetch(link))
+        classes.append(cell.text_content())
+
+    path = base + url.rsplit('/', 1)[-1]
+    save(directory, path, index)
+    return path, classes
+
+
+def record_dsb(directory: str, plan_id: int, page_struct: dict) -> Tuple[str, List[str]]:
+    '''Nimmt die GetData-Antwort & alle Vertretungsseiten eines DSBMobile-Plans auf
+    Gibt den Anmeldenamen auf dem Stand-in & die Klassen zurück'''
+    import requests
+    from dsbapi import DSBApi, is_timetable
+
+    credentials = (page_struct['username'], page_struct['password']) \
+        if 'username' in page_struct else load_credentials(page_struct['id'])
+    api = DSBApi(*credentials,
+                 tablemapper=page_struct.get('mapper', DEFAULT_MAPPER),
+                 inline_header=page_struct.get('inline_header', False))
+    data = api.fetch_data()
+
+    classes = set()
+    for i, item in enumerate(api.detail_items(data)):
+        if not is_timetable(item['Detail']):
+            continue
+
+        page = requests.get(item['Detail'], timeout=30).text
+        for day in api.parse_days(page):
+            classes.update(class_ for entry in day.entries
+                           for class_ in entry['classes'] if class_ is not None)
+
+        # beim Abspielen wird die Adresse des Stand-ins vorangestellt
+        item['Detail'] = f"/dsb/{plan_id}/{i}_{item['Detail'].rsplit('/', 1)[-1]}"
+        save(directory, item['Detail'], page.encode('utf-8'))
+
+    save(directory, f'/dsb/{plan_id}/GetData.json', json.dumps(data).encode('utf-8'))
+    return f'plan{plan_id}', sorted(classes)
+
+
+def record(plan_ids: List[int], directory: str = RECORDINGS) -> None:
+    '''Fragt die Pläne einmal ab & speichert alles, was der Bot dabei lädt'''
+    registry = PlanRegistry(PageDatabase(), lambda url, page_struct: None)
+
+    plans = {}
+    for plan_id in plan_ids or list(registry.pages):
+        url, page_struct = registry.pages[plan_id]
+        struct = {key: value for key, value in page_struct.items()
+                  if not key in ('username', 'password')}
+        if page_struct['type'] == UNTIS_HTML:
+            struct['path'], struct['classes'] = record_untis(directory, plan_id, url)
+        elif page_struct['type'] == DSB_MOBILE:
+            struct['username'], struct['classes'] = record_dsb(directory, plan_id, page_struct)
+        else:
+            continue
+
+        plans[plan_id] = struct
+        print(f"Plan {plan_id} aufgenommen: {len(struct['classes'])} Klassen")
+
+    with open(os.path.join(directory, MANIFEST), 'w', encoding='utf-8') as file:
+        json.dump({'plans': plans}, file, ensure_ascii=False, indent=2)
+
+
+class UpstreamStandIn:
+    '''Spielt die aufgenommenen Untis-Seiten & DSBMobile-Antworten ab
+    Jede Anfrage wartet latency ± jitter Sekunden & wird gezählt'''
+
+    def __init__(self, directory: str, latency: float, jitter: float):
+        self.directory = directory
+        self.latency = latency
+        self.jitter = jitter
+        self.base_url: Optional[str] = None
+        # (Plan-ID, Art der Anfrage) -> Anzahl
+        self.requests: Counter = Counter()
+        self.files: Dict[str, bytes] = {}
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0):
+        from aiohttp import web
+
+        app = web.Application()
+        app.router.add_post('/JsonHandler.ashx/GetData', self.get_data)
+        app.router.add_get('/{kind}/{plan_id}/{name}', self.get_file)
+
+        # mit Port 0 sucht sich das System einen freien Port aus
+        sock = socket.socket()
+        sock.bind((host, port))
+        self.base_url = f'http://{host}:{sock.getsockname()[1]}'
+
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.SockSite(self.runner, sock).start()
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    async def delay(self):
+        await asyncio.sleep(max(0.0, random.uniform(self.latency - self.jitter,
+                                                    self.latency + self.jitter)))
+
+    def read(self, path: str) -> Optional[bytes]:
+        if not path in self.files:
+            filename = os.path.join(self.directory, *path.strip('/').split('/'))
+            if not os.path.isfile(filename):
+                return None
+            with open(filename, 'rb') as file:
+                self.files[path] = file.read()
+        return self.files[path]
+
+    async def get_file(self, request):
+        from aiohttp import web
+
+        plan_id = request.match_info['plan_id']
+        kind = request.match_info['kind']
+        self.requests[plan_id, 'dsb timetable' if kind == 'dsb' else 'untis'] += 1
+        await self.delay()
+
+        data = self.read(request.path)
+        if data is None:
+            raise web.HTTPNotFound()
+        response = web.Response(body=data, content_type='text/html')
+        # wie die echten Server komprimieren, wenn der Bot es anbietet
+        response.enable_compression()
+        return response
+
+    async def get_data(self, request):
+        '''Der JsonHandler von DSBMobile, der Plan wird am Anmeldenamen erkannt'''
+        from aiohttp import web
+
+        body = await request.json()
+        params = json.loads(gzip.decompress(base64.b64decode(body['req']['Data'])))
+        plan_id = params['UserId'][len('plan'):]
+        self.requests[plan_id, 'dsb GetData'] += 1
+        await self.delay()
+
+        recorded = self.read(f'/dsb/{plan_id}/GetData.json')
+        if recorded is None:
+            data = {'Resultcode': 1, 'ResultStatusInfo': 'Unbekannter Benutzer'}
+        else:
+            from dsbapi import DSBApi
+
+            data = json.loads(recorded)
+            for item in DSBApi.detail_items(data):
+                if item['Detail'].startswith('/'):
+                    item['Detail'] = self.base_url + item['Detail']
+
+        return web.json_response({'d': base64.b64encode(gzip.compress(
+            json.dumps(data).encode('utf-8'))).decode('utf-8')})
+
+
+class FakeDiscord:
+    '''Attrappe der Discord REST-API: zeichnet alle Nachrichten auf & lässt jeden
+    Channel nur RATE_LIMIT Nachrichten pro RATE_LIMIT_PER Sekunden senden.
+    Wie discord.py wird bei einem 429 retry_after gewartet & erneut gesendet'''
+
+    def __init__(self, latency: float = 0.05, rate: int = RATE_LIMIT,
+                 per: float = RATE_LIMIT_PER):
+        self.latency = latency
+        self.rate = rate
+        self.per = per
+
+        self.sent: List[Tuple[int, dict]] = []
+        self.buckets: Dict[int, Deque[float]] = {}
+        self.rate_limited: int = 0
+        self.deferred: int = 0
+
+    async def defer(self):
+        '''Interaction-Callbacks zählen nicht zum Rate Limit des Channels'''
+        self.deferred += 1
+        await asyncio.sleep(self.latency)
+
+    async def create_message(self, channel_id: int, payload: dict):
+        bucket = self.buckets.setdefault(channel_id, deque())
+        while True:
+            await asyncio.sleep(self.latency)
+            now = time.monotonic()
+            while bucket and now - bucket[0] >= self.per:
+                bucket.popleft()
+            if len(bucket) < self.rate:
+                break
+
+            self.rate_limited += 1
+            await asyncio.sleep(self.per - (now - bucket[0]))
+
+        bucket.append(now)
+        self.sent.append((channel_id, payload))
+
+
+class FakeContext:
+    '''Steht für den SlashContext eines Befehls, sendet über die FakeDiscord'''
+
+    def __init__(self, discord: FakeDiscord, guild_id: int, channel_id: int):
+        self.discord = discord
+        self.guild = Object(id=guild_id)
+        self.channel = Object(id=channel_id)
+        self.first_response: Optional[float] = None
+
+    async def defer(self, hidden: bool = False):
+        await self.discord.defer()
+
+    async def send(self, content: str = None, *, embed=None, embeds=None,
+                   file=None, files=None, hidden: bool = False, **kwargs):
+        embeds = [embed] if embed is not None else embeds or []
+        files = [file] if file is not None else files or []
+        await self.discord.create_message(self.channel.id, {
+            'content': content,
+            'embeds': len(embeds),
+            'files': len(files)
+        })
+        if self.first_response is None:
+            self.first_response = time.perf_counter()
+
+
+def percentile(values: List[float], q: float) -> float:
+    '''Perzentil nach dem Nearest-Rank-Verfahren'''
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(q / 100 * len(ordered)) - 1))]
+
+
+class LoadTest:
+    '''Lässt N Server gleichzeitig Befehle an die aufgenommenen Pläne schicken'''
+
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        with open(os.path.join(args.recordings, MANIFEST), encoding='utf-8') as file:
+            self.manifest: Dict[str, dict] = json.load(file)['plans']
+
+        self.upstream = UpstreamStandIn(args.recordings, args.latency, args.jitter)
+        self.discord = FakeDiscord(args.discord_latency)
+        # Befehl -> (Dauer bis zur ersten Nachricht, Gesamtdauer), ohne defer
+        # beantwortete Befehle (aus dem Cache, siehe main.send_plan) getrennt
+        self.latencies: Dict[str, List[Tuple[float, float]]] = {
+            'get': [], 'get cache': [], 'all': [], 'all cache': []}
+        self.errors: Counter = Counter()
+
+    def create_registry(self, page_db: PageDatabase, img_db: ImageDatabase) -> PlanRegistry:
+        '''Die Pläne zeigen auf den Stand-in statt auf die Schulen'''
+        plans = PlanRegistry(page_db, lambda url, page_struct: Page(
+            url, img_db, page_struct))
+        plans.pages.clear()
+
+        for plan_id, struct in self.manifest.items():
+            struct = copy.deepcopy(struct)
+            if struct['type'] == UNTIS_HTML:
+                url = self.upstream.base_url + struct['path']
+            else:
+                url = f"dsb://{struct['username']}"
+                struct['password'] = 'loadtest'
+                struct['data_url'] = self.upstream.base_url + '/JsonHandler.ashx/GetData'
+            plans.pages[int(plan_id)] = (url, struct)
+
+        return plans
+
+    async def run_command(self, context: FakeContext, command: str,
+                          plans: PlanRegistry, page_db: PageDatabase,
+                          img_db: ImageDatabase, klasse: str):
+        started = time.perf_counter()
+        plan_id = page_db.get_server_default(context.guild)
+        try:
+            # wie die Slash Commands in main.py, gerade abgefragte Pläne
+            # werden ohne defer sofort gesendet
+            if command == 'get':
+                plan, cached = main.peek_class_plan(plans, plan_id, klasse)
+                if cached is None:
+                    await context.defer()
+                await main.send_class_plan(context, plans, page_db, img_db, klasse,
+                                           cached=cached,
+                                           plan=None if cached is None else plan)
+            else:
+                plan = plans.peek(plan_id)
+                cached = None if plan is None else plan.cached_plan_for_all()
+                if cached is None:
+                    await context.defer()
+                await main.send_school_plan(context, plans, page_db, img_db, cached)
+        except Exception as error:
+            self.errors[f'{command}: {type(error).__name__}'] += 1
+            return
+
+        finished = time.perf_counter()
+        first = finished if context.first_response is None else context.first_response
+        key = command if cached is None else f'{command} cache'
+        self.latencies[key].append((first - started, finished - started))
+
+    async def run_guild(self, guild_id: int, plan_id: str, plans: PlanRegistry,
+                        page_db: PageDatabase, img_db: ImageDatabase):
+        args = self.args
+        await asyncio.sleep(random.uniform(0, args.ramp))
+
+        classes = self.manifest[plan_id]['classes'] or ['5a']
+        for _ in range(args.commands):
+            command = 'all' if random.random() < args.all_ratio else 'get'
+            context = FakeContext(self.discord, guild_id, guild_id)
+            await self.run_command(context, command, plans, page_db, img_db,
+                                   random.choice(classes))
+            await asyncio.sleep(random.uniform(0, args.think_time))
+
+    async def run(self):
+        args = self.args
+        await self.upstream.start()
+
+        with tempfile.TemporaryDirectory() as directory:
+            page_db = PageDatabase(os.path.join(directory, 'webpages.db'))
+            img_db = ImageDatabase(os.path.join(directory, 'attachments.db'))
+            plans = self.create_registry(page_db, img_db)
+
+            plan_ids = list(self.manifest)
+            for guild_id in range(1, args.guilds + 1):
+                page_db.config_server(Object(id=guild_id),
+                                      int(plan_ids[guild_id % len(plan_ids)]))
+
+            started = time.perf_counter()
+            await asyncio.gather(*(self.run_guild(
+                guild_id, plan_ids[guild_id % len(plan_ids)], plans, page_db,
+                img_db) for guild_id in range(1, args.guilds + 1)))
+            self.duration = time.perf_counter() - started
+
+            del plans, img_db, page_db
+
+        await self.upstream.stop()
+
+    def report(self):
+        print(f'{self.args.guilds} Server, {self.duration:.2f}s\n')
+        print(f"{'Befehl':<10}{'Anzahl':>8}{'p50':>9}{'p99':>9}{'max':>9}{'1. p50':>9}{'1. p99':>9}")
+        for command, latencies in self.latencies.items():
+            if not latencies:
+                continue
+            first = [latency[0] for latency in latencies]
+            total = [latency[1] for latency in latencies]
+            print(f'{command:<10}{len(latencies):>8}'
+                  f'{percentile(total, 50):>8.3f}s{percentile(total, 99):>8.3f}s{max(total):>8.3f}s'
+                  f'{percentile(first, 50):>8.3f}s{percentile(first, 99):>8.3f}s')
+
+        print(f'\nDiscord: {len(self.discord.sent)} Nachrichten, '
+              f'{sum(message[1]["embeds"] for message in self.discord.sent)} Embeds, '
+              f'{self.discord.deferred} defer, {self.discord.rate_limited}x Rate Limit (429)')
+
+        print('\nAnfragen an die Schulen:')
+        for (plan_id, kind), count in sorted(self.upstream.requests.items()):
+            print(f'  Plan {plan_id:<4} {kind:<14}{count:>6}')
+
+        for error, count in self.errors.most_common():
+            print(f'Fehler {error}: {count}x')
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--recordings', default=RECORDINGS,
+                        help='Verzeichnis der Aufnahmen')
+    commands = parser.add_subparsers(dest='mode', required=True)
+
+    record_parser = commands.add_parser('record', help='Pläne aufnehmen')
+    record_parser.add_argument('plan_ids', nargs='*', type=int,
+                               help='nur diese Pläne (Standard: alle)')
+
+    run_parser = commands.add_parser('run', help='Lasttest abspielen')
+    run_parser.add_argument('--guilds', type=int, default=100,
+                            help='Anzahl der Server')
+    run_parser.add_argument('--commands', type=int, default=3,
+                            help='Befehle pro Server')
+    run_parser.add_argument('--all-ratio', type=float, default=0.1,
+                            help='Anteil /vplan all an den Befehlen')
+    run_parser.add_argument('--ramp', type=float, default=2.0,
+                            help='Sekunden, über die die Server losschicken')
+    run_parser.add_argument('--think-time', type=float, default=1.0,
+                            help='höchstens so viele Sekunden zwischen zwei Befehlen')
+    run_parser.add_argument('--latency', type=float, default=0.2,
+                            help='Latenz der Schulseiten in Sekunden')
+    run_parser.add_argument('--jitter', type=float, default=0.1,
+                            help='Schwankung der Latenz in Sekunden')
+    run_parser.add_argument('--discord-latency', type=float, default=0.05,
+                            help='Latenz der Discord-API in Sekunden')
+    run_parser.add_argument('--seed', type=int, default=None)
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    arguments = parse_args()
+    if arguments.mode == 'record':
+        record(arguments.plan_ids, arguments.recordings)
+    else:
+        random.seed(arguments.seed)
+        load_test = LoadTest(arguments)
+        asyncio.run(load_test.run())
+        load_test.report()
@@ -0,0 +1,108 @@
+'''Misst die Verzögerung der Event Loop & findet heraus, was sie blockiert
+Ein Coroutine-Herzschlag tickt alle INTERVAL Sekunden, ein Thread prüft ihn.
+Bleibt der Herzschlag länger als THRESHOLD aus, wird der Stack des
+Loop-Threads mitgeschnitten, also genau der blockierende Aufruf.'''
+import asyncio
+import sys
+import threading
+import time
+import traceback
+from typing import Final, Optional, Dict, List
+
+
+# Sekunden zwischen zwei Herzschlägen
+INTERVAL: Final[float] = 0.1
+# ab so vielen Sekunden ohne Herzschlag gilt die Loop als blockiert
+THRESHOLD: Final[float] = 0.5
+# so viele mitgeschnittene Stacks werden für die Statistik behalten
+KEEP_STALLS: Final[int] = 5
+
+
+class LoopWatchdog:
+    '''Zählt Verzögerungen & Blockaden der Event Loop'''
+
+    def __init__(self, threshold: float = THRESHOLD, interval: float = INTERVAL):
+        self.threshold = threshold
+        self.interval = interval
+
+        self.loop_thread: Optional[int] = None
+        self.last_beat: float = time.monotonic()
+        # der Herzschlag, dessen Blockade schon mitgeschnitten wurde
+        self.captured_beat: Optional[float] = None
+
+        self.beats: int = 0
+        self.stalls: int = 0
+        self.max_lag: float = 0.0
+        self.total_lag: float = 0.0
+        self.recent: List[Dict] = []
+
+        self.lock = threading.Lock()
+        self.task: Optional[asyncio.Task] = None
+
+    @property
+    def is_running(self) -> bool:
+        return self.task is not None and not self.task.done()
+
+    def start(self) -> None:
+        '''Startet Herzschlag & Wächter, muss in der laufenden Loop passieren'''
+        if self.is_running:
+            return
+        self.loop_thread = threading.get_ident()
+        self.last_beat = time.monotonic()
+        self.task = asyncio.get_running_loop().create_task(self.heartbeat())
+        threading.Thread(target=self.watch, name='loop-watchdog',
+                         daemon=True).start()
+
+    async def heartbeat(self) -> None:
+        '''Die Verzögerung ist, wie viel später als geplant die Loop zurückkehrt'''
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(0.0, now - expected)
+            with self.lock:
+                self.last_beat = now
+                self.beats += 1
+                self.total_lag += lag
+                self.max_lag = max(self.max_lag, lag)
+
+    def watch(self) -> None:
+        '''Läuft im eigenen Thread, die Loop kann ihn nicht blockieren'''
+        while self.is_running:
+            time.sleep(self.interval)
+            with self.lock:
+                beat = self.last_beat
+                stalled = time.monotonic() - beat
+                if stalled < self.threshold or self.captured_beat == beat:
+                    continue
+                self.captured_beat = beat
+
+            frame = sys._current_frames().get(self.loop_thread)
+            if frame is None:
+                continue
+            stack = ''.join(traceback.format_stack(frame))
+            self.record_stall(stalled, stack)
+
+    def record_stall(self, stalled: float, stack: str) -> None:
+        with self.lock:
+            self.stalls += 1
+            self.recent.append({
+                'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+                'stalled': round(stalled, 3),
+                'stack': stack
+            })
+            del self.recent[:-KEEP_STALLS]
+        print(f'Event Loop blockiert seit {stalled:.2f}s:\n{stack}',
+              file=sys.stderr)
+
+    def stats(self) -> Dict:
+        '''Zähler für die Bot-Statistik (Sekunden)'''
+        with self.lock:
+            return {
+                'beats': self.beats,
+                'stalls': self.stalls,
+                'mean_lag': round(self.total_lag / self.beats, 4) if self.beats else 0.0,
+                'max_lag': round(self.max_lag, 4),
+                'threshold': self.threshold,
+                'recent_stalls': list(self.recent)
+            }
@@ -1,19 +1,31 @@
+import time
+
+# measure the Startup from the very first Import on
+STARTUP_BEGIN: float = time.perf_counter()
+
+import io
 import os
+import asyncio
+import hashlib
 import json
-from typing import List, Dict
-from datetime import date, datetime
-from pytz import timezone
-from discord import Embed, Intents
+from functools import lru_cache, partial
+from typing import Iterator, Optional, Tuple, List, Dict
+from datetime import date, datetime, timedelta
+from discord import AsyncWebhookAdapter, Embed, File, Forbidden, Intents, MemberCacheFlags, NotFound, Object, Webhook
+from discord.http import Route
 from discord.abc import Messageable
 from discord.ext import commands, tasks
-from discord_slash import SlashCommand
 
 from attachment_database import ImageDatabase
+from channel_context import ChannelContext, EditingContext, RecordingContext, WebhookContext, plan_digest
 from server_database import PageDatabase
 from timetable_parser import Page
-from replacement_types import ReplacementType
-from preview_factory import create_vplan_message
-from keep_alive import keep_alive
+from plan_registry import PlanRegistry
+from plan_index import PlanIndex, IndexEntry, class_sort_key
+from replacement_types import ReplacementType, PlanPreview
+from preview_factory import create_vplan_message, create_image_message, render_plan_image
+from config import TIMEZONE, load_pages
+from plan_renderer import preview_key
 
 EMPTY_FIELD = {'name': '\u200b', 'value': '\u200b', 'inline': False}
 
@@ -30,60 +42,384 @@ NO_REPLACEMENTS_EMBED.add_field(name='**Keine Vertretungen heute...**',
                                 inline=False)
 NO_REPLACEMENTS_EMBED.set_footer(**DEFAULT_FOOTER)
 
-TIMEZONE = timezone('Europe/Berlin')
+# Plans with more Replacements, than fit into one Message, are sent as an Image
+PLAN_IMAGE_THRESHOLD = 10
+
+# the popular Classes of each Plan are prefetched during the Morning Peak
+PREFETCH_HOURS = range(5, 9)
+PREFETCH_CLASSES = 8
+
+# Name of the Webhooks, that deliver scheduled Events (see add-event)
+WEBHOOK_NAME = 'Vertretungsplan'
+
+# a changed Stand is only sent, once it didn't change for this many Seconds,
+# Schools often upload their Plan several Times in a Row
+SUBSCRIPTION_DEBOUNCE = 4 * 60
+# the notified Stand of Subscriptions, whose Class has no Replacements
+NO_REPLACEMENTS_STAND = ''
+
+# Interaction Types, that discord_slash doesn't handle
+AUTOCOMPLETE_INTERACTION = 4
+AUTOCOMPLETE_RESULT = 8
+
+# Read the Timetable Data
+PAGES: dict = load_pages()
+
+
+def parse_day(text: str) -> Optional[date]:
+    '''Parses `heute`, `morgen` or a Date (dd.mm.yyyy / dd.mm.)
+    Weekends roll over to the next monday, None if the Text is invalid'''
+    today: date = datetime.now(TIMEZONE).date()
+    text = text.strip().lower()
+
+    if text in ('heute', 'today'):
+        day = today
+    elif text in ('morgen', 'tomorrow'):
+        day = today + timedelta(days=1)
+    else:
+        try:
+            parts = [int(part) for part in text.split('.') if part]
+            day = date(parts[2] if len(parts) > 2 else today.year, parts[1],
+                       parts[0])
+        except (ValueError, IndexError):
+            return None
+
+    while day.weekday() >= 5:
+        day += timedelta(days=1)
+
+    return day
+
+
+async def run_blocking(func, *args):
+    '''Runs blocking Plan Calls (Network & Parsing) in a Thread,
+    so a slow School Site doesn't stall the Event Loop'''
+    return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
 
-# Read the Timetable Data - unused
-with open('pages.json', 'r', encoding='utf-8') as page_json:
-    PAGES: dict = json.loads(page_json.read())
+def stale_notice(plan) -> str:
+    '''Warns, if the Plan is served from its last known State'''
+    stale_since: Optional[float] = getattr(plan, 'stale_since', None)
+    if stale_since is None:
+        return ''
+
+    since: datetime = datetime.fromtimestamp(stale_since, TIMEZONE)
+    return f"⚠️ *Die Seite der Schule ist nicht erreichbar, das ist der Stand vom {since.strftime('%d.%m. %H:%M')} Uhr!*\n"
+
+
+def schema_digest(schema: dict) -> str:
+    '''Hashes the generated Slash Command Schema'''
+    return hashlib.sha256(
+        json.dumps(schema, sort_keys=True, default=str).encode()).hexdigest()
+
+
+@lru_cache(maxsize=None)
+def load_archive():
+    '''The Archive is only opened, once it is needed'''
+    from plan_archive import PlanArchive
+
+    return PlanArchive()
+
+
+@lru_cache(maxsize=None)
+def load_stats():
+    '''numpy is only loaded for the first Statistic'''
+    from plan_stats import PlanStats
+
+    return PlanStats(load_archive())
+
+
+def stats_period(period: str) -> Tuple[Optional[date], Optional[date]]:
+    '''Returns the first & the first excluded Day of `monat`, `vormonat`,
+    `schuljahr` (since the 1st of August) or `alles`'''
+    today: date = datetime.now(TIMEZONE).date()
+    month: date = today.replace(day=1)
+
+    if period == 'monat':
+        return month, None
+    elif period == 'vormonat':
+        return (month - timedelta(days=1)).replace(day=1), month
+    elif period == 'schuljahr':
+        return date(today.year if today.month >= 8 else today.year - 1, 8, 1), None
+    return None, None
+
+
+def find_focused_option(options: List[dict]) -> Optional[dict]:
+    '''Finds the Option the User is typing in (also inside Subcommands)'''
+    for option in options:
+        if option.get('focused'):
+            return option
+        focused = find_focused_option(option.get('options', []))
+        if focused is not None:
+            return focused
+    return None
 
 
 def sort_classes(classes: List[str]) -> List[str]:
     '''Sorts Classes by their Identifiers/Names'''
-    def comp(key: str):
-        i = 0
-        while key[:i + 1].isnumeric():
-            i += 1
-        return key[:i], key[i:]
-
-    return sorted(classes, key=comp)
-
-
-def check_last_modified() -> None:
-    '''Deletes the Database when the Code has changed'''
-    database = './attachments.db'
-    if not os.path.exists(database):
-        return
-
-    files = (  #'main.py', 'preview_factory.py', 'timetable_parser.py',
-        'attachment_database.py', )
-    db_last_mod = os.path.getmtime(database)
-    for file in files:
-        if db_last_mod < os.path.getmtime(file):
-            os.remove(database)
+    return sorted(classes, key=class_sort_key)
+
+
+def peek_class_plan(plans: PlanRegistry, plan_id: int, klasse: str
+                    ) -> Tuple[Optional[Page], Optional[Tuple[str, List[ReplacementType]]]]:
+    '''Returns the loaded Plan & the Plan of the Class, if it can be sent
+    right away (without a Fetch or rendering an Image), else (Plan, None)'''
+    plan = plans.peek(plan_id)
+    if plan is None:
+        return None, None
+    cached = plan.cached_plan_for_class(klasse)
+    # long Plans are sent as an Image, which may still have to be rendered
+    if cached is not None and len(cached[1]) > PLAN_IMAGE_THRESHOLD \
+            and plan.get_plan_preview(*cached) is None:
+        cached = None
+    return plan, cached
+
+
+async def send_class_plan(context, plans: PlanRegistry, page_db: PageDatabase,
+                          img_db: ImageDatabase, klasse: str,
+                          silent: bool = False, day: Optional[date] = None,
+                          cached: Optional[Tuple[str, List[ReplacementType]]] = None,
+                          plan: Optional[Page] = None):
+    '''Sends the Plan of a Class to the Context (Command or scheduled Event)
+    cached is the Plan from Page.cached_plan_for_class, if it was answered without
+    a Fetch, plan the Page it came from (then nothing blocks before sending)'''
+    plan_id: int = page_db.get_server_default(context.guild)
+    if plan is None:
+        plan = await run_blocking(plans.get, plan_id)
+    if cached is not None:
+        data = cached
+    elif day is None:
+        data = await run_blocking(plan.get_plan_for_class, klasse)
+    else:
+        data = await run_blocking(plan.get_plan_for_day, klasse, day)
+    notice: str = stale_notice(plan)
+
+    if data is None or data[1] is {}:
+        # Send, if we dont ignore empty Tables
+        if not silent:
+            await context.send(content=notice or None,
+                               embed=NO_REPLACEMENTS_EMBED)
+    else:
+        klasse: str = data[0]
+        date_str: str = plan.times.get(
+            klasse) if day is None else day.strftime('%d.%m.%Y')
+        if len(data[1]) > PLAN_IMAGE_THRESHOLD:
+            await send_plan_image(context, plan, klasse, data[1], date_str,
+                                  notice)
+        else:
+            for msg in create_vplan_message(data[1], klasse, img_db, date_str):
+                if notice:
+                    msg['content'] = notice + msg['content']
+                    notice = ''
+                await send_vplan_message(context, img_db, msg)
+
+    # counted after the Reply, it doesn't have to wait for the Database
+    if data is not None and not silent:
+        page_db.record_query(plan_id, data[0])
+
+
+async def send_vplan_message(context, img_db: ImageDatabase, msg: dict):
+    '''Sends a Message of create_vplan_message & remembers its uploaded Icons'''
+    message = await context.send(**msg)
+    if msg['files'] and message is not None:
+        img_db.remember_icons(message.attachments)
+
+
+async def send_plan_image(context, plan, klasse: str,
+                          events: List[ReplacementType], date_str: str,
+                          notice: str = ''):
+    '''Sends the whole Plan of a Class as one Image, it is rendered once per
+    "Stand" and afterwards reused by its CDN Link'''
+    image: Optional[PlanPreview] = plan.get_plan_preview(klasse, events)
+    if image is None:
+        image = await render_plan_image(
+            klasse, events, events[0].get('updated') or date_str)
+
+    msg: dict = create_image_message(klasse, image, date_str)
+    msg['content'] = notice + msg['content']
+    message = await context.send(**msg)
+
+    if isinstance(image, File) and message is not None and message.attachments:
+        plan.set_plan_preview(klasse, events, message.attachments[0].url)
+
+
+async def send_school_plan(context, plans: PlanRegistry, page_db: PageDatabase,
+                           img_db: ImageDatabase,
+                           cached: Optional[Dict[str, List[ReplacementType]]] = None):
+    '''Sends the Plan of the whole School to the Context, Class by Class
+    cached is the Plan from Page.cached_plan_for_all, if it was answered without a Fetch'''
+    plan_id: int = page_db.get_server_default(context.guild)
+    plan: Page = await run_blocking(plans.get, plan_id)
+
+    # the Classes are fetched one by one in a Thread & sent right away,
+    # so the first Message doesn't wait for the whole School
+    classes: Iterator[Tuple[str, List[ReplacementType]]] = \
+        plan.iter_plan_for_all() if cached is None else iter(cached.items())
+
+    first: bool = True
+    while True:
+        item = await run_blocking(next, classes, None)
+        if item is None:
             break
 
+        klasse, events = item
+        date_str: str = plan.times.get(klasse)
+        for msg in create_vplan_message(events, klasse, img_db, date_str,
+                                        False):
+            if first:
+                msg['content'] = stale_notice(plan) + f"**Vertretungsplan der ganzen Schule für den {'heutigen Tag' if date_str is None else date_str.split(' ')[0]}:**\n\n" + msg[
+                    'content']
+                first = False
+            await send_vplan_message(context, img_db, msg)
+
+    if first:
+        # No replacements
+        await context.send(content=stale_notice(plan) or None,
+                           embed=NO_REPLACEMENTS_EMBED)
+
 
 if __name__ == "__main__":
-    # remove the database, if it's older than the Source Code
-    check_last_modified()
+    from discord_slash import SlashCommand
+    from keep_alive import keep_alive, register_stats
+    from loop_watchdog import LoopWatchdog
 
+    # the Databases migrate their Schema in place when they are opened
     img_db: ImageDatabase = ImageDatabase()
     page_db: PageDatabase = PageDatabase()
-    plans = {
-        page['id']: Page(url, img_db)
-        for url, page in PAGES['keys'].items()
-    }
+    if 'SNAPSHOT_DB' in os.environ:
+        # a separate fetcher.py Process polls the Schools, only read its Snapshots
+        from snapshot_store import SnapshotStore, SnapshotPage
+
+        snapshot_store = SnapshotStore(os.environ['SNAPSHOT_DB'])
+        plans = PlanRegistry(
+            page_db, lambda url, page_struct: SnapshotPage(
+                page_struct['id'], snapshot_store, img_db))
+    else:
+        plans = PlanRegistry(
+            page_db,
+            lambda url, page_struct: Page(url, img_db, page_struct))
+
+    # run as one of several Shards, if configured
+    shard_config = {
+        'shard_id': int(os.environ['SHARD_ID']),
+        'shard_count': int(os.environ['SHARD_COUNT'])
+    } if 'SHARD_ID' in os.environ else {}
+
+    if os.environ.get('LOW_MEMORY'):
+        # the Bot only needs Interactions & the Guilds with their Channels,
+        # Members & Messages are neither received nor cached
+        intents = Intents.none()
+        intents.guilds = True
+        cache_config = {
+            'member_cache_flags': MemberCacheFlags.none(),
+            'max_messages': None,
+            'chunk_guilds_at_startup': False
+        }
+    else:
+        intents, cache_config = Intents.all(), {}
 
-    bot = commands.Bot(intents=Intents.all(), command_prefix='/')
-    slash = SlashCommand(bot, sync_commands=True)
+    bot = commands.Bot(intents=intents,
+                       command_prefix='/',
+                       **cache_config,
+                       **shard_config)
+    # logs the Stack of whatever blocks the Event Loop for longer than LOOP_STALL_THRESHOLD
+    watchdog = LoopWatchdog(
+        threshold=float(os.environ.get('LOOP_STALL_THRESHOLD', 0.5)))
+    register_stats('bot', lambda: {
+        'guilds': len(bot.guilds),
+        'latency': round(bot.latency, 4),
+        'active_plans': len(plans.active)
+    })
+    register_stats('event_loop', watchdog.stats)
+
+    # the Commands are only synced, when their Schema changed (see sync_commands)
+    slash = SlashCommand(bot, sync_commands=False)
+    commands_synced: bool = False
+
+    async def sync_commands():
+        '''Registers the Slash Commands with Discord, if their Schema changed
+        since the last Sync (or FORCE_COMMAND_SYNC is set)'''
+        schema: dict = await slash.to_dict()
+        digest: str = schema_digest(schema)
+        state_key: str = f'command_schema_{bot.user.id}'
+
+        if digest == page_db.get_state(state_key) \
+                and not os.environ.get('FORCE_COMMAND_SYNC'):
+            print('Slash Commands unchanged, skipping the Sync')
+            return
+
+        await slash.sync_all_commands()
+        page_db.set_state(state_key, digest)
+        print('Slash Commands synced')
 
     @bot.event
     async def on_ready():
         """Called when the Bot is ready"""
         print(f"We've logged in as {bot.user}")
+        print(f'Startup took {time.perf_counter() - STARTUP_BEGIN:.2f}s')
+        watchdog.start()
+
+        # on_ready fires again after Reconnects, the Commands are global,
+        # so only the first Shard syncs them
+        global commands_synced
+        if not commands_synced and shard_config.get('shard_id', 0) == 0:
+            commands_synced = True
+            await sync_commands()
+
+        if not exec_events.is_running():
+            exec_events.start()
+            exec_events.change_interval(minutes=15.0)
+        if not evict_plans.is_running():
+            evict_plans.start()
+        if not prefetch_classes.is_running():
+            prefetch_classes.start()
+        # with SNAPSHOT_DB, fetcher.py archives the Plans
+        if not 'SNAPSHOT_DB' in os.environ and not archive_plans.is_running():
+            archive_plans.start()
+        if not watch_subscriptions.is_running():
+            watch_subscriptions.start()
+
+    @bot.listen('on_socket_response')
+    async def on_autocomplete(msg: dict):
+        '''Answers Autocomplete Interactions for Classes from the Class Trie
+        of the loaded Plan, without touching the Network'''
+        if msg.get('t') != 'INTERACTION_CREATE' or msg['d'].get(
+                'type') != AUTOCOMPLETE_INTERACTION:
+            return
 
-        exec_events.start()
-        exec_events.change_interval(minutes=15.0)
+        interaction: dict = msg['d']
+        focused: Optional[dict] = find_focused_option(
+            interaction['data'].get('options', []))
+
+        choices: List[dict] = []
+        if focused is not None and focused['name'] == 'klasse' \
+                and 'guild_id' in interaction:
+            plan_id: int = page_db.get_server_default(
+                Object(id=int(interaction['guild_id'])))
+            plan = plans.peek(plan_id)
+            if plan is not None and plan.class_trie is not None:
+                choices = [{
+                    'name': name,
+                    'value': name
+                } for name in plan.class_trie.complete(str(focused.get('value', '')))]
+        elif focused is not None and focused['name'] == 'plan_id':
+            # the Plans added at runtime (by any Shard) are offered too
+            plans.reload()
+            choices = [{
+                'name': name,
+                'value': plan_id
+            } for plan_id, name in plans.search(str(focused.get('value', '')))]
+
+        await bot.http.request(
+            Route('POST',
+                  '/interactions/{interaction_id}/{interaction_token}/callback',
+                  interaction_id=interaction['id'],
+                  interaction_token=interaction['token']),
+            json={
+                'type': AUTOCOMPLETE_RESULT,
+                'data': {
+                    'choices': choices
+                }
+            })
 
     @slash.subcommand(
         base='vplan',
@@ -100,75 +436,93 @@ if __name__ == "__main__":
             'Name der Schule',
             'required':
             True,
-            'choices': [{
-                'name': page['name'],
-                'value': page['id']
-            } for page in PAGES['keys'].values()]
+            'autocomplete':
+            True
         }],
         subcommand_group_description='Verwalte die Pläne für diesen Server')
     async def set_server_default(context, plan_id: int):
+        if not plan_id in plans:
+            await context.send('Diesen Plan gibt es nicht!', hidden=True)
+            return
         page_db.config_server(context.guild, plan_id)
-        for page in PAGES['keys'].values():
-            if page['id'] == plan_id:
-                await context.send(
-                    f"Erfolgreich den Standard-Vertretungsplan des Servers auf **{page['name']}** festgelegt!"
-                )
-                break
-
-    # @slash.subcommand(
-    #     base='vplan',
-    #     name='add',
-    #     subcommand_group='config',
-    #     description='Fügt einen neuen Plan zum Server hinzu',
-    #     subcommand_group_description='Verwalte die Pläne für diesen Server',
-    #     options=[{
-    #         'name': 'plan_name',
-    #         'description': 'Name des neuen Plans',
-    #         'type': 3,
-    #         'required': True,
-    #     }, {
-    #         'name': 'seitentyp',
-    #         'description': 'Typ der Website',
-    #         'type': 4,
-    #         'required': True,
-    #         'choices': [{
-    #             'name': name,
-    #             'value': int(id)
-    #         } for id, name in PAGES['types'].items()]
-    #     }, {
-    #         'name': 'seitenlink',
-    #         'description': 'Link zum Plan',
-    #         'type': 3,
-    #         'required': False,
-    #     }, {
-    #         'name': 'username',
-    #         'description': 'Anmeldename für die Seite',
-    #         'type': 3,
-    #         'required': False,
-    #     }, {
-    #         'name': 'password',
-    #         'description': 'Anmeldename für die Seite',
-    #         'type': 3,
-    #         'required': False,
-    #     }, {
-    #         'name': 'default',
-    #         'description': 'Den Plan als Standard setzen',
-    #         'type': 5,
-    #         'required': False
-    #     }],
-    #     connector={
-    #         'seitentyp': 'page_type',
-    #         'seitenlink': 'link'
-    #     })
-    # async def add_plan(context,
-    #                    plan_name: str,
-    #                    page_type: int,
-    #                    link: str,
-    #                    username: str,
-    #                    password: str,
-    #                    default: bool = False):
-    #     ...
-    #     await context.send('Not yet implemented!')
+        await context.send(
+            f"Erfolgreich den Standard-Vertretungsplan des Servers auf **{plans.name(plan_id)}** festgelegt!"
+        )
+
+    @slash.subcommand(
+        base='vplan',
+        name='add',
+        subcommand_group='config',
+        description='Fügt einen neuen Plan zum Server hinzu',
+        subcommand_group_description='Verwalte die Pläne für diesen Server',
+        options=[{
+            'name': 'plan_name',
+            'description': 'Name des neuen Plans',
+            'type': 3,
+            'required': True,
+        }, {
+            'name': 'seitentyp',
+            'description': 'Typ der Website',
+            'type': 4,
+            'required': True,
+            'choices': [{
+                'name': name,
+                'value': int(id)
+            } for id, name in PAGES['types'].items()]
+        }, {
+            'name': 'seitenlink',
+            'description': 'Link zum Plan',
+            'type': 3,
+            'required': False,
+        }, {
+            'name': 'username',
+            'description': 'Anmeldename für die Seite',
+            'type': 3,
+            'required': False,
+        }, {
+            'name': 'password',
+            'description': 'Passwort für die Seite',
+            'type': 3,
+            'required': False,
+        }, {
+            'name': 'default',
+            'description': 'Den Plan als Standard setzen',
+            'type': 5,
+            'required': False
+        }],
+        connector={
+            'seitentyp': 'page_type',
+            'seitenlink': 'link'
+        })
+    async def add_plan(context,
+                       plan_name: str,
+                       page_type: int,
+                       link: str = None,
+                       username: str = None,
+                       password: str = None,
+                       default: bool = False):
+        # Plans store Credentials & make the Bot request any URL
+        if not context.author.guild_permissions.manage_guild:
+            await context.send(
+                'Pläne hinzufügen darf nur, wer den Server verwalten darf!',
+                hidden=True)
+            return
+
+        if (page_type == 0 and link is None) or (page_type == 1 and (
+                username is None or password is None)):
+            await context.send(
+                'Untis-Pläne brauchen einen `seitenlink`, DSBMobile-Pläne `username` & `password`!',
+                hidden=True)
+            return
+
+        plan_id: int = plans.register(plan_name, page_type, link, username,
+                                      password)
+        if default:
+            page_db.config_server(context.guild, plan_id)
+
+        await context.send(
+            f"Plan **{plans.name(plan_id)}** hinzugefügt{' & als Standard festgelegt' if default else ''}!",
+            hidden=True)
 
     @slash.subcommand(
         base='vplan',
@@ -187,17 +541,32 @@ if __name__ == "__main__":
             'description': 'Optional: Nur für eine bestimmte Klasse senden',
             'type': 3,
             'required': False,
+            'autocomplete': True
         }, {
             'name': 'channel',
             'description':
             'Der Channel, in dem gesendet wird (fällt auf den aktuellen zurück)',
             'type': 7,
             'required': False
+        }, {
+            'name': 'webhook',
+            'description':
+            'Optional: Über einen Webhook senden, blockiert die Befehle nicht (braucht "Webhooks verwalten")',
+            'type': 5,
+            'required': False
+        }, {
+            'name': 'bearbeiten',
+            'description':
+            'Optional: Den letzten Plan bearbeiten, statt ihn neu zu senden (nur bei Änderungen)',
+            'type': 5,
+            'required': False
         }])
     async def add_event(context,
                         time: str,
                         klasse: str = None,
-                        channel: Messageable = None):
+                        channel: Messageable = None,
+                        webhook: bool = False,
+                        bearbeiten: bool = False):
         await context.defer()
         if len(time) > 5 or not time.count(':') or not time.split(
                 ':')[0].isnumeric() or not time.split(':')[1].isnumeric():
@@ -212,25 +581,85 @@ if __name__ == "__main__":
                 channel = context.channel
 
             page_db.add_event(channel, t_stamp, klasse)
+            if bearbeiten and page_db.get_posted(channel.id, klasse) is None:
+                page_db.set_posted(channel.id, klasse, [])
+
+            notice: str = ''
+            if webhook:
+                try:
+                    hook: Webhook = await channel_webhook(channel)
+                    page_db.set_webhook(channel.id, hook.id, hook.token)
+                except Forbidden:
+                    notice = '\nDer Bot darf hier keine Webhooks verwalten, er sendet das Event also selbst.'
 
             await context.send(
-                f'Neues Event um {time} Uhr für Klasse: {klasse} im Channel **#-{channel.name}** ({channel.id}) hinzugefüt!'
+                f'Neues Event um {time} Uhr für Klasse: {klasse} im Channel **#-{channel.name}** ({channel.id}) hinzugefüt!{notice}'
             )
 
-    async def _send_plan(context, klasse, silent: bool = False):
-        plan_id: int = page_db.get_server_default(context.guild)
-        plan: Page = plans[plan_id]
-        data = plan.get_plan_for_class(klasse)
+    @slash.subcommand(
+        base='vplan',
+        name='subscribe',
+        subcommand_group='config',
+        description='Schickt den Plan einer Klasse, sobald er sich ändert',
+        options=[{
+            'name': 'klasse',
+            'description': 'Die Klasse, deren Änderungen gesendet werden',
+            'type': 3,
+            'required': True,
+            'autocomplete': True
+        }, {
+            'name': 'channel',
+            'description':
+            'Der Channel, in dem gesendet wird (fällt auf den aktuellen zurück)',
+            'type': 7,
+            'required': False
+        }])
+    async def subscribe(context, klasse: str, channel: Messageable = None):
+        if channel is None:
+            channel = context.channel
+
+        page_db.add_subscription(channel, klasse)
+        await context.send(
+            f'Der Plan der Klasse {klasse} wird ab jetzt bei jeder Änderung in **#-{channel.name}** gesendet!'
+        )
 
-        if data is None or data[1] is {}:
-            # Send, if we dont ignore empty Tables
-            if not silent:
-                await context.send(embed=NO_REPLACEMENTS_EMBED)
+    @slash.subcommand(
+        base='vplan',
+        name='unsubscribe',
+        subcommand_group='config',
+        description='Beendet das Senden der Änderungen einer Klasse',
+        options=[{
+            'name': 'klasse',
+            'description': 'Die Klasse, deren Änderungen nicht mehr gesendet werden',
+            'type': 3,
+            'required': True,
+            'autocomplete': True
+        }, {
+            'name': 'channel',
+            'description':
+            'Der Channel, in dem gesendet wurde (fällt auf den aktuellen zurück)',
+            'type': 7,
+            'required': False
+        }])
+    async def unsubscribe(context, klasse: str, channel: Messageable = None):
+        if channel is None:
+            channel = context.channel
+
+        if page_db.delete_subscription(channel.id, klasse):
+            await context.send(
+                f'Die Änderungen der Klasse {klasse} werden nicht mehr in **#-{channel.name}** gesendet.')
         else:
-            klasse: str = data[0]
-            date_str: str = plan.times.get(klasse)
-            for msg in create_vplan_message(data[1], klasse, img_db, date_str):
-                await context.send(**msg)
+            await context.send(
+                f'In **#-{channel.name}** werden keine Änderungen der Klasse {klasse} gesendet!',
+                hidden=True)
+
+    async def channel_webhook(channel) -> Webhook:
+        '''Reuses the Webhook, the Bot created in the Channel, or creates one'''
+        for hook in await channel.webhooks():
+            if hook.user is not None and hook.user.id == bot.user.id and hook.token:
+                return hook
+        return await channel.create_webhook(
+            name=WEBHOOK_NAME, reason='Sendet die geplanten Vertretungspläne')
 
     @slash.subcommand(
         base='vplan',
@@ -240,54 +669,120 @@ if __name__ == "__main__":
             'name': 'klasse',
             'description': 'Kürzel deiner Klasse',
             'type': 3,
-            'required': True
+            'required': True,
+            'autocomplete': True
+        }, {
+            'name': 'tag',
+            'description': 'Optional: heute, morgen oder ein Datum (dd.mm.yyyy)',
+            'type': 3,
+            'required': False
         }])
-    async def send_plan(context, klasse):
+    async def send_plan(context, klasse, tag: str = None):
         """Sends the Substitution-Table for the given Class"""
-        await context.defer()
-        await _send_plan(context, klasse)
+        day: Optional[date] = None
+        if tag is not None:
+            day = parse_day(tag)
+            if day is None:
+                await context.send(
+                    'Unbekannter Tag, versuch es mit `heute`, `morgen` oder `dd.mm.yyyy`!',
+                    hidden=True)
+                return
+
+        # a Plan, that was just fetched, is sent right away, without the
+        # extra Round Trip (& the "thinking…" State) of defer()
+        plan, cached = peek_class_plan(
+            plans, page_db.get_server_default(context.guild), klasse) \
+            if day is None else (None, None)
+
+        if cached is None:
+            await context.defer()
+        await send_class_plan(context, plans, page_db, img_db, klasse,
+                              day=day, cached=cached,
+                              plan=None if cached is None else plan)
 
     @slash.subcommand(
         base='vplan',
         name='klassen',
         description='Schickt alle Klassen, die heute Vertretung haben!')
     async def send_classes_w_replacements(context):
-        await context.defer()
-
         plan_id: int = page_db.get_server_default(context.guild)
-        plan: Page = plans[plan_id]
+        plan: Page = plans.peek(plan_id)
+        classes = None if plan is None else plan.cached_classes()
+
+        if classes is None:
+            await context.defer()
+            plan = await run_blocking(plans.get, plan_id)
+            classes = await run_blocking(plan.get_classes)
 
         info_embed = Embed(
             title='**Klassen die heute Vertretung haben**:',
             description=
-            f"`{'`, `'.join(plan.get_classes())}`\n\n Verwende `/vplan get <Klasse>` um einen bestimmten Plan zu sehen!"
+            f"`{'`, `'.join(classes)}`\n\n Verwende `/vplan get <Klasse>` um einen bestimmten Plan zu sehen!"
         )
         info_embed.set_footer(**DEFAULT_FOOTER)
-        await context.send(embed=info_embed)
+        await context.send(content=stale_notice(plan) or None,
+                           embed=info_embed)
+
+    async def _send_index_entries(context, entries: List[IndexEntry],
+                                  heading: str):
+        if not entries:
+            await context.send(embed=NO_REPLACEMENTS_EMBED)
+            return
+
+        for msg in create_vplan_message([entry[1] for entry in entries],
+                                        '',
+                                        img_db,
+                                        subtitle=False,
+                                        heading=heading,
+                                        labels=[entry[0] for entry in entries]):
+            await send_vplan_message(context, img_db, msg)
+
+    @slash.subcommand(
+        base='vplan',
+        name='lehrer',
+        description='Zeigt, was eine Lehrkraft vertritt und wo sie vertreten wird!',
+        options=[{
+            'name': 'kuerzel',
+            'description': 'Kürzel der Lehrkraft',
+            'type': 3,
+            'required': True
+        }])
+    async def send_teacher_plan(context, kuerzel: str):
+        await context.defer()
 
-    async def _send_plan_for_all(context):
         plan_id: int = page_db.get_server_default(context.guild)
-        plan: Page = plans[plan_id]
+        plan = await run_blocking(plans.get, plan_id)
+        index: PlanIndex = await run_blocking(plan.get_index)
+        covering, replaced = ([], []) if index is None else index.get_teacher(
+            kuerzel)
 
-        replacements: Dict[str,
-                           List[ReplacementType]] = plan.get_plan_for_all()
+        # wer sich selbst vertritt (z.B. Raumänderung), steht nur einmal drin
+        covered = {id(entry[1]) for entry in covering}
+        entries = covering + [
+            entry for entry in replaced if not id(entry[1]) in covered
+        ]
+        await _send_index_entries(context, entries,
+                                  f'Vertretungsplan für {kuerzel}')
 
-        if replacements is None or replacements == {}:
-            # No replacements
-            await context.send(embed=NO_REPLACEMENTS_EMBED)
-        else:
-            first: bool = True
-            for klasse, events in replacements.items():
-                date_str: str = plan.times.get(klasse)
-                for msg in create_vplan_message(events, klasse, img_db, date_str,
-                                                False):
-                    if first:
-                        msg['content'] = f"**Vertretungsplan der ganzen Schule für den {'heutigen Tag' if date_str is None else date_str.split(' ')[0]}:**\n\n" + msg[
-                            'content']
-                        await context.send(**msg)
-                        first = False
-                    else:
-                        await context.send(**msg)
+    @slash.subcommand(
+        base='vplan',
+        name='raum',
+        description='Zeigt alle Vertretungen in einem Raum!',
+        options=[{
+            'name': 'raum',
+            'description': 'Name des Raums',
+            'type': 3,
+            'required': True
+        }])
+    async def send_room_plan(context, raum: str):
+        await context.defer()
+
+        plan_id: int = page_db.get_server_default(context.guild)
+        plan = await run_blocking(plans.get, plan_id)
+        index: PlanIndex = await run_blocking(plan.get_index)
+        entries = [] if index is None else index.get_room(raum)
+        await _send_index_entries(context, entries,
+                                  f'Vertretungsplan für Raum {raum}')
 
     @slash.subcommand(
         base='vplan',
@@ -296,10 +791,228 @@ if __name__ == "__main__":
         'Schickt ALLE Vertretungen — Nervig & sollte vermieden werden!!!')
     async def send_plan_for_all(context):
         """Sends all replacements, quite annoying!"""
+        plan = plans.peek(page_db.get_server_default(context.guild))
+        cached = None if plan is None else plan.cached_plan_for_all()
+
+        if cached is None:
+            await context.defer()
+        await send_school_plan(context, plans, page_db, img_db, cached)
+
+
+
+    @slash.subcommand(
+        base='vplan',
+        name='stats',
+        description='Zeigt, wie oft es Vertretungen gab, z.B. Ausfälle je Klasse!',
+        options=[{
+            'name': 'gruppe',
+            'description': 'Wonach gezählt wird',
+            'type': 3,
+            'required': True,
+            'choices': [{
+                'name': name,
+                'value': name.lower()
+            } for name in ('Klasse', 'Lehrer', 'Wochentag', 'Stunde')]
+        }, {
+            'name': 'art',
+            'description': 'Optional: Nur diese Art von Vertretung zählen',
+            'type': 3,
+            'required': False,
+            'choices': [{
+                'name': name,
+                'value': name.lower()
+            } for name in ('Entfall', 'Vertretung', 'Raumänderung')]
+        }, {
+            'name': 'zeitraum',
+            'description': 'Optional: Zeitraum (Standard: dieser Monat)',
+            'type': 3,
+            'required': False,
+            'choices': [{
+                'name': name,
+                'value': value
+            } for name, value in (('Dieser Monat', 'monat'),
+                                  ('Letzter Monat', 'vormonat'),
+                                  ('Schuljahr', 'schuljahr'),
+                                  ('Alles', 'alles'))]
+        }])
+    async def send_stats(context,
+                         gruppe: str,
+                         art: str = None,
+                         zeitraum: str = 'monat'):
+        """Sends the Statistics of the archived Plans"""
         await context.defer()
-        await _send_plan_for_all(context)
 
+        plan_id: int = page_db.get_server_default(context.guild)
+        start, end = stats_period(zeitraum)
+        stats = await run_blocking(load_stats)
+        result = await run_blocking(stats.count, plan_id, gruppe, art, start,
+                                    end)
+
+        stats_embed = Embed(
+            title=f"**{'Vertretungen' if art is None else art.capitalize()} je {gruppe.capitalize()}**",
+            description='\n'.join(f'`{label}` {count}'
+                                   for label, count in result[:25])
+            or 'Für diesen Zeitraum gibt es noch keine archivierten Pläne!')
+        stats_embed.set_footer(**DEFAULT_FOOTER)
+        await context.send(embed=stats_embed)
+
+    @slash.subcommand(
+        base='vplan',
+        subcommand_group='debug',
+        name='profile',
+        description='Nur für den Besitzer: Profiliert den Bot für ein paar Sekunden',
+        options=[{
+            'name': 'seconds',
+            'description': 'Wie lange gemessen wird (max. 120)',
+            'type': 4,
+            'required': True
+        }])
+    async def send_profile(context, seconds: int):
+        """Samples the Stacks of all Threads and sends them as collapsed Stacks"""
+        from sampling_profiler import MAX_SECONDS, ProfilerBusyError, profile
+
+        if not await bot.is_owner(context.author):
+            await context.send('Das darf nur der Besitzer des Bots!', hidden=True)
+            return
+        await context.defer()
+
+        seconds = max(1, min(seconds, MAX_SECONDS))
+        try:
+            collapsed: str = await run_blocking(profile, seconds)
+        except ProfilerBusyError as error:
+            await context.send(str(error))
+            return
+        await context.send(
+            content=f'Profil über {seconds}s (Collapsed Stacks)',
+            file=File(io.BytesIO(collapsed.encode('utf-8')),
+                      filename=f'profile_{int(time.time())}.txt'))
+
+    @tasks.loop(minutes=10)
+    async def evict_plans():
+        '''Drops Plans from memory, that nobody asked for in a while'''
+        for plan_id in plans.evict_idle():
+            print(f'Plan {plan_id} evicted')
+
+    @tasks.loop(minutes=30)
+    async def archive_plans():
+        '''Without a separate fetcher.py, the Bot archives the Plans of all
+        Servers itself, the Statistics are computed from the Archive
+        Only the loaded Plans are archived, as the Queries left them: fetching
+        here would keep every Plan from going idle & poll all Schools'''
+        from plan_archive import archive_plan
+
+        archive = await run_blocking(load_archive)
+        for plan_id in set(page_db.server_mapper.values()):
+            plan = plans.peek(plan_id)
+            if plan is None:
+                continue
+            try:
+                archived = await run_blocking(archive_plan, archive, plan_id, plan)
+            except Exception as error:
+                print(f'Plan {plan_id} could not be archived:', repr(error))
+                continue
+            if archived:
+                print(f'Plan {plan_id}: archived {len(archived)} Versions')
+
+    @tasks.loop(minutes=5)
+    async def prefetch_classes():
+        '''Keeps the Pages of the most popular Classes fresh during the Morning,
+        so their Queries only wait for the Overview Page'''
+        # the Queries are counted in Memory & stored here in one Transaction
+        page_db.flush_queries()
 
+        ctime = datetime.now(TIMEZONE)
+        if ctime.weekday() >= 5 or not ctime.hour in PREFETCH_HOURS:
+            return
+
+        for plan_id in set(page_db.server_mapper.values()):
+            if not plan_id in plans:
+                continue
+            classes: List[str] = page_db.hot_classes(plan_id, PREFETCH_CLASSES)
+            if not classes:
+                continue
+            plan = await run_blocking(plans.get, plan_id)
+            # Snapshots of the Fetcher & DSBMobile Plans have nothing to prefetch
+            if hasattr(plan, 'prefetch'):
+                await run_blocking(plan.prefetch, classes)
+
+    # (plan_id, class) -> (new Stand, first seen), until it is sent
+    stand_changes: Dict[Tuple[int, str], Tuple[str, float]] = {}
+
+    @tasks.loop(minutes=2)
+    async def watch_subscriptions():
+        '''Sends the Plan of subscribed Classes, once their Stand changed
+        The Plan is rendered once for all Channels, that subscribed it'''
+        subscribers: Dict[Tuple[int, str], List[Tuple[int, int, str, Optional[str]]]] = {}
+        for subscription in page_db.get_subscriptions():
+            plan_id: int = page_db.server_mapper.get(subscription[0], 0)
+            subscribers.setdefault((plan_id, subscription[2].lower()),
+                                   []).append(subscription)
+
+        classes: Dict[int, List[str]] = {}
+        for plan_id, class_ in subscribers:
+            classes.setdefault(plan_id, []).append(class_)
+
+        for plan_id, plan_classes in classes.items():
+            if not plan_id in plans:
+                continue
+            try:
+                await notify_subscribers(plan_id, plan_classes, subscribers)
+            except Exception as error:
+                # one broken Plan mustn't stop the Loop
+                print(f'Subscriptions of Plan {plan_id} failed:', repr(error))
+
+    async def notify_subscribers(plan_id: int, plan_classes: List[str],
+                                 subscribers: Dict[Tuple[int, str], List[Tuple[int, int, str, Optional[str]]]]):
+        '''Sends the changed Plans of the Classes to their Subscribers'''
+        plan = await run_blocking(plans.get, plan_id)
+        # all Classes of the Plan with a single Request of the Page
+        results = await run_blocking(plan.get_plans_for_classes, plan_classes)
+
+        for class_, data in results.items():
+            key = (plan_id, class_)
+            # the Replacements are gone, that's a Change too
+            stand: Optional[str] = NO_REPLACEMENTS_STAND if data is None else \
+                preview_key(plan_id, data[0], data[1], plan.times)[1]
+            if stand is None:
+                # the Plan doesn't tell its Stand, nothing to compare
+                stand_changes.pop(key, None)
+                continue
+
+            outdated = []
+            for guild_id, channel_id, class_id, notified in subscribers[key]:
+                if notified is None:
+                    # new Subscriptions start with the current Stand
+                    page_db.set_notified(channel_id, class_id, stand)
+                elif notified != stand:
+                    outdated.append((guild_id, channel_id, class_id))
+            if not outdated:
+                stand_changes.pop(key, None)
+                continue
+
+            change = stand_changes.get(key)
+            if change is None or change[0] != stand:
+                stand_changes[key] = (stand, time.monotonic())
+                continue
+            if time.monotonic() - change[1] < SUBSCRIPTION_DEBOUNCE:
+                continue
+            del stand_changes[key]
+
+            recording = RecordingContext(*outdated[0][:2])
+            if data is None:
+                await recording.send(content=stale_notice(plan) or None,
+                                     embed=NO_REPLACEMENTS_EMBED)
+            else:
+                await send_class_plan(recording, plans, page_db, img_db,
+                                      class_, silent=True, cached=data)
+            for guild_id, channel_id, class_id in outdated:
+                delivered = await deliver(guild_id, channel_id, recording.replay)
+                if delivered:
+                    page_db.set_notified(channel_id, class_id, stand)
+                elif delivered is False:
+                    print('Channel of the Subscription is gone, deleting it:',
+                          channel_id)
+                    page_db.delete_subscription(channel_id, class_id)
 
     ctime = datetime.now(TIMEZONE)
 
@@ -317,28 +1030,85 @@ if __name__ == "__main__":
         events = page_db.events.get(cur_min)
         if events is None: return
 
-        for event in events:
-            if isinstance(event[0], int):  # deal with channel and guild id
-                try:
-                    channel: Messageable = bot.get_channel(event[1])
-                except AttributeError as error:
-                    print(error)
-                    print('nix gefunden warum bin ich dumm?', event)
-                    page_db.delete_event(event[0], event[1], cur_min, event[2])
-                    continue
-            else:
-                channel = event[0]
-            _class: str = event[2]
-            try:    
-                context = await bot.get_context(await channel.fetch_message(channel.last_message_id))
-            except:
-                continue
-            if not context.valid: continue
+        for guild_id, channel_id, _class in list(events):
+            if await deliver(guild_id, channel_id,
+                             partial(deliver_event, _class=_class)) is False:
+                print('Channel of the Event is gone, deleting it:', channel_id)
+                page_db.delete_event(guild_id, channel_id, cur_min, _class)
 
-            if _class is None:
-                await _send_plan_for_all(context)
-            else:
-                await _send_plan(context, _class, silent=True)
+    async def deliver(guild_id: int, channel_id: int, send) -> Optional[bool]:
+        '''Runs send(context) through the Webhook of the Channel, if it has one,
+        else as the Bot. Returns False, if the Channel is gone & None, if the
+        Delivery failed otherwise (it's logged, the Loops go on)'''
+        webhook = page_db.webhooks.get(channel_id)
+        if webhook is not None:
+            # Webhooks have their own Rate Limits, the Commands aren't slowed down
+            context = WebhookContext(
+                Webhook.partial(*webhook, adapter=webhook_adapter()),
+                guild_id, channel_id)
+            try:
+                await send(context)
+                return True
+            except NotFound as error:
+                if context.sent:
+                    # the Webhook exists, sending as the Bot would repeat
+                    # the Messages, that were sent already
+                    print(f'Delivery to Channel {channel_id} failed:', repr(error))
+                    return None
+                print('Webhook of the Channel is gone, sending as the Bot:',
+                      channel_id)
+                page_db.delete_webhook(channel_id)
+                # the Bot can't edit the Messages of the Webhook
+                page_db.clear_posted(channel_id)
+            except Exception as error:
+                print(f'Delivery to Channel {channel_id} failed:', repr(error))
+                return None
+
+        # only the IDs are needed, no Message has to be cached or fetched
+        try:
+            await send(ChannelContext(bot.http, guild_id, channel_id))
+        except NotFound:
+            return False
+        except Exception as error:
+            print(f'Delivery to Channel {channel_id} failed:', repr(error))
+            return None
+        return True
+
+    async def deliver_event(context, _class: Optional[str]):
+        '''Sends the Plan of the Event (the whole School without a Class)
+        or edits the Messages of its last Post, if the Event was added so'''
+        posted = page_db.get_posted(context.channel.id, _class)
+        data = None
+        if _class is not None:
+            plan: Page = await run_blocking(
+                plans.get, page_db.get_server_default(context.guild))
+            data = await run_blocking(plan.get_plan_for_class, _class)
+        if posted is not None:
+            # rendered Images are compared by the Plan, not by their Link
+            context = EditingContext(context, posted,
+                                     pack=isinstance(context, WebhookContext),
+                                     source=None if data is None else plan_digest(data))
+
+        if _class is None:
+            await send_school_plan(context, plans, page_db, img_db)
+        elif data is not None:
+            # Events stay silent without Replacements, nothing to fetch again
+            await send_class_plan(context, plans, page_db, img_db, _class,
+                                  silent=True, cached=data, plan=plan)
+        await context.flush()
+
+        if posted is not None:
+            page_db.set_posted(context.channel.id, _class, context.posted)
+
+    webhook_session = None
+
+    def webhook_adapter() -> AsyncWebhookAdapter:
+        '''The Webhooks share one Session, it's opened on the first Delivery'''
+        global webhook_session
+        if webhook_session is None:
+            import aiohttp
+            webhook_session = aiohttp.ClientSession()
+        return AsyncWebhookAdapter(webhook_session)
 
 
 
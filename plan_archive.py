@@ -0,0 +1,361 @@
+'''Append-only Archiv aller unterschiedlichen Planstände jeder Schule
+Die Vertretungen werden spaltenweise gespeichert: jede Spalte ist eine Datei
+mit uint32-Codes (direkt mit numpy.fromfile lesbar), die Texte stehen einmalig
+im Wörterbuch der Spalte. Eine Zeile je Vertretung & Klasse.
+
+Nachträglich aufgenommene Seiten werden parallel eingelesen:
+    python plan_archive.py ingest <plan_id> <Verzeichnis/Datei ...> [--workers N]
+Untis: je Stand ein Verzeichnis mit der Übersicht & den Seiten der Klassen
+DSBMobile: die gespeicherten Vertretungsseiten (subst_*.htm)'''
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime
+from typing import Final, Iterable, Mapping, Optional, Tuple, List, Dict
+
+from database_migrations import Migration, migrate
+
+
+ARCHIVE_DIR: Final[str] = os.environ.get('ARCHIVE_DIR', 'archive')
+# Sekunden, nach denen auch ungenutzte Pläne wieder archiviert werden
+ARCHIVE_INTERVAL: Final[float] = float(os.environ.get('ARCHIVE_INTERVAL', 30 * 60))
+
+# Spalten mit Texten, None wird als Code 0 gespeichert
+TEXT_COLUMNS: Final[Tuple[str, ...]] = (
+    'class', 'lesson', 'teacher', 'subject', 'replacing_teacher', 'room',
+    'info_text', 'type_of_replacement', 'type', 'new_subject', 'new_teacher')
+# Version, Tag (date.toordinal()) & Zeile der Vertretung innerhalb der Version
+NUMBER_COLUMNS: Final[Tuple[str, ...]] = ('version', 'day', 'row')
+COLUMNS: Final[Tuple[str, ...]] = NUMBER_COLUMNS + TEXT_COLUMNS
+
+MIGRATIONS: Final[List[Migration]] = [
+    ('CREATE TABLE IF NOT EXISTS versions (id INTEGER PRIMARY KEY, plan_id INT NOT NULL, day TEXT NOT NULL, stand TEXT, digest TEXT NOT NULL, archived REAL NOT NULL, first_row INT NOT NULL, rows INT NOT NULL)',
+     'CREATE UNIQUE INDEX IF NOT EXISTS versions_digest ON versions (plan_id, day, digest)')
+]
+
+# ein Tag eines Plans: Klasse -> Vertretungen
+Classes = Mapping[Optional[str], List[Mapping]]
+
+
+def plan_digest(classes: Classes) -> str:
+    '''Prüfsumme über den Inhalt eines Tages, unabhängig vom Stand'''
+    rows = sorted((str(class_), [sorted((key, str(value))
+                                        for key, value in event.items()
+                                        if not key in ('updated', 'classes'))
+                                 for event in events])
+                  for class_, events in classes.items())
+    return hashlib.sha1(json.dumps(rows).encode('utf-8')).hexdigest()
+
+
+class ColumnDictionary:
+    '''Das Wörterbuch einer Textspalte, neue Texte werden nur angehängt'''
+
+    def __init__(self, path: str):
+        self.path = path
+        self.values: List[Optional[str]] = [None]
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as file:
+                self.values.extend(json.loads(line) for line in file)
+        self.codes: Dict[str, int] = {
+            value: code for code, value in enumerate(self.values) if code
+        }
+        self.new: List[str] = []
+
+    def encode(self, value: Optional[str]) -> int:
+        if value is None:
+            return 0
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+            self.new.append(value)
+        return code
+
+    def flush(self) -> None:
+        if self.new:
+            with open(self.path, 'a', encoding='utf-8') as file:
+                file.writelines(json.dumps(value, ensure_ascii=False) + '\n'
+                                for value in self.new)
+            self.new = []
+
+
+class PlanArchive:
+    '''Speichert jeden unterschiedlichen Stand eines Tages genau einmal
+    Es gibt nur einen schreibenden Prozess (Fetcher, Bot ohne Fetcher oder Ingest), die Spalten
+    werden vor dem Eintrag der Version geschrieben & beim Öffnen auf die
+    eingetragenen Zeilen gekürzt, ein Abbruch hinterlässt also nichts Halbes'''
+
+    def __init__(self, directory: str = ARCHIVE_DIR):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        # der Bot liest das Archiv aus den Threads des Executors
+        self.database = sqlite3.connect(os.path.join(directory, 'archive.db'),
+                                        check_same_thread=False)
+        migrate(self.database, MIGRATIONS)
+
+        self.dictionaries: Dict[Tuple[int, str], ColumnDictionary] = {}
+        # der Bot archiviert aus den Threads des Executors
+        self.lock = threading.Lock()
+
+    def plan_directory(self, plan_id: int) -> str:
+        return os.path.join(self.directory, str(plan_id))
+
+    def column_path(self, plan_id: int, column: str) -> str:
+        return os.path.join(self.plan_directory(plan_id), f'{column}.u32')
+
+    def row_count(self, plan_id: int) -> int:
+        '''Anzahl der Zeilen aller eingetragenen Versionen des Plans'''
+        row = self.database.execute(
+            'SELECT MAX(first_row + rows) FROM versions WHERE plan_id = ?',
+            (plan_id, )).fetchone()
+        return row[0] or 0
+
+    def dictionary_path(self, plan_id: int, column: str) -> str:
+        return os.path.join(self.plan_directory(plan_id), f'{column}.dict')
+
+    def dictionary(self, plan_id: int, column: str) -> ColumnDictionary:
+        if not (plan_id, column) in self.dictionaries:
+            self.dictionaries[plan_id, column] = ColumnDictionary(
+                self.dictionary_path(plan_id, column))
+        return self.dictionaries[plan_id, column]
+
+    def open_columns(self, plan_id: int) -> int:
+        '''Legt die Spalten an & kürzt sie auf die eingetragenen Zeilen'''
+        os.makedirs(self.plan_directory(plan_id), exist_ok=True)
+        rows = self.row_count(plan_id)
+        for column in COLUMNS:
+            path = self.column_path(plan_id, column)
+            with open(path, 'ab') as file:
+                if file.tell() != rows * 4:
+                    file.truncate(rows * 4)
+        return rows
+
+    def has_version(self, plan_id: int, day: date, digest: str) -> bool:
+        return self.database.execute(
+            'SELECT 1 FROM versions WHERE plan_id = ? AND day = ? AND digest = ?',
+            (plan_id, day.isoformat(), digest)).fetchone() is not None
+
+    def append(self, plan_id: int, day: date, stand: Optional[str],
+               classes: Classes, archived: float = None) -> Optional[int]:
+        '''Hängt den Stand eines Tages an, wenn es ihn so noch nicht gibt
+        Gibt die ID der neuen Version zurück'''
+        digest = plan_digest(classes)
+        if self.has_version(plan_id, day, digest):
+            return None
+
+        first_row = self.open_columns(plan_id)
+        version = (self.database.execute('SELECT MAX(id) FROM versions').fetchone()[0] or 0) + 1
+
+        data: Dict[str, array] = {column: array('I') for column in COLUMNS}
+        # Zeilen für mehrere Klassen bekommen für alle dieselbe Nummer
+        rows: Dict[int, int] = {}
+        for class_, events in classes.items():
+            for event in events:
+                row = rows.setdefault(id(event), len(rows))
+                data['version'].append(version)
+                data['day'].append(day.toordinal())
+                data['row'].append(row)
+                data['class'].append(self.dictionary(plan_id, 'class').encode(class_))
+                for column in TEXT_COLUMNS[1:]:
+                    data[column].append(
+                        self.dictionary(plan_id, column).encode(event.get(column)))
+
+        for column, values in data.items():
+            with open(self.column_path(plan_id, column), 'ab') as file:
+                values.tofile(file)
+        for column in TEXT_COLUMNS:
+            self.dictionary(plan_id, column).flush()
+
+        with self.database:
+            self.database.execute(
+                'INSERT INTO versions (id, plan_id, day, stand, digest, archived, first_row, rows) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (version, plan_id, day.isoformat(), stand, digest,
+                 time.time() if archived is None else archived, first_row,
+                 len(data['version'])))
+
+        return version
+
+    def append_days(self, plan_id: int, days: Mapping[date, Classes],
+                    stands: Mapping[date, str]) -> List[int]:
+        '''Archiviert alle Tage eines Plans, gibt die neuen Versionen zurück'''
+        versions = []
+        with self.lock:
+            for day, classes in sorted(days.items()):
+                version = self.append(plan_id, day, stands.get(day), classes)
+                if version is not None:
+                    versions.append(version)
+        return versions
+
+    def versions(self, plan_id: int) -> List[Tuple[int, str, Optional[str], int]]:
+        '''Gibt ID, Tag, Stand & Zeilenanzahl aller Versionen des Plans zurück'''
+        return self.database.execute(
+            'SELECT id, day, stand, rows FROM versions WHERE plan_id = ? ORDER BY id',
+            (plan_id, )).fetchall()
+
+    def latest_versions(self, plan_id: int) -> List[int]:
+        '''Gibt die jeweils letzte Version jedes Tages zurück'''
+        return [row[0] for row in self.database.execute(
+            'SELECT MAX(id) FROM versions WHERE plan_id = ? GROUP BY day',
+            (plan_id, ))]
+
+    def __del__(self):
+        self.database.close()
+
+
+def day_stands(plan) -> Dict[date, str]:
+    '''Der Stand jedes Tages eines Page, bei Untis (ein Tag) der neueste Stand der Klassen'''
+    if plan.day_times:
+        return plan.day_times
+
+    stand = max(plan.times.values(),
+                key=lambda stand: parse_stand(stand) or datetime.min,
+                default=None)
+    return {day: stand for day in plan.days}
+
+
+def archive_plan(archive: PlanArchive, plan_id: int, plan) -> List[int]:
+    '''Archiviert alle Tage eines Plans (Page) mit dem Stand, den er gerade
+    geladen hat, ohne ihn abzufragen. Veraltete Stände werden übersprungen,
+    gibt die neuen Versionen zurück'''
+    if plan.stale_since is not None:
+        return []
+    return archive.append_days(plan_id, plan.get_all_days(), day_stands(plan))
+
+
+def parse_stand(stand: Optional[str]) -> Optional[datetime]:
+    '''Liest das Datum aus einem Stand wie "19.10.2026 07:45"'''
+    for text, pattern in ((stand, '%d.%m.%Y %H:%M'), ((stand or '')[:10], '%d.%m.%Y')):
+        try:
+            return datetime.strptime((text or '').strip(), pattern)
+        except ValueError:
+            continue
+    return None
+
+
+def parse_untis_snapshot(directory: str, index_name: str, mapper: tuple) -> List[Tuple[date, str, dict]]:
+    '''Liest einen gespeicherten Untis Stand (Übersicht & Klassen) ein, läuft im Prozesspool
+    Untis zeigt nur einen Tag, das Datum kommt aus dem neuesten Stand der Klassen'''
+    from lxml import html
+    from timetable_parser import parse_untis_rows, untis_class_links, untis_stand
+
+    links = untis_class_links(html.parse(os.path.join(directory, index_name)))
+    if links is None:
+        return []
+
+    classes, stands = {}, []
+    for class_, link in links.items():
+        path = os.path.join(directory, link.rsplit('/', 1)[-1])
+        if not os.path.isfile(path):
+            continue
+        page = html.parse(path)
+        stands.append(untis_stand(page))
+        classes[class_] = [event.to_dict() for event in parse_untis_rows(page, mapper)]
+
+    stand = max(stands, key=lambda stand: parse_stand(stand) or datetime.min, default=None)
+    parsed = parse_stand(stand)
+    day = parsed.date() if parsed is not None else date.fromtimestamp(
+        os.path.getmtime(os.path.join(directory, index_name)))
+    return [(day, stand, classes)]
+
+
+def parse_dsb_file(path: str, page_struct: dict) -> List[Tuple[date, str, dict]]:
+    '''Liest eine gespeicherte DSBMobile Vertretungsseite ein, läuft im Prozesspool'''
+    from dsbapi import DSBApi
+    from timetable_parser import DEFAULT_MAPPER, group_by_class, parse_dsb_date, parse_type_from_info
+
+    mapper = page_struct.get('mapper', DEFAULT_MAPPER)
+    api = DSBApi('', '', tablemapper=mapper,
+                 inline_header=page_struct.get('inline_header', False))
+    with open(path, encoding='utf-8', errors='replace') as file:
+        days = api.parse_days(file.read())
+
+    results = []
+    for handle in days:
+        plan = handle.entries
+        if not 'type_of_replacement' in mapper:
+            plan = parse_type_from_info(plan, page_struct.get('event_cases', {}))
+        # dicts lassen sich billiger zurück an den Hauptprozess schicken,
+        # die Zeilen mehrerer Klassen bleiben dabei dieselben Objekte
+        rows = {id(event): event.to_dict() for event in plan}
+        results.append((parse_dsb_date(handle.date), handle.updated, {
+            class_: [rows[id(event)] for event in events]
+            for class_, events in group_by_class(plan).items()
+        }))
+
+    return results
+
+
+def parse_snapshot(path: str, page_struct: dict, index_name: str) -> List[Tuple[date, str, dict]]:
+    '''Liest einen gespeicherten Stand mit dem Parser des Seitentyps ein'''
+    if page_struct['type'] == 0:
+        from timetable_parser import DEFAULT_MAPPER
+
+        # wie Page, Pläne aus der Datenbank haben keinen eigenen Mapper
+        return parse_untis_snapshot(path, index_name,
+                                    page_struct.get('mapper', DEFAULT_MAPPER))
+    return parse_dsb_file(path, page_struct)
+
+
+def snapshot_paths(paths: Iterable[str], directories: bool) -> Iterable[str]:
+    '''Untis Stände sind Verzeichnisse, DSBMobile Stände einzelne Dateien,
+    die Verzeichnisse werden dann durchsucht'''
+    for path in paths:
+        if directories or not os.path.isdir(path):
+            yield path
+            continue
+
+        for root, _, files in os.walk(path):
+            for name in files:
+                if name.endswith('.htm'):
+                    yield os.path.join(root, name)
+
+
+def ingest(archive: PlanArchive, plan_id: int, page_struct: dict,
+           paths: Iterable[str], index_name: str = None,
+           workers: int = None) -> int:
+    '''Liest die gespeicherten Seiten parallel ein & archiviert sie in zeitlicher Reihenfolge
+    Gibt die Anzahl der neuen Versionen zurück'''
+    paths = sorted(snapshot_paths(paths, page_struct['type'] == 0))
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        snapshots = [snapshot for result in pool.map(
+            parse_snapshot, paths, [page_struct] * len(paths),
+            [index_name] * len(paths), chunksize=8) for snapshot in result]
+
+    snapshots.sort(key=lambda snapshot: (snapshot[0], parse_stand(snapshot[1]) or datetime.min))
+
+    added = 0
+    for day, stand, classes in snapshots:
+        if archive.append(plan_id, day, stand, classes) is not None:
+            added += 1
+    return added
+
+
+if __name__ == '__main__':
+    from plan_registry import PlanRegistry
+    from server_database import PageDatabase
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--archive', default=ARCHIVE_DIR)
+    commands = parser.add_subparsers(dest='mode', required=True)
+
+    ingest_parser = commands.add_parser('ingest', help='gespeicherte Seiten einlesen')
+    ingest_parser.add_argument('plan_id', type=int)
+    ingest_parser.add_argument('paths', nargs='+')
+    ingest_parser.add_argument('--index', default=None,
+                               help='Dateiname der Untis Übersicht (Standard: aus der URL)')
+    ingest_parser.add_argument('--workers', type=int, default=None)
+    arguments = parser.parse_args()
+
+    url, struct = PlanRegistry(PageDatabase(), lambda url, page_struct: None).pages[arguments.plan_id]
+    started = time.perf_counter()
+    count = ingest(PlanArchive(arguments.archive), arguments.plan_id, struct,
+                   arguments.paths, arguments.index or url.rsplit('/', 1)[-1],
+                   arguments.workers)
+    print(f'{count} neue Versionen in {time.perf_counter() - started:.1f}s archiviert')
@@ -0,0 +1,140 @@
+'''Invertierte Indizes für Abfragen nach Lehrer & Raum'''
+from typing import Final, Iterable, Optional, List, Dict, Tuple
+from replacement_types import ReplacementType
+
+
+# (Klassen, Vertretung)
+IndexEntry = Tuple[str, ReplacementType]
+
+TEACHER_FIELDS: Final = ('teacher', )
+REPLACING_TEACHER_FIELDS: Final = ('replacing_teacher', 'new_teacher')
+ROOM_FIELDS: Final = ('room', )
+
+
+def normalize(key: str) -> str:
+    '''Schlüssel für die Indizes, unabhängig von Groß-/Kleinschreibung'''
+    return key.strip().casefold()
+
+
+class PlanIndex:
+    '''Indiziert die Vertretungen eines Tages nach (Vertretungs-)Lehrer & Raum
+    Wird einmal pro neuem Stand gebaut, Abfragen sind dann Dict-Lookups'''
+
+    def __init__(self, classes: Dict[str, List[ReplacementType]]):
+        self.by_teacher: Dict[str, List[IndexEntry]] = {}
+        self.by_replacing_teacher: Dict[str, List[IndexEntry]] = {}
+        self.by_room: Dict[str, List[IndexEntry]] = {}
+
+        seen = set()
+        for class_, events in classes.items():
+            for event in events:
+                # Zeilen für mehrere Klassen nur einmal aufnehmen
+                if id(event) in seen:
+                    continue
+                seen.add(id(event))
+
+                label = ', '.join(
+                    item for item in event.get('classes', ()) if item
+                ) or class_ or '?'
+                entry = (label, event)
+
+                self._add(self.by_teacher, event, TEACHER_FIELDS, entry)
+                self._add(self.by_replacing_teacher, event,
+                          REPLACING_TEACHER_FIELDS, entry)
+                self._add(self.by_room, event, ROOM_FIELDS, entry)
+
+        for index in (self.by_teacher, self.by_replacing_teacher,
+                      self.by_room):
+            for entries in index.values():
+                entries.sort(key=lambda entry: entry[1].get('lesson', ''))
+
+    @staticmethod
+    def _add(index: Dict[str, List[IndexEntry]], event: ReplacementType,
+             fields: Iterable[str], entry: IndexEntry):
+        keys = set()
+        for field in fields:
+            value = event.get(field)
+            if value is not None:
+                # mehrere Lehrer/Räume stehen mit Komma in einer Zelle
+                keys.update(normalize(item) for item in value.split(',')
+                            if item.strip())
+
+        for key in keys:
+            if key in index:
+                index[key].append(entry)
+            else:
+                index[key] = [entry]
+
+    def get_teacher(self, teacher: str) -> Tuple[List[IndexEntry], List[IndexEntry]]:
+        '''Gibt zurück, was der Lehrer vertritt & wo er vertreten wird'''
+        key = normalize(teacher)
+        return self.by_replacing_teacher.get(key, []), self.by_teacher.get(key, [])
+
+    def get_room(self, room: str) -> List[IndexEntry]:
+        '''Gibt alle Vertretungen in dem Raum zurück'''
+        return self.by_room.get(normalize(room), [])
+
+
+def class_sort_key(name: str) -> Tuple[bool, int, str]:
+    '''Sortiert Klassen nach Stufe & Zusatz ("5a" < "10b" < "Q1")'''
+    i = 0
+    while i < len(name) and name[i].isnumeric():
+        i += 1
+    return not i, (int(name[:i]) if i else 0), name[i:].casefold()
+
+
+def lookup_classes(plan: Dict[str, List[ReplacementType]], classes: List[str]) -> Dict[str, Optional[Tuple[str, List[ReplacementType]]]]:
+    '''Sucht die Klassen im Plan, Groß-/Kleinschreibung egal'''
+    key_dict = {item.lower(): item for item in plan if item is not None}
+    result = {}
+    for class_ in classes:
+        key = key_dict.get(class_.lower())
+        result[class_] = None if key is None else (key, plan[key])
+    return result
+
+
+class TrieNode:
+    '''Knoten im ClassTrie, kennt die besten Vervollständigungen darunter'''
+    __slots__ = ('children', 'completions')
+
+    def __init__(self):
+        self.children: Dict[str, 'TrieNode'] = {}
+        self.completions: List[str] = []
+
+
+class ClassTrie:
+    '''Präfixbaum über die Klassennamen eines Plans für die Autovervollständigung
+    Die Vervollständigungen werden beim Bauen vorsortiert, Klassen mit
+    aktuellen Vertretungen zuerst, eine Abfrage folgt nur dem Präfix'''
+
+    MAX_RESULTS: Final[int] = 25  # mehr Vorschläge erlaubt Discord nicht
+
+    def __init__(self, classes: Iterable[str], active: Iterable[str] = ()):
+        active = set(active)
+        ranked = sorted({item for item in classes if item},
+                        key=lambda item: (not item in active,
+                                          class_sort_key(item)))
+
+        self.root = TrieNode()
+        for name in ranked:
+            node = self.root
+            self._add_completion(node, name)
+            for char in name.casefold():
+                if not char in node.children:
+                    node.children[char] = TrieNode()
+                node = node.children[char]
+                self._add_completion(node, name)
+
+    def _add_completion(self, node: TrieNode, name: str):
+        if len(node.completions) < self.MAX_RESULTS:
+            node.completions.append(name)
+
+    def complete(self, prefix: str) -> List[str]:
+        '''Gibt die besten Klassen zurück, die mit dem Präfix beginnen'''
+        node = self.root
+        for char in prefix.strip().casefold():
+            node = node.children.get(char)
+            if node is None:
+                return []
+
+        return node.completions
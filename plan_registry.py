@@ -0,0 +1,158 @@
+'''Verwaltet alle bekannten Pläne & hält nur die aktiv genutzten im Speicher'''
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Callable, Final, Optional, Tuple, List, Dict
+from config import load_pages
+
+if TYPE_CHECKING:
+    from server_database import PageDatabase
+
+
+# Sekunden ohne Abfrage, nach denen ein Plan aus dem Speicher fliegt
+PLAN_IDLE_TIMEOUT: Final[float] = float(
+    os.environ.get('PLAN_IDLE_TIMEOUT', 6 * 60 * 60))
+# Höchstzahl gleichzeitig geladener Pläne
+MAX_ACTIVE_PLANS: Final[int] = int(os.environ.get('MAX_ACTIVE_PLANS', 64))
+
+# erzeugt das Plan-Objekt aus URL & Struktur (Page oder SnapshotPage)
+PlanFactory = Callable[[str, dict], object]
+
+
+class PlanRegistry:
+    '''Kennt alle Pläne aus der pages.json & der Datenbank
+    Pläne werden erst bei der ersten Abfrage erzeugt & wieder verworfen,
+    wenn sie länger nicht abgefragt wurden
+    get läuft in den Threads von run_blocking, alles andere in der Event Loop,
+    daher schützt eine Sperre die Verzeichnisse'''
+
+    def __init__(self,
+                 page_db: 'PageDatabase',
+                 factory: PlanFactory,
+                 idle_timeout: float = PLAN_IDLE_TIMEOUT,
+                 max_active: int = MAX_ACTIVE_PLANS):
+        self.page_db = page_db
+        self.factory = factory
+        self.idle_timeout = idle_timeout
+        self.max_active = max_active
+
+        self.pages: Dict[int, Tuple[str, dict]] = {}
+        # zuletzt genutzte Pläne stehen hinten
+        self.active: 'OrderedDict[int, object]' = OrderedDict()
+        self.last_used: Dict[int, float] = {}
+        # je Plan, der gerade erzeugt wird, eine Sperre (nur ein Aufbau je Plan)
+        self.building: Dict[int, threading.Lock] = {}
+        self.lock = threading.Lock()
+
+        self.reload()
+
+    def reload(self) -> None:
+        '''Liest die registrierten Pläne neu ein, geladene Pläne bleiben'''
+        pages = {}
+        for registered in (load_pages()['keys'], self.page_db.get_pages()):
+            for url, page in registered.items():
+                pages[page['id']] = (url, page)
+        with self.lock:
+            self.pages.update(pages)
+
+    def __contains__(self, plan_id: int) -> bool:
+        with self.lock:
+            return plan_id in self.pages
+
+    def name(self, plan_id: int) -> Optional[str]:
+        '''Gibt den Namen des Plans zurück'''
+        with self.lock:
+            page = self.pages.get(plan_id)
+        return None if page is None else page[1]['name']
+
+    def search(self, text: str, limit: int = 25) -> List[Tuple[int, str]]:
+        '''Gibt die IDs & Namen der Pläne zurück, deren Name den Text enthält'''
+        text = text.casefold()
+        with self.lock:
+            found = sorted((page['name'], plan_id) for plan_id, (_, page) in self.pages.items()
+                           if text in page['name'].casefold())
+        return [(plan_id, name) for name, plan_id in found[:limit]]
+
+    def get(self, plan_id: int):
+        '''Gibt den Plan zurück & erzeugt ihn, falls er nicht geladen ist
+        Fragen mehrere Threads gleichzeitig nach einem neuen Plan, wird er
+        nur einmal erzeugt, die anderen warten auf ihn'''
+        with self.lock:
+            url, page_struct = self.pages[plan_id]
+            self.last_used[plan_id] = time.monotonic()
+            plan = self.loaded(plan_id)
+            if plan is not None:
+                return plan
+            building = self.building.setdefault(plan_id, threading.Lock())
+
+        with building:
+            with self.lock:
+                plan = self.loaded(plan_id)
+                if plan is not None:
+                    return plan
+
+            try:
+                # das Erzeugen fragt die Seite ab, also ohne die Sperre
+                plan = self.factory(url, page_struct)
+            finally:
+                with self.lock:
+                    self.building.pop(plan_id, None)
+
+            with self.lock:
+                self.active[plan_id] = plan
+                self.last_used[plan_id] = time.monotonic()
+                # die am längsten ungenutzten Pläne verwerfen
+                while len(self.active) > self.max_active:
+                    self.discard(next(iter(self.active)))
+
+        return plan
+
+    def loaded(self, plan_id: int):
+        '''Der geladene Plan, zuletzt genutzt (nur mit der Sperre aufrufen)'''
+        plan = self.active.get(plan_id)
+        if plan is not None:
+            self.active.move_to_end(plan_id)
+        return plan
+
+    def peek(self, plan_id: int):
+        '''Gibt den Plan nur zurück, wenn er schon geladen ist (ohne Abfrage)'''
+        with self.lock:
+            return self.active.get(plan_id)
+
+    def register(self,
+                 plan_name: str,
+                 plan_type: int,
+                 link: Optional[str] = None,
+                 username: Optional[str] = None,
+                 password: Optional[str] = None) -> int:
+        '''Fügt einen neuen Plan hinzu & gibt seine ID zurück
+        Die ID vergibt die Datenbank, so bekommen gleichzeitig hinzugefügte
+        Pläne anderer Shards nie dieselbe'''
+        min_id = max(page['id'] for page in load_pages()['keys'].values()) + 1
+        plan_id = self.page_db.add_page(min_id, plan_name, plan_type, link,
+                                        username, password)
+        self.reload()
+
+        return plan_id
+
+    def evict(self, plan_id: int) -> None:
+        '''Verwirft den geladenen Plan, er bleibt aber registriert'''
+        with self.lock:
+            self.discard(plan_id)
+
+    def discard(self, plan_id: int) -> None:
+        '''Wie evict, nur mit der Sperre aufrufen'''
+        self.active.pop(plan_id, None)
+        self.last_used.pop(plan_id, None)
+
+    def evict_idle(self) -> List[int]:
+        '''Verwirft alle Pläne, die länger als idle_timeout ungenutzt sind'''
+        deadline = time.monotonic() - self.idle_timeout
+        with self.lock:
+            idle = [plan_id for plan_id in self.active
+                    if self.last_used.get(plan_id, 0.0) < deadline]
+            for plan_id in idle:
+                self.discard(plan_id)
+
+        return idle
@@ -0,0 +1,145 @@
+'''Zeichnet den ganzen Plan einer Klasse als eine Tabelle (PNG)
+Gezeichnet wird in einem Prozesspool, damit die Event Loop nicht blockiert.
+Hochgeladene Bilder werden über ihre CDN-URL wiederverwendet (siehe ImageDatabase.plans)'''
+from __future__ import annotations
+
+import asyncio
+import io
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import TYPE_CHECKING, Final, Optional, Sequence, Tuple, List
+
+# die Prozesse des Pools brauchen weder discord noch die Parser
+if TYPE_CHECKING:
+    from replacement_types import ReplacementType
+
+
+# Prozesse, die gleichzeitig Pläne zeichnen
+RENDER_WORKERS: Final[int] = int(os.environ.get('RENDER_WORKERS', 2))
+
+FONT: Final[str] = 'fonts/arialrounded.ttf'
+FONT_SIZE: Final[int] = 22
+PADDING: Final[int] = 16
+LINE_HEIGHT: Final[int] = int(FONT_SIZE * 1.5)
+# längere Zellen (meist der Infotext) werden umgebrochen
+MAX_COLUMN_WIDTH: Final[int] = 360
+COLOR_BAR: Final[int] = 6
+
+# Farben des dunklen Discord-Themes
+BACKGROUND: Final = (54, 57, 63)
+HEADER_BACKGROUND: Final = (47, 49, 54)
+TEXT: Final = (220, 221, 222)
+MUTED: Final = (142, 146, 151)
+
+# (Feld, Spaltenüberschrift)
+COLUMNS: Final[Tuple[Tuple[str, str], ...]] = (
+    ('lesson', 'Stunde'), ('subject', 'Fach'), ('teacher', 'Lehrkraft'),
+    ('replacing_teacher', 'Vertretung'), ('room', 'Raum'),
+    ('type_of_replacement', 'Art'), ('info_text', 'Info'))
+
+# eine Zeile der Tabelle: Farbe der Vertretungsart & Zellen
+Row = Tuple[int, Tuple[str, ...]]
+
+_pool: Optional[ProcessPoolExecutor] = None
+
+
+def plan_rows(replacements: Sequence[ReplacementType], colors: Sequence[int]) -> List[Row]:
+    '''Wandelt die Vertretungen in einfache Tupel um, die billig an den Pool gehen'''
+    return [(color, tuple(replacement.get(field) or '' for field, _ in COLUMNS))
+            for replacement, color in zip(replacements, colors)]
+
+
+def wrap(text: str, font, width: int) -> List[str]:
+    '''Bricht den Text an Leerzeichen um, sodass jede Zeile in width passt'''
+    lines: List[str] = []
+    line = ''
+    for word in text.split(' '):
+        candidate = word if not line else f'{line} {word}'
+        if line and font.getlength(candidate) > width:
+            lines.append(line)
+            line = word
+        else:
+            line = candidate
+    lines.append(line)
+    return lines
+
+
+def render_plan(heading: str, subheading: str, rows: List[Row]) -> bytes:
+    '''Zeichnet die Tabelle & gibt das PNG zurück, läuft im Prozesspool'''
+    from PIL import Image, ImageDraw, ImageFont
+
+    font = ImageFont.truetype(FONT, FONT_SIZE)
+    bold = ImageFont.truetype(FONT, int(FONT_SIZE * 1.3))
+
+    header = tuple(title for _, title in COLUMNS)
+    cells = [[wrap(cell, font, MAX_COLUMN_WIDTH) for cell in row]
+             for _, row in rows]
+
+    widths = [
+        int(min(MAX_COLUMN_WIDTH, max(
+            [font.getlength(header[i])] +
+            [font.getlength(line) for row in cells for line in row[i]])))
+        for i in range(len(COLUMNS))
+    ]
+    heights = [LINE_HEIGHT * max(len(cell) for cell in row) for row in cells]
+
+    width = COLOR_BAR + sum(widths) + PADDING * (len(widths) + 1)
+    width = max(width, int(bold.getlength(heading)) + 2 * PADDING)
+    title_height = 2 * PADDING + int(FONT_SIZE * 1.3) + LINE_HEIGHT
+    height = title_height + LINE_HEIGHT + PADDING + sum(
+        heights) + PADDING * (len(rows) + 1)
+
+    img = Image.new('RGB', (width, height), BACKGROUND)
+    draw = ImageDraw.Draw(img)
+
+    draw.text((PADDING, PADDING), heading, font=bold, fill=TEXT)
+    draw.text((PADDING, PADDING + int(FONT_SIZE * 1.5)), subheading,
+              font=font, fill=MUTED)
+
+    y = title_height
+    draw.rectangle((0, y, width, y + LINE_HEIGHT + PADDING),
+                   fill=HEADER_BACKGROUND)
+    x = COLOR_BAR + PADDING
+    for title, column_width in zip(header, widths):
+        draw.text((x, y + PADDING // 2), title, font=font, fill=MUTED)
+        x += column_width + PADDING
+    y += LINE_HEIGHT + 2 * PADDING
+
+    for (color, _), row, row_height in zip(rows, cells, heights):
+        draw.rectangle((0, y - PADDING // 2, COLOR_BAR, y + row_height - PADDING // 2),
+                       fill=((color >> 16) & 0xff, (color >> 8) & 0xff, color & 0xff))
+        x = COLOR_BAR + PADDING
+        for lines, column_width in zip(row, widths):
+            for i, line in enumerate(lines):
+                draw.text((x, y + i * LINE_HEIGHT), line, font=font, fill=TEXT)
+            x += column_width + PADDING
+        y += row_height + PADDING
+
+    buf = io.BytesIO()
+    img.save(buf, format='PNG', optimize=True)
+    return buf.getvalue()
+
+
+def render_pool() -> ProcessPoolExecutor:
+    '''Der Prozesspool wird erst beim ersten Bild gestartet'''
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=RENDER_WORKERS)
+    return _pool
+
+
+async def render_plan_png(heading: str, subheading: str, rows: List[Row]) -> bytes:
+    '''Zeichnet den Plan im Prozesspool, ohne die Event Loop zu blockieren'''
+    return await asyncio.get_running_loop().run_in_executor(
+        render_pool(), render_plan, heading, subheading, rows)
+
+
+def preview_key(plan_id: int, class_: str,
+                replacements: Sequence[ReplacementType],
+                times: dict) -> Tuple[str, Optional[str]]:
+    '''Gibt den Schlüssel des Bildes in der ImageDatabase & den Stand des Plans zurück
+    DSBMobile Zeilen kennen ihren Tag & Stand, bei Untis steht er in times'''
+    first = replacements[0] if replacements else {}
+    day = first.get('date')
+    key = f'{plan_id}_{class_}' if day is None else f'{plan_id}_{class_}_{day}'
+    return key, first.get('updated') or times.get(class_) or times.get('all')
@@ -0,0 +1,162 @@
+'''Statistiken über das Archiv: wie oft fiel etwas aus, je Klasse, Lehrkraft,
+Wochentag oder Stunde. Gezählt wird vektorisiert mit NumPy über die Spalten
+des PlanArchive, jeweils nur mit dem letzten Stand jedes Tages.
+
+Bericht ohne Bot:
+    python plan_stats.py <plan_id> [--gruppe klasse] [--art entfall] [--von 2026-09-01] [--bis 2026-10-01]'''
+import argparse
+import time
+from datetime import date
+from typing import Final, Optional, Tuple, List, Dict
+
+import numpy as np
+
+from plan_archive import PlanArchive, ColumnDictionary, COLUMNS, ARCHIVE_DIR
+from plan_index import class_sort_key
+from preview_factory import REPLACED, OMITTED, ROOM_REPLACEMENT
+
+
+# Option -> Spalte im Archiv (der Wochentag wird aus dem Tag berechnet)
+GROUPS: Final[Dict[str, str]] = {
+    'klasse': 'class',
+    'lehrer': 'teacher',
+    'wochentag': 'weekday',
+    'stunde': 'lesson'
+}
+
+# Arten der Vertretung, wie sie auch die Farben der Embeds bestimmen
+CATEGORIES: Final[Dict[str, tuple]] = {
+    'entfall': OMITTED,
+    'vertretung': REPLACED,
+    'raumänderung': ROOM_REPLACEMENT
+}
+
+WEEKDAYS: Final = ('Montag', 'Dienstag', 'Mittwoch', 'Donnerstag', 'Freitag',
+                   'Samstag', 'Sonntag')
+
+
+class ArchiveColumns:
+    '''Die geladenen Spalten eines Plans, gültig solange keine Zeilen dazukommen'''
+
+    def __init__(self, archive: PlanArchive, plan_id: int):
+        self.rows: int = archive.row_count(plan_id)
+        # nur eingetragene Zeilen lesen, ein laufender Schreibvorgang stört nicht
+        self.columns: Dict[str, np.ndarray] = {
+            column: np.fromfile(archive.column_path(plan_id, column),
+                                dtype=np.uint32, count=self.rows)
+            if self.rows else np.zeros(0, dtype=np.uint32)
+            for column in COLUMNS
+        }
+        self.dictionaries: Dict[str, ColumnDictionary] = {}
+        self.archive = archive
+        self.plan_id = plan_id
+        self.latest = np.array(archive.latest_versions(plan_id), dtype=np.uint32)
+
+    def dictionary(self, column: str) -> List[Optional[str]]:
+        if not column in self.dictionaries:
+            # immer frisch lesen, das Wörterbuch des Archivs wächst mit
+            self.dictionaries[column] = ColumnDictionary(
+                self.archive.dictionary_path(self.plan_id, column))
+        return self.dictionaries[column].values
+
+
+class PlanStats:
+    '''Beantwortet die Statistik-Abfragen, die Spalten werden je Plan gecacht'''
+
+    def __init__(self, archive: PlanArchive):
+        self.archive = archive
+        self.loaded: Dict[int, ArchiveColumns] = {}
+
+    def columns(self, plan_id: int) -> ArchiveColumns:
+        '''Lädt die Spalten neu, wenn das Archiv gewachsen ist'''
+        loaded = self.loaded.get(plan_id)
+        if loaded is None or loaded.rows != self.archive.row_count(plan_id):
+            loaded = self.loaded[plan_id] = ArchiveColumns(self.archive, plan_id)
+        return loaded
+
+    @staticmethod
+    def category_mask(loaded: ArchiveColumns, column: str,
+                      category: str) -> Tuple[np.ndarray, np.ndarray]:
+        '''Die Zeilen, deren Spalte zur Art der Vertretung passt & die ohne Wert'''
+        values = loaded.dictionary(column)
+        matches = np.fromiter(
+            (value is not None and value.casefold() in CATEGORIES[category]
+             for value in values), dtype=bool, count=len(values))
+        missing = np.fromiter((not value for value in values),
+                              dtype=bool, count=len(values))
+        codes = loaded.columns[column]
+        return matches[codes], missing[codes]
+
+    def count(self,
+              plan_id: int,
+              group: str,
+              category: Optional[str] = None,
+              start: Optional[date] = None,
+              end: Optional[date] = None) -> List[Tuple[str, int]]:
+        '''Zählt die Vertretungen je Gruppe (siehe GROUPS) im Zeitraum [start, end)
+        Klassen zählen jede ihrer Vertretungen, alle anderen Gruppen jede
+        Vertretung nur einmal, auch wenn sie mehrere Klassen betrifft'''
+        loaded = self.columns(plan_id)
+        columns = loaded.columns
+
+        mask = np.isin(columns['version'], loaded.latest)
+        if start is not None:
+            mask &= columns['day'] >= start.toordinal()
+        if end is not None:
+            mask &= columns['day'] < end.toordinal()
+        if category is not None:
+            # Untis Pläne mit dem DEFAULT_MAPPER haben die Art nur in der Spalte type
+            matches, missing = self.category_mask(loaded, 'type_of_replacement', category)
+            fallback, _ = self.category_mask(loaded, 'type', category)
+            mask &= matches | (missing & fallback)
+
+        column = GROUPS[group]
+        if column != 'class':
+            # eine Zeile je Vertretung & Klasse, jede Vertretung nur einmal zählen
+            selected = np.flatnonzero(mask)
+            keys = columns['version'][selected].astype(np.uint64) << np.uint64(32) \
+                | columns['row'][selected]
+            _, first = np.unique(keys, return_index=True)
+            mask = np.zeros_like(mask)
+            mask[selected[first]] = True
+
+        if column == 'weekday':
+            # date.fromordinal(1) ist ein Montag
+            codes = (columns['day'][mask].astype(np.int64) - 1) % 7
+            labels: List[Optional[str]] = list(WEEKDAYS)
+        else:
+            codes = columns[column][mask]
+            labels = loaded.dictionary(column)
+
+        counts = np.bincount(codes, minlength=len(labels))
+        result = [(labels[code] or '–', int(counts[code]))
+                  for code in np.flatnonzero(counts)]
+
+        if column == 'weekday':
+            return result
+        if column == 'lesson':
+            return sorted(result, key=lambda item: class_sort_key(item[0]))
+        return sorted(result, key=lambda item: -item[1])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('plan_id', type=int)
+    parser.add_argument('--archive', default=ARCHIVE_DIR)
+    parser.add_argument('--gruppe', choices=GROUPS, default=None,
+                        help='nur diese Gruppe (Standard: alle)')
+    parser.add_argument('--art', choices=CATEGORIES, default=None)
+    parser.add_argument('--von', type=date.fromisoformat, default=None)
+    parser.add_argument('--bis', type=date.fromisoformat, default=None,
+                        help='erster Tag, der nicht mehr zählt')
+    parser.add_argument('--top', type=int, default=20)
+    arguments = parser.parse_args()
+
+    stats = PlanStats(PlanArchive(arguments.archive))
+    for group in [arguments.gruppe] if arguments.gruppe else GROUPS:
+        started = time.perf_counter()
+        result = stats.count(arguments.plan_id, group, arguments.art,
+                             arguments.von, arguments.bis)
+        print(f'\n{group} ({time.perf_counter() - started:.3f}s):')
+        for label, count in result[:arguments.top]:
+            print(f'  {label:<24}{count:>8}')
@@ -1,13 +1,10 @@
-import json
-from typing import Final, List
-from discord import Embed, Color
-from replacement_types import ReplacementType
-from attachment_database import ImageDatabase
+import io
+from typing import Final, Iterator, List
+from discord import Embed, Color, File
+from replacement_types import ReplacementType, PlanPreview
+from attachment_database import ImageDatabase
+from plan_renderer import plan_rows, render_plan_png
 
-# Read the Timetable Data - unused
-with open('pages.json', 'r', encoding='utf-8') as page_json:
-    PAGES: Final[dict] = json.loads(page_json.read())['keys']
-
 REPLACED: Final = ('vertretung', 'betreuung')
 OMITTED: Final = ('entfall', 'eva', 'aufgaben')
 ROOM_REPLACEMENT: Final = ('raumvertretung', 'raumänderung', 'raum-vtr.')
@@ -19,9 +16,7 @@ event_types = ((REPLACED, Color.blue()), (OMITTED, Color.red()),
                (INFO, Color.teal()))
 
 DEFAULT_FOOTER = {'text': 'Alle Angaben ohne Gewähr! Aber mit Gewehr. '}
-
-UNKNOWNS_FILE = open('unknowns.txt', 'r+')
-
+
 
 def __del__():
     print('i have to go')
@@ -56,8 +51,9 @@ def sort_items(replacements: List[ReplacementType]) -> List[ReplacementType]:
     return sorted(replacements, key=lambda key: key.get('lesson'))
 
 
-def create_embed(replacement: ReplacementType) -> Embed:
-    '''Creates an Embed Tile for a Replacement'''
+def create_embed(replacement: ReplacementType, label: str = None) -> Embed:
+    '''Creates an Embed Tile for a Replacement
+    The optional label (e.g. the Class) is prefixed to the Title'''
     subject: str = replacement.get('subject')
     replacer: str = replacement.get('replacing_teacher')
     teacher: str = replacement.get('teacher')
@@ -78,16 +74,24 @@ def create_embed(replacement: ReplacementType) -> Embed:
     if info is not None:
         desc += '\n' + info
 
-    return Embed(title=repl_type, description=desc, color=get_color(repl_type))
+    title: str = repl_type if label is None else f'{label}: {repl_type}'
+
+    return Embed(title=title, description=desc, color=get_color(repl_type))
 
 
 def create_vplan_message(replacements: List[ReplacementType],
                          class_: str,
                          database: ImageDatabase,
-                         date: str = None,
-                         subtitle: bool = True) -> List[dict]:
+                         date: str = None,
+                         subtitle: bool = True,
+                         heading: str = None,
+                         labels: List[str] = None) -> Iterator[dict]:
+    '''Creates the Messages for the Replacements
+    Each Message is yielded as soon as it is full, so it can be sent while
+    the rest is rendered. heading replaces the first Line, labels are shown
+    per Replacement'''
     message: dict = {
-        'content': f"**Vertretungsplan für die {class_}**",
+        'content': f"**Vertretungsplan für die {class_}**" if heading is None else f'**{heading}**',
         'embeds': [],
         'files': []
     }
@@ -100,39 +104,75 @@ def create_vplan_message(replacements: List[ReplacementType],
         message[
             'content'] += '\n\nOooaah, es sieht so aus als hättest du heute keine Vertretung! :('
 
-    messages: List[dict] = [message]
-
     embed_count: int = 0
     lessons: dict = {}
-    for replacement in replacements:
-        embed = create_embed(replacement)
+    for i, replacement in enumerate(replacements):
+        embed = create_embed(replacement, None if labels is None else labels[i])
 
         if embed_count != 10:
-            messages[-1]['embeds'].append(embed)
+            message['embeds'].append(embed)
             embed_count += 1
         else:
-            messages[-1]['embeds'][-1].set_footer(**DEFAULT_FOOTER)
-            messages.append({'embeds': [embed], 'files': []})
+            message['embeds'][-1].set_footer(**DEFAULT_FOOTER)
+            yield message
+            message = {'embeds': [embed], 'files': []}
             embed_count = 1
 
         lesson: str = replacement['lesson']
         if not lesson in lessons:
-            thumb = database.get_icon(lesson)
+            thumb = lessons[lesson] = database.get_icon(lesson)
         else:
             thumb = lessons[lesson]
 
         if isinstance(thumb, str):
-            messages[-1]['embeds'][-1].set_thumbnail(url=thumb)
+            message['embeds'][-1].set_thumbnail(url=thumb)
         else:
-            messages[-1]['embeds'][-1].set_thumbnail(
+            message['embeds'][-1].set_thumbnail(
                 url=f'attachment://{thumb.filename}')
-            if not thumb in messages[-1]['files']:
-                messages[-1]['files'].append(thumb)
+            if not thumb in message['files']:
+                message['files'].append(thumb)
 
-    messages[-1]['embeds'][-1].set_footer(
-        **DEFAULT_FOOTER)  # adds the no responsibility statement
+    if message['embeds']:
+        message['embeds'][-1].set_footer(
+            **DEFAULT_FOOTER)  # adds the no responsibility statement
 
-    return messages
+    yield message
+
+
+async def render_plan_image(class_: str,
+                            replacements: List[ReplacementType],
+                            stand: str = None) -> File:
+    '''Renders the whole Plan of a Class as one Image in the Process Pool'''
+    colors: List[int] = [
+        get_color(replacement.get('type_of_replacement') or 'Info').value
+        for replacement in replacements
+    ]
+    png: bytes = await render_plan_png(
+        f'Vertretungsplan für die {class_}',
+        '' if stand is None else f'Stand: {stand}',
+        plan_rows(replacements, colors))
+
+    return File(io.BytesIO(png), filename=f"{class_.replace(' ', '_')}_plan.png")
+
+
+def create_image_message(class_: str, image: PlanPreview,
+                         date: str = None) -> dict:
+    '''Creates a single Message, that shows the Plan as an Image
+    image is either the CDN Link of an uploaded Plan or a newly rendered File'''
+    message: dict = {
+        'content': f"**Vertretungsplan für die {class_}**\nHier siehst du deine Vertretungen für den {date.split(' ')[0] if date is not None else 'heutigen Tag'}:"
+    }
+
+    embed = Embed()
+    if isinstance(image, str):
+        embed.set_image(url=image)
+    else:
+        embed.set_image(url=f'attachment://{image.filename}')
+        message['file'] = image
+    embed.set_footer(**DEFAULT_FOOTER)
+    message['embed'] = embed
+
+    return message
 
 
 def prepare_replacements(
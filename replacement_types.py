@@ -1,16 +1,102 @@
-from typing import TypedDict, Union, List
+import sys
+from collections.abc import Mapping
+from typing import Any, Dict, Iterator, Optional, TypedDict, Union, List
 from discord import File, Embed
 
 
-class ReplacementType(TypedDict):
-    '''Type for an Replacement'''
-    lesson: str
-    teacher: str
-    subject: str
-    replacing_teacher: str
-    room: str
-    info_text: str
-    type_of_replacement: str
+def intern_value(value: Any) -> Any:
+    '''Interns Strings (also inside Tuples/Lists), so equal Values are shared'''
+    if isinstance(value, str):
+        return sys.intern(value)
+    if isinstance(value, (tuple, list)):
+        return tuple(intern_value(item) for item in value)
+    return value
+
+
+class Replacement(Mapping):
+    '''Compact, read-mostly Record for a Replacement
+    Behaves like the dict it replaces, but stores the known Fields in Slots
+    and interns their Values. A Row for several Classes is stored once and
+    referenced from each Class (see `classes`)'''
+
+    FIELDS = ('lesson', 'teacher', 'subject', 'replacing_teacher', 'room',
+              'info_text', 'type_of_replacement', 'type', 'new_subject',
+              'new_teacher', 'classes', 'date', 'day', 'updated')
+
+    __slots__ = FIELDS + ('extra', )
+
+    def __init__(self, **fields):
+        for field in self.FIELDS:
+            object.__setattr__(self, field, None)
+        self.extra: Optional[Dict[str, Any]] = None
+
+        for key, value in fields.items():
+            self[key] = value
+
+    @classmethod
+    def from_pairs(cls, pairs) -> 'Replacement':
+        '''Creates a Record from (Key, Value) Pairs, skipping empty ones'''
+        replacement = cls()
+        for key, value in pairs:
+            if key is not None and value is not None:
+                replacement[key] = value
+        return replacement
+
+    def __getitem__(self, key: str) -> Any:
+        value = getattr(self, key, None) if key in self.FIELDS else (
+            None if self.extra is None else self.extra.get(key))
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key: str, value: Any):
+        value = intern_value(value)
+        if key in self.FIELDS:
+            setattr(self, key, value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[intern_value(key)] = value
+
+    def __delitem__(self, key: str):
+        if key not in self:
+            raise KeyError(key)
+        if key in self.FIELDS:
+            setattr(self, key, None)
+        else:
+            del self.extra[key]
+
+    def pop(self, key: str, *default) -> Any:
+        '''Removes the Field and returns its Value, like dict.pop'''
+        try:
+            value = self[key]
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+        del self[key]
+        return value
+
+    def __iter__(self) -> Iterator[str]:
+        for field in self.FIELDS:
+            if getattr(self, field) is not None:
+                yield field
+        if self.extra is not None:
+            yield from self.extra
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def to_dict(self) -> dict:
+        '''Converts the Record to a plain (JSON serializable) dict'''
+        return dict(self.items())
+
+    def __repr__(self) -> str:
+        return f'Replacement({self.to_dict()!r})'
+
+
+# the Records replace the former TypedDict, the Name stays for the Annotations
+ReplacementType = Replacement
 
 
 class MessageData(TypedDict):
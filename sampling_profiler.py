@@ -0,0 +1,72 @@
+'''Sampling Profiler für den laufenden Bot
+Ein Thread liest alle INTERVAL Sekunden die Stacks aller Threads (Event Loop
+& die Threads von run_blocking) & zählt sie. Das Ergebnis sind Collapsed
+Stacks ("datei:funktion;datei:funktion anzahl"), die z.B. flamegraph.pl
+oder speedscope direkt anzeigen.'''
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Final, Optional, Dict
+
+
+# Sekunden zwischen zwei Samples
+INTERVAL: Final[float] = 0.005
+# länger darf ein Profil nicht laufen
+MAX_SECONDS: Final[int] = 120
+
+# es läuft immer nur ein Profil gleichzeitig
+_running = threading.Lock()
+
+
+class ProfilerBusyError(Exception):
+    '''Es läuft schon ein Profil'''
+
+
+def collapse(frame, thread_name: str) -> str:
+    '''Der Stack vom äußersten zum innersten Aufruf, mit ; getrennt'''
+    calls = []
+    while frame is not None:
+        code = frame.f_code
+        calls.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+        frame = frame.f_back
+    calls.append(thread_name)
+    return ';'.join(reversed(calls))
+
+
+def sample(seconds: float, interval: float = INTERVAL) -> Counter:
+    '''Zählt die Stacks aller anderen Threads, blockiert für seconds'''
+    if not _running.acquire(blocking=False):
+        raise ProfilerBusyError('Es läuft schon ein Profil')
+
+    try:
+        own = threading.get_ident()
+        stacks: Counter = Counter()
+        end = time.monotonic() + min(seconds, MAX_SECONDS)
+        while time.monotonic() < end:
+            names: Dict[int, str] = {
+                thread.ident: thread.name for thread in threading.enumerate()
+            }
+            for ident, frame in sys._current_frames().items():
+                if ident != own:
+                    stacks[collapse(frame, names.get(ident, str(ident)))] += 1
+            time.sleep(interval)
+        return stacks
+    finally:
+        _running.release()
+
+
+def format_collapsed(stacks: Counter, header: Optional[str] = None) -> str:
+    '''Eine Zeile je Stack, die häufigsten zuerst'''
+    lines = [] if header is None else [f'# {header}']
+    lines.extend(f'{stack} {count}' for stack, count in stacks.most_common())
+    return '\n'.join(lines) + '\n'
+
+
+def profile(seconds: float) -> str:
+    '''Profiliert seconds lang & gibt die Collapsed Stacks zurück'''
+    started = time.strftime('%Y-%m-%d %H:%M:%S')
+    stacks = sample(seconds)
+    return format_collapsed(
+        stacks, f'{started}, {seconds}s, {sum(stacks.values())} Samples')
@@ -1,44 +1,72 @@
-import os
+import json
 import sqlite3
+import time
 from sqlite3 import Cursor
-from typing import Optional, Union, Dict, Tuple, List
+from typing import Final, Optional, Dict, Tuple, List
 from discord import Guild
 from discord.abc import Messageable
+from database_migrations import Migration, migrate
+
+
+# Append a new Migration when the Schema changes, never edit an old one
+MIGRATIONS: Final[List[Migration]] = [
+    ('CREATE TABLE IF NOT EXISTS untis_page (name TEXT NOT NULL PRIMARY KEY, link TEXT NOT NULL UNIQUE)',
+     'CREATE TABLE IF NOT EXISTS dsb_page (name TEXT NOT NULL PRIMARY KEY, username TEXT NOT NULL, password TEXT NOT NULL)',
+     'CREATE TABLE IF NOT EXISTS servers (guild_id INT NOT NULL PRIMARY KEY, page_id INT NOT NULL)',
+     'CREATE TABLE IF NOT EXISTS events (guild_id INT NOT NULL, channel_id INT NOT NULL, time INT NOT NULL, class_id TEXT, PRIMARY KEY (guild_id, channel_id, time, class_id))'
+     ),
+    # pages added at runtime get a plan ID, like the ones in the pages.json
+    ('ALTER TABLE untis_page ADD COLUMN id INT',
+     'ALTER TABLE dsb_page ADD COLUMN id INT',
+     'CREATE UNIQUE INDEX untis_page_id ON untis_page (id)',
+     'CREATE UNIQUE INDEX dsb_page_id ON dsb_page (id)'),
+    # small Key-Value Store for the Bot's own State
+    ('CREATE TABLE IF NOT EXISTS bot_state (key TEXT NOT NULL PRIMARY KEY, value TEXT)', ),
+    # how often each Class is asked for, to prefetch the popular ones
+    ('CREATE TABLE IF NOT EXISTS class_popularity (plan_id INT NOT NULL, class_id TEXT NOT NULL, score REAL NOT NULL, updated REAL NOT NULL, PRIMARY KEY (plan_id, class_id))', ),
+    # Channels, whose scheduled Events are delivered through a Webhook
+    ('CREATE TABLE IF NOT EXISTS webhooks (channel_id INT NOT NULL PRIMARY KEY, webhook_id INT NOT NULL, token TEXT NOT NULL)', ),
+    # the Messages of the last Post of Events, that edit it in place ('' is the whole School)
+    ('CREATE TABLE IF NOT EXISTS posted_plans (channel_id INT NOT NULL, class_id TEXT NOT NULL, messages TEXT NOT NULL, PRIMARY KEY (channel_id, class_id))', ),
+    # Channels, that get the Plan of a Class whenever its Stand changes
+    ('CREATE TABLE IF NOT EXISTS subscriptions (guild_id INT NOT NULL, channel_id INT NOT NULL, class_id TEXT NOT NULL, stand TEXT, PRIMARY KEY (channel_id, class_id))', ),
+    # IDs of the Pages added at runtime, handed out by SQLite, so Shards never share one
+    ('CREATE TABLE IF NOT EXISTS page_ids (id INTEGER NOT NULL PRIMARY KEY)',
+     'INSERT OR IGNORE INTO page_ids SELECT id FROM untis_page WHERE id IS NOT NULL UNION SELECT id FROM dsb_page WHERE id IS NOT NULL')
+]
+
+# Seconds after which a Query only counts half
+POPULARITY_HALF_LIFE: Final[float] = 7 * 24 * 60 * 60
+# a scheduled Event counts like this many Queries
+SUBSCRIPTION_WEIGHT: Final[float] = 5.0
+
+
+def decayed(score: float, updated: float, now: float) -> float:
+    return score * 0.5**((now - updated) / POPULARITY_HALF_LIFE)
 
 
 class PageDatabase:
     '''A Database, that stores Guild Data and Subsitution Table credentials'''
 
     server_mapper: Dict[int, int]
-    events: Dict[int, List[Union[Tuple[Messageable, str], Tuple[int, int,
-                                                                str]]]]
+    # quarter hour -> (guild_id, channel_id, class_id)
+    events: Dict[int, List[Tuple[int, int, Optional[str]]]]
+    # channel_id -> (webhook_id, token)
+    webhooks: Dict[int, Tuple[int, str]]
+    # (plan_id, class_id) -> (score, updated) of the Queries, that aren't stored yet
+    queries: Dict[Tuple[int, str], Tuple[float, float]]
     cursor: Cursor
 
     def __init__(self, name: str = 'webpages.db'):
-        create_tables = not os.path.exists(name)
         self.database = sqlite3.connect(name)
+        migrate(self.database, MIGRATIONS)
         self.cursor = self.database.cursor()
 
-        if create_tables:
-            self.cursor.execute(
-                'CREATE TABLE untis_page (name TEXT NOT NULL PRIMARY KEY, link TEXT NOT NULL UNIQUE)'
-            )
-            self.cursor.execute(
-                'CREATE TABLE dsb_page (name TEXT NOT NULL PRIMARY KEY, username TEXT NOT NULL, password TEXT NOT NULL)'
-            )
-            self.cursor.execute(
-                'CREATE TABLE servers (guild_id INT NOT NULL PRIMARY KEY, page_id INT NOT NULL)'
-            )
-            # self.cursor.execute('DROP TABLE events')
-            self.cursor.execute(
-                'CREATE TABLE events (guild_id INT NOT NULL, channel_id INT NOT NULL, time INT NOT NULL, class_id TEXT, PRIMARY KEY (guild_id, channel_id, time, class_id))'
-            )
-
         self.server_mapper = {
             name: id
             for name, id in self.cursor.execute(
                 'SELECT * from servers').fetchall()
-        } if not create_tables else {}
+        }
 
         self.events = {}
         for guild_id, channel_id, time, class_id in self.cursor.execute(
@@ -48,44 +76,78 @@ class PageDatabase:
             else:
                 self.events[time] = [(guild_id, channel_id, class_id)]
 
-    def get_page(self, plan_name: str, plan_type: int) -> str:
-        '''Request the URL for a plan from the Database'''
+        self.queries = {}
 
-        self.cursor.execute('SELECT name FROM plans WHERE key = ?', plan_name)
-        result = self.cursor.fetchone()
-        self.cursor = self.database.cursor()
+        self.webhooks = {
+            channel_id: (webhook_id, token)
+            for channel_id, webhook_id, token in self.cursor.execute(
+                'SELECT channel_id, webhook_id, token FROM webhooks').fetchall()
+        }
+
+    def get_pages(self) -> Dict[str, dict]:
+        '''Returns all registered pages, keyed by URL like the pages.json'''
+        pages = {}
+        for plan_id, name, link in self.cursor.execute(
+                'SELECT id, name, link FROM untis_page WHERE id IS NOT NULL'
+        ).fetchall():
+            pages[link] = {'id': plan_id, 'type': 0, 'name': name}
 
-        if result is None:
-            return None
+        for plan_id, name, username, password in self.cursor.execute(
+                'SELECT id, name, username, password FROM dsb_page WHERE id IS NOT NULL'
+        ).fetchall():
+            pages[f'dsb://{username}'] = {
+                'id': plan_id,
+                'type': 1,
+                'name': name,
+                'username': username,
+                'password': password
+            }
 
-        return None
+        return pages
 
     def add_page(self,
+                 min_id: int,
                  plan_name: str,
                  plan_type: int,
                  link: Optional[str] = None,
                  username: Optional[str] = None,
-                 password: Optional[str] = None):
-        '''Adds a page to the database'''
-
+                 password: Optional[str] = None) -> int:
+        '''Adds a page to the database, its ID is at least min_id (the IDs
+        below belong to the pages.json)
+        Returns the ID of the page, which differs if it already existed'''
         if plan_type == 0:
-            exists = len(
-                self.cursor.execute(
-                    'SELECT untis_page.name FROM untis_page WHERE untis_page.link = ?',
-                    link)) != 0
-            if not exists:
-                self.cursor.execute('INSERT INTO untis_page VALUES (?, ?)',
-                                    (plan_name, link))
+            select = ('SELECT untis_page.id FROM untis_page WHERE untis_page.link = ?', (link, ))
         elif plan_type == 1:
-            exists = len(
-                self.cursor.execute(
-                    'SELECT dsb_page.name FROM dsb_page WHERE dsb_page.username = ?',
-                    username)) != 0
-            if not exists:
-                self.cursor.execute('INSERT INTO dsb_page VALUES (?, ?, ?)',
-                                    (plan_name, username, password))
+            select = ('SELECT dsb_page.id FROM dsb_page WHERE dsb_page.username = ?', (username, ))
+        else:
+            raise ValueError(f'Unknown page type {plan_type}')
 
-        self.database.commit()
+        existing = self.cursor.execute(*select).fetchone()
+        if existing is not None:
+            return existing[0]
+
+        try:
+            # a single Statement, concurrent Shards can't get the same ID
+            self.cursor.execute(
+                'INSERT INTO page_ids SELECT MAX(?, IFNULL(MAX(id), 0) + 1) FROM page_ids',
+                (min_id, ))
+            plan_id: int = self.cursor.lastrowid
+            if plan_type == 0:
+                self.cursor.execute('INSERT INTO untis_page VALUES (?, ?, ?)',
+                                    (plan_name, link, plan_id))
+            else:
+                self.cursor.execute('INSERT INTO dsb_page VALUES (?, ?, ?, ?)',
+                                    (plan_name, username, password, plan_id))
+            self.database.commit()
+        except sqlite3.IntegrityError:
+            # another Shard added the same page in the meantime
+            self.database.rollback()
+            existing = self.cursor.execute(*select).fetchone()
+            if existing is None:
+                raise
+            return existing[0]
+
+        return plan_id
 
     def config_server(self, guild: Guild, default_plan: int):
         self.database.execute(
@@ -101,24 +163,152 @@ class PageDatabase:
         self.cursor.execute(
             'REPLACE INTO events (guild_id, channel_id, time, class_id) VALUES (?, ?, ?, ?)',
             (channel.guild.id, channel.id, time, class_id))
+        event = (channel.guild.id, channel.id, class_id)
         if time in self.events:
-            self.events[time].append((channel, class_id))
+            if not event in self.events[time]:
+                self.events[time].append(event)
         else:
-            self.events[time] = [channel, class_id]
+            self.events[time] = [event]
 
         self.database.commit()
 
     def delete_event(self, guild_id: int, channel_id: int, time: int,
-                     class_id: int):
+                     class_id: Optional[str]):
         self.cursor.execute(
-            'DELETE FROM events WHERE events.guild_id = ? and events.channel_id = ? and events.time = ? and events.class_id = ?',
+            'DELETE FROM events WHERE events.guild_id = ? and events.channel_id = ? and events.time = ? and events.class_id IS ?',
             (guild_id, channel_id, time, class_id))
+        event = (guild_id, channel_id, class_id)
+        if event in self.events.get(time, ()):
+            self.events[time].remove(event)
+
+        self.database.commit()
+
+    def set_webhook(self, channel_id: int, webhook_id: int, token: str):
+        '''Delivers the scheduled Events of the Channel through the Webhook'''
+        self.cursor.execute(
+            'REPLACE INTO webhooks (channel_id, webhook_id, token) VALUES (?, ?, ?)',
+            (channel_id, webhook_id, token))
+        self.webhooks[channel_id] = (webhook_id, token)
+        self.database.commit()
+
+    def delete_webhook(self, channel_id: int):
+        self.cursor.execute('DELETE FROM webhooks WHERE channel_id = ?',
+                            (channel_id, ))
+        self.webhooks.pop(channel_id, None)
+        self.database.commit()
+
+    def get_posted(self, channel_id: int,
+                   class_id: Optional[str]) -> Optional[List[Tuple[int, str]]]:
+        '''Returns the (message_id, digest) Pairs of the last Post of the Class,
+        None if the Events of the Class send a new Post every Time'''
+        row = self.cursor.execute(
+            'SELECT messages FROM posted_plans WHERE channel_id = ? and class_id = ?',
+            (channel_id, class_id or '')).fetchone()
+        return None if row is None else [tuple(message) for message in json.loads(row[0])]
 
+    def set_posted(self, channel_id: int, class_id: Optional[str],
+                   messages: List[Tuple[int, str]]):
+        '''Stores the Messages of the last Post, so the next one edits them'''
+        self.cursor.execute(
+            'REPLACE INTO posted_plans (channel_id, class_id, messages) VALUES (?, ?, ?)',
+            (channel_id, class_id or '', json.dumps(messages)))
         self.database.commit()
 
+    def clear_posted(self, channel_id: int):
+        '''Forgets the posted Messages of the Channel, the next Posts are new ones'''
+        self.cursor.execute(
+            "UPDATE posted_plans SET messages = '[]' WHERE channel_id = ?",
+            (channel_id, ))
+        self.database.commit()
+
+    def add_subscription(self, channel: Messageable, class_id: str):
+        '''Sends the Plan of the Class to the Channel, whenever it changes'''
+        self.cursor.execute(
+            'INSERT OR IGNORE INTO subscriptions (guild_id, channel_id, class_id, stand) VALUES (?, ?, ?, NULL)',
+            (channel.guild.id, channel.id, class_id))
+        self.database.commit()
+
+    def delete_subscription(self, channel_id: int, class_id: str) -> bool:
+        '''Returns whether the Channel was subscribed to the Class'''
+        self.cursor.execute(
+            'DELETE FROM subscriptions WHERE channel_id = ? and class_id = ? COLLATE NOCASE',
+            (channel_id, class_id))
+        self.database.commit()
+        return self.cursor.rowcount > 0
+
+    def get_subscriptions(self) -> List[Tuple[int, int, str, Optional[str]]]:
+        '''Returns all (guild_id, channel_id, class_id, stand) Subscriptions,
+        stand is the last one sent (None for new Subscriptions)'''
+        return self.cursor.execute(
+            'SELECT guild_id, channel_id, class_id, stand FROM subscriptions'
+        ).fetchall()
+
+    def set_notified(self, channel_id: int, class_id: str, stand: str):
+        self.cursor.execute(
+            'UPDATE subscriptions SET stand = ? WHERE channel_id = ? and class_id = ?',
+            (stand, channel_id, class_id))
+        self.database.commit()
+
+    def get_state(self, key: str) -> Optional[str]:
+        '''Returns a stored Value of the Bot's State'''
+        row = self.cursor.execute('SELECT value FROM bot_state WHERE key = ?',
+                                  (key, )).fetchone()
+        return None if row is None else row[0]
+
+    def set_state(self, key: str, value: Optional[str]):
+        '''Stores a Value of the Bot's State'''
+        self.cursor.execute('REPLACE INTO bot_state (key, value) VALUES (?, ?)',
+                            (key, value))
+        self.database.commit()
+
+    def record_query(self, plan_id: int, class_id: str):
+        '''Counts a Query for the Class, older Queries count less
+        The Queries are only counted in Memory, flush_queries() stores them'''
+        now = time.time()
+        pending = self.queries.get((plan_id, class_id))
+        score = 1.0 if pending is None else decayed(*pending, now) + 1.0
+        self.queries[(plan_id, class_id)] = (score, now)
+
+    def flush_queries(self):
+        '''Adds the counted Queries to the Database, in a single Transaction'''
+        if not self.queries:
+            return
+        queries, self.queries = self.queries, {}
+        now = time.time()
+        for (plan_id, class_id), pending in queries.items():
+            row = self.cursor.execute(
+                'SELECT score, updated FROM class_popularity WHERE plan_id = ? and class_id = ?',
+                (plan_id, class_id)).fetchone()
+            score = decayed(*pending, now) + (0.0 if row is None else decayed(*row, now))
+            self.cursor.execute(
+                'REPLACE INTO class_popularity (plan_id, class_id, score, updated) VALUES (?, ?, ?, ?)',
+                (plan_id, class_id, score, now))
+        self.database.commit()
+
+    def hot_classes(self, plan_id: int, limit: int) -> List[str]:
+        '''Returns the most popular Classes of the Plan, by their Queries
+        and the scheduled Events, that post them'''
+        self.flush_queries()
+        now = time.time()
+        scores: Dict[str, float] = {
+            class_id: decayed(score, updated, now)
+            for class_id, score, updated in self.cursor.execute(
+                'SELECT class_id, score, updated FROM class_popularity WHERE plan_id = ?',
+                (plan_id, )).fetchall()
+        }
+        subscribed = [event for events in self.events.values() for event in events]
+        subscribed.extend(self.cursor.execute(
+            'SELECT guild_id, channel_id, class_id FROM subscriptions').fetchall())
+        for guild_id, _, class_id in subscribed:
+            if class_id is not None and self.server_mapper.get(guild_id, 0) == plan_id:
+                scores[class_id] = scores.get(class_id, 0.0) + SUBSCRIPTION_WEIGHT
+
+        return sorted(scores, key=scores.get, reverse=True)[:limit]
+
     def get_server_default(self, guild: Guild) -> int:
         return self.server_mapper.get(guild.id, 0)
 
     def __del__(self):
+        self.flush_queries()
         self.database.commit()
         self.database.close()
@@ -0,0 +1,252 @@
+'''Tauscht Vertretungspläne zwischen dem Fetcher und den Bot-Shards aus'''
+import json
+import sqlite3
+import threading
+import time
+from datetime import date
+from typing import Final, Iterator, Optional, Tuple, List, Dict
+from database_migrations import Migration, migrate
+from attachment_database import ImageDatabase
+from plan_index import ClassTrie, PlanIndex, lookup_classes
+from plan_renderer import preview_key
+from replacement_types import Replacement, ReplacementType, PlanPreview
+
+
+SNAPSHOT_DB: Final[str] = 'snapshots.db'
+
+# die Shards melden Abfragen höchstens so oft (in Sekunden) an den Fetcher
+REQUEST_MARK_INTERVAL: Final[float] = 60.0
+# Sekunden, die ein geladener Snapshot beantwortet, ohne nach einer neuen Version zu sehen
+SNAPSHOT_MAX_AGE: Final[float] = 30.0
+
+MIGRATIONS: Final[List[Migration]] = [
+    ('CREATE TABLE IF NOT EXISTS snapshots (plan_id INT NOT NULL PRIMARY KEY, version INT NOT NULL, created REAL NOT NULL, times TEXT NOT NULL, replacements TEXT NOT NULL)',
+     'CREATE TABLE IF NOT EXISTS requests (plan_id INT NOT NULL PRIMARY KEY, requested REAL NOT NULL)'),
+    # Index aller veröffentlichten Tage
+    ("ALTER TABLE snapshots ADD COLUMN days TEXT NOT NULL DEFAULT '{}'", ),
+    # seit wann die Schulseite nicht erreichbar ist
+    ('ALTER TABLE snapshots ADD COLUMN stale_since REAL', )
+]
+
+
+def load_classes(classes: dict) -> Dict[str, List[ReplacementType]]:
+    '''Wandelt die gespeicherten Vertretungen wieder in Replacements um'''
+    return {
+        class_: [Replacement(**event) for event in events]
+        for class_, events in classes.items()
+    }
+
+
+class SnapshotStore:
+    '''Speichert den jeweils neuesten Stand jedes Plans mit Versionsnummer
+    Ein Prozess schreibt (der Fetcher), beliebig viele Prozesse lesen'''
+
+    def __init__(self, name: str = SNAPSHOT_DB):
+        # die Bot-Shards lesen aus den Threads von run_blocking, die Sperre
+        # lässt immer nur einen davon an die Verbindung
+        self.database = sqlite3.connect(name, check_same_thread=False)
+        self.lock = threading.Lock()
+        # WAL erlaubt gleichzeitiges Lesen, während der Fetcher schreibt
+        self.database.execute('PRAGMA journal_mode=WAL')
+        migrate(self.database, MIGRATIONS)
+
+    def mark_requested(self, plan_id: int) -> None:
+        '''Meldet dem Fetcher, dass der Plan gerade abgefragt wird'''
+        with self.lock:
+            with self.database:
+                self.database.execute('REPLACE INTO requests VALUES (?, ?)',
+                                      (plan_id, time.time()))
+
+    def get_requested(self, plan_id: int) -> Optional[float]:
+        '''Gibt zurück, wann der Plan zuletzt abgefragt wurde'''
+        with self.lock:
+            row = self.database.execute(
+                'SELECT requested FROM requests WHERE plan_id = ?',
+                (plan_id, )).fetchone()
+            return None if row is None else row[0]
+
+    def get_version(self, plan_id: int) -> Optional[int]:
+        '''Gibt die aktuelle Version des Plans zurück, None wenn es keine gibt'''
+        with self.lock:
+            row = self.database.execute(
+                'SELECT version FROM snapshots WHERE plan_id = ?',
+                (plan_id, )).fetchone()
+            return None if row is None else row[0]
+
+    def publish(self, plan_id: int, times: dict,
+                replacements: Dict[str, List[ReplacementType]],
+                days: Dict[date, Dict[str, List[ReplacementType]]] = None,
+                stale_since: Optional[float] = None) -> int:
+        '''Veröffentlicht einen neuen Stand, wenn er sich geändert hat
+        Gibt die (neue) Version zurück'''
+        times_json = json.dumps(times, sort_keys=True)
+        # Klassen können None sein (Zeilen ohne Klasse), also nicht sortieren
+        replacements_json = json.dumps(replacements,
+                                       default=Replacement.to_dict)
+        days_json = json.dumps(
+            {day.isoformat(): classes for day, classes in (days or {}).items()},
+            default=Replacement.to_dict)
+
+        with self.lock:
+            row = self.database.execute(
+                'SELECT version, times, replacements, days, stale_since FROM snapshots WHERE plan_id = ?',
+                (plan_id, )).fetchone()
+            if row is not None and row[1:] == (times_json, replacements_json,
+                                               days_json, stale_since):
+                return row[0]
+
+            version = 1 if row is None else row[0] + 1
+            with self.database:
+                self.database.execute(
+                    'REPLACE INTO snapshots (plan_id, version, created, times, replacements, days, stale_since) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (plan_id, version, time.time(), times_json, replacements_json,
+                     days_json, stale_since))
+
+            return version
+
+    def load(self, plan_id: int) -> Optional[Tuple[int, dict, dict, dict, Optional[float]]]:
+        '''Lädt Version, Zeiten, Vertretungen, den Tages-Index des Plans
+        & seit wann die Schulseite nicht erreichbar ist'''
+        with self.lock:
+            row = self.database.execute(
+                'SELECT version, times, replacements, days, stale_since FROM snapshots WHERE plan_id = ?',
+                (plan_id, )).fetchone()
+        if row is None:
+            return None
+
+        days = {
+            date.fromisoformat(day): load_classes(classes)
+            for day, classes in json.loads(row[3]).items()
+        }
+        return row[0], json.loads(row[1]), load_classes(json.loads(
+            row[2])), days, row[4]
+
+    def __del__(self):
+        self.database.close()
+
+
+class SnapshotPage:
+    '''Nur-Lese-Ersatz für Page, der die Pläne aus dem SnapshotStore liest,
+    statt die Schulseiten selbst abzufragen'''
+
+    def __init__(self, plan_id: int, store: SnapshotStore,
+                 database: ImageDatabase = None):
+        self.plan_id: Final = plan_id
+        self.store = store
+        self.database = database
+
+        self.version: Optional[int] = None
+        self.last_marked: float = 0.0
+        self.replacements: Dict[str, List[ReplacementType]] = {}
+        self.times: dict = {}
+        self.days: Dict[date, Dict[str, List[ReplacementType]]] = {}
+        self.indexes: Dict[date, PlanIndex] = {}
+        self.class_trie: Optional[ClassTrie] = None
+        self.stale_since: Optional[float] = None
+        self.last_checked: float = 0.0
+
+    def refresh_page(self):
+        '''Lädt den Snapshot neu, falls der Fetcher eine neue Version hat'''
+        now = time.time()
+        if now - self.last_marked > REQUEST_MARK_INTERVAL:
+            self.store.mark_requested(self.plan_id)
+            self.last_marked = now
+
+        self.last_checked = time.monotonic()
+        if self.store.get_version(self.plan_id) == self.version:
+            return
+
+        snapshot = self.store.load(self.plan_id)
+        if snapshot is not None:
+            self.version, self.times, self.replacements, self.days, \
+                self.stale_since = snapshot
+            self.indexes = {
+                day: PlanIndex(classes)
+                for day, classes in self.days.items()
+            }
+
+            known = set(self.replacements)
+            for classes in self.days.values():
+                known.update(classes)
+            known.discard('null')  # Zeilen ohne Klasse
+            self.class_trie = ClassTrie(known, self.replacements)
+
+    def get_plan_for_class(self, key: str) -> Optional[Tuple[str, List[ReplacementType]]]:
+        '''Gibt den Vertretungsplan der gegebenen Klasse zurück'''
+        self.refresh_page()
+
+        key_dict = {item.lower(): item for item in self.replacements}
+        key = key_dict.get(key.lower())
+        if key is None:
+            return None
+
+        return key, self.replacements[key]
+
+    def is_fresh(self) -> bool:
+        '''Der Snapshot wurde gerade erst mit dem Store abgeglichen'''
+        return self.version is not None and \
+            time.monotonic() - self.last_checked < SNAPSHOT_MAX_AGE
+
+    def cached_plan_for_class(self, key: str) -> Optional[Tuple[str, List[ReplacementType]]]:
+        '''Gibt den Plan der Klasse aus dem Speicher zurück, wenn er aktuell ist'''
+        return lookup_classes(self.replacements, [key])[key] if self.is_fresh() else None
+
+    def cached_classes(self) -> Optional[list]:
+        return list(self.replacements) if self.is_fresh() else None
+
+    def cached_plan_for_all(self) -> Optional[Dict[str, List[ReplacementType]]]:
+        return dict(self.replacements) if self.is_fresh() else None
+
+    def get_plans_for_classes(self, classes: List[str]) -> Dict[str, Optional[Tuple[str, List[ReplacementType]]]]:
+        '''Gibt die Pläne mehrerer Klassen zurück'''
+        self.refresh_page()
+        return lookup_classes(self.replacements, classes)
+
+    def get_plan_for_day(self, key: str, day: date) -> Optional[Tuple[str, List[ReplacementType]]]:
+        '''Gibt den Vertretungsplan der Klasse für den Tag zurück'''
+        self.refresh_page()
+
+        classes = self.days.get(day, {})
+        key_dict = {item.lower(): item for item in classes if item is not None}
+        key = key_dict.get(key.lower())
+        if key is None:
+            return None
+
+        return key, classes[key]
+
+    def get_index(self, day: date = None) -> Optional[PlanIndex]:
+        '''Gibt die Lehrer- & Raum-Indizes für den Tag (sonst den neuesten) zurück'''
+        self.refresh_page()
+
+        if day is None:
+            day = max(self.indexes, default=None)
+
+        return self.indexes.get(day)
+
+    def iter_plan_for_all(self) -> Iterator[Tuple[str, List[ReplacementType]]]:
+        '''Gibt den Vertretungsplan aller Klassen Klasse für Klasse zurück'''
+        yield from self.get_plan_for_all().items()
+
+    def get_plan_for_all(self) -> Dict[str, List[ReplacementType]]:
+        '''Gibt den Vertretungsplan für alle Klassen der Seite zurück!'''
+        self.refresh_page()
+        return self.replacements
+
+    def get_classes(self) -> list:
+        '''Gibt alle Klassen mit Vertretungen zurück'''
+        self.refresh_page()
+        return self.replacements.keys()
+
+    def get_plan_preview(self, key: str, replacements: List[ReplacementType]) -> Optional[PlanPreview]:
+        '''Gibt den Link zum Bild des Plans für den aktuellen Stand zurück'''
+        if self.database is None:
+            return None
+
+        image_key, stand = preview_key(self.plan_id, key, replacements, self.times)
+        return None if stand is None else self.database.get_plan(image_key, stand)
+
+    def set_plan_preview(self, key: str, replacements: List[ReplacementType], link: str):
+        '''Merkt sich die CDN-URL des hochgeladenen Bildes für den aktuellen Stand'''
+        image_key, stand = preview_key(self.plan_id, key, replacements, self.times)
+        if self.database is not None and stand is not None:
+            self.database.set_attachment(image_key, link, stand)
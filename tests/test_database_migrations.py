@@ -0,0 +1,65 @@
+'''Tests for migrating sqlite Schemas in place'''
+import sqlite3
+import unittest
+from contextlib import redirect_stdout
+from io import StringIO
+
+from database_migrations import get_version, migrate
+
+
+MIGRATIONS = [
+    ('CREATE TABLE items (id INT PRIMARY KEY, name TEXT)', ),
+    ('ALTER TABLE items ADD COLUMN url TEXT',
+     'CREATE INDEX items_url ON items (url)'),
+]
+
+
+class MigrateTest(unittest.TestCase):
+    def setUp(self):
+        self.database = sqlite3.connect(':memory:')
+
+    def tearDown(self):
+        self.database.close()
+
+    def migrate(self, migrations) -> int:
+        with redirect_stdout(StringIO()):
+            return migrate(self.database, migrations)
+
+    def columns(self) -> list:
+        return [row[1] for row in self.database.execute('PRAGMA table_info(items)')]
+
+    def test_new_database(self):
+        self.assertEqual(get_version(self.database), 0)
+        self.assertEqual(self.migrate(MIGRATIONS), 2)
+        self.assertEqual(get_version(self.database), 2)
+        self.assertEqual(self.columns(), ['id', 'name', 'url'])
+
+    def test_keeps_data(self):
+        self.migrate(MIGRATIONS[:1])
+        with self.database:
+            self.database.execute("INSERT INTO items VALUES (1, 'icon')")
+
+        self.assertEqual(self.migrate(MIGRATIONS), 2)
+        self.assertEqual(self.database.execute('SELECT * FROM items').fetchall(),
+                         [(1, 'icon', None)])
+
+    def test_up_to_date(self):
+        self.migrate(MIGRATIONS)
+        with redirect_stdout(StringIO()) as output:
+            self.assertEqual(migrate(self.database, MIGRATIONS), 2)
+        self.assertEqual(output.getvalue(), '')
+
+    def test_failed_migration_rolls_back(self):
+        self.migrate(MIGRATIONS[:1])
+        broken = MIGRATIONS[:1] + [('ALTER TABLE items ADD COLUMN url TEXT',
+                                    'CREATE INDEX items_url ON missing (url)')]
+        with self.assertRaises(sqlite3.OperationalError):
+            self.migrate(broken)
+
+        self.assertEqual(get_version(self.database), 1)
+        self.assertEqual(self.columns(), ['id', 'name'])
+        self.assertEqual(self.migrate(MIGRATIONS), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+'''Tests für das Entfernen doppelter Stände in PlanArchive'''
+import os
+import tempfile
+import unittest
+from datetime import date
+
+from plan_archive import PlanArchive, plan_digest
+
+
+MONDAY = date(2024, 3, 4)
+TUESDAY = date(2024, 3, 5)
+
+
+def event(lesson: str, teacher: str = 'Mü', info_text: str = None) -> dict:
+    return {'lesson': lesson, 'teacher': teacher, 'subject': 'M',
+            'info_text': info_text, 'updated': '04.03.2024 07:00'}
+
+
+class PlanArchiveTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.archive = PlanArchive(self.directory.name)
+
+    def tearDown(self):
+        self.archive.database.close()
+        self.directory.cleanup()
+
+    def column_size(self, column: str) -> int:
+        return os.path.getsize(self.archive.column_path(1, column))
+
+    def test_same_content_is_archived_once(self):
+        classes = {'5a': [event('1')], '6b': [event('2')]}
+        version = self.archive.append(1, MONDAY, '04.03.2024 07:00', classes)
+        rows = self.archive.row_count(1)
+
+        # ein neuer Stand mit gleichem Inhalt ergibt keine neue Version
+        self.assertIsNone(self.archive.append(1, MONDAY, '04.03.2024 08:00',
+                                              {'5a': [event('1')], '6b': [event('2')]}))
+        self.assertEqual(self.archive.versions(1), [(version, MONDAY.isoformat(),
+                                                     '04.03.2024 07:00', 2)])
+        self.assertEqual(self.archive.row_count(1), rows)
+        self.assertEqual(self.column_size('class'), rows * 4)
+        self.assertTrue(self.archive.has_version(1, MONDAY, plan_digest(classes)))
+
+    def test_digest_ignores_stand_and_updated(self):
+        changed = event('1')
+        changed['updated'] = '04.03.2024 09:00'
+        self.assertEqual(plan_digest({'5a': [event('1')]}), plan_digest({'5a': [changed]}))
+        self.assertNotEqual(plan_digest({'5a': [event('1')]}),
+                            plan_digest({'5a': [event('1', info_text='fällt aus')]}))
+
+    def test_changed_content_is_new_version(self):
+        first = self.archive.append(1, MONDAY, None, {'5a': [event('1')]})
+        second = self.archive.append(1, MONDAY, None,
+                                     {'5a': [event('1', info_text='fällt aus')]})
+        self.assertIsNotNone(second)
+        self.assertNotEqual(first, second)
+        self.assertEqual(self.archive.row_count(1), 2)
+        self.assertEqual(self.column_size('info_text'), 2 * 4)
+
+    def test_same_content_on_other_day_or_plan(self):
+        classes = {'5a': [event('1')]}
+        self.assertIsNotNone(self.archive.append(1, MONDAY, None, classes))
+        self.assertIsNotNone(self.archive.append(1, TUESDAY, None, classes))
+        self.assertIsNotNone(self.archive.append(2, MONDAY, None, classes))
+        self.assertEqual(len(self.archive.versions(1)), 2)
+        self.assertEqual(len(self.archive.versions(2)), 1)
+
+    def test_append_days_skips_known_days(self):
+        days = {MONDAY: {'5a': [event('1')]}, TUESDAY: {'5a': [event('2')]}}
+        stands = {MONDAY: '04.03.2024 07:00', TUESDAY: '04.03.2024 07:00'}
+        self.assertEqual(len(self.archive.append_days(1, days, stands)), 2)
+
+        days[TUESDAY] = {'5a': [event('2', teacher='Sc')]}
+        versions = self.archive.append_days(1, days, stands)
+        self.assertEqual(len(versions), 1)
+        self.assertEqual(self.archive.latest_versions(1), sorted([1, versions[0]]))
+
+    def test_shared_event_rows(self):
+        shared = event('3')
+        self.archive.append(1, MONDAY, None, {'5a': [shared], '5b': [shared]})
+        # eine Zeile je Klasse, aber dieselbe Nummer der Vertretung
+        self.assertEqual(self.archive.row_count(1), 2)
+        with open(self.archive.column_path(1, 'row'), 'rb') as file:
+            self.assertEqual(file.read(), bytes(8))
+
+    def test_reopen_keeps_versions(self):
+        classes = {'5a': [event('1')]}
+        self.archive.append(1, MONDAY, None, classes)
+        self.archive.database.close()
+
+        self.archive = PlanArchive(self.directory.name)
+        self.assertIsNone(self.archive.append(1, MONDAY, None, classes))
+        self.assertEqual(self.archive.row_count(1), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
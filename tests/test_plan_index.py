@@ -0,0 +1,49 @@
+'''Tests für die Reihenfolge der Vorschläge im ClassTrie'''
+import unittest
+
+from plan_index import ClassTrie, class_sort_key
+
+
+class ClassSortKeyTest(unittest.TestCase):
+    def test_order(self):
+        self.assertEqual(sorted(['Q1', '10b', '5a', 'EF', '5B', '6a'], key=class_sort_key),
+                         ['5a', '5B', '6a', '10b', 'EF', 'Q1'])
+
+    def test_number_only(self):
+        self.assertLess(class_sort_key('5'), class_sort_key('5a'))
+        self.assertLess(class_sort_key('9'), class_sort_key('10'))
+
+
+class ClassTrieTest(unittest.TestCase):
+    def test_prefix(self):
+        trie = ClassTrie(['5a', '5b', '10a', 'Q1'])
+        self.assertEqual(trie.complete('5'), ['5a', '5b'])
+        self.assertEqual(trie.complete('1'), ['10a'])
+        self.assertEqual(trie.complete(' q '), ['Q1'])
+        self.assertEqual(trie.complete('7'), [])
+
+    def test_empty_prefix(self):
+        trie = ClassTrie(['Q1', '10a', '5b', '5a', None, ''])
+        self.assertEqual(trie.complete(''), ['5a', '5b', '10a', 'Q1'])
+
+    def test_active_first(self):
+        trie = ClassTrie(['5a', '5b', '5c', '10a'], active=['5c', '10a'])
+        self.assertEqual(trie.complete(''), ['5c', '10a', '5a', '5b'])
+        self.assertEqual(trie.complete('5'), ['5c', '5a', '5b'])
+
+    def test_case_insensitive(self):
+        trie = ClassTrie(['EF', 'ef2'])
+        self.assertEqual(trie.complete('e'), ['EF', 'ef2'])
+        self.assertEqual(trie.complete('Ef2'), ['ef2'])
+
+    def test_max_results(self):
+        classes = [f'{grade}{letter}' for grade in range(5, 11) for letter in 'abcde']
+        trie = ClassTrie(classes, active=['10e'])
+        completions = trie.complete('')
+        self.assertEqual(len(completions), ClassTrie.MAX_RESULTS)
+        self.assertEqual(completions[:3], ['10e', '5a', '5b'])
+        self.assertEqual(trie.complete('10'), ['10e', '10a', '10b', '10c', '10d'])
+
+
+if __name__ == '__main__':
+    unittest.main()
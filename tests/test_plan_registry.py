@@ -0,0 +1,139 @@
+'''Tests für das Laden & Verwerfen der Pläne in PlanRegistry'''
+import threading
+import time
+import unittest
+from unittest import mock
+
+from plan_registry import PlanRegistry
+
+
+PAGES = {
+    'keys': {
+        f'https://schule{plan_id}.de/plan.htm': {'id': plan_id, 'type': 0,
+                                                 'name': f'Schule {plan_id}'}
+        for plan_id in range(4)
+    }
+}
+
+
+class FakePageDatabase:
+    def get_pages(self) -> dict:
+        return {}
+
+
+class CountingFactory:
+    '''Erzeugt Pläne & zählt, wie oft jeder erzeugt wurde'''
+
+    def __init__(self, delay: float = 0.0):
+        self.delay = delay
+        self.built = {}
+        self.lock = threading.Lock()
+
+    def __call__(self, url: str, page_struct: dict):
+        time.sleep(self.delay)
+        with self.lock:
+            self.built[page_struct['id']] = self.built.get(page_struct['id'], 0) + 1
+        return object()
+
+
+class PlanRegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch('plan_registry.load_pages', return_value=PAGES)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def registry(self, factory, **kwargs) -> PlanRegistry:
+        return PlanRegistry(FakePageDatabase(), factory, **kwargs)
+
+    def test_get_reuses_loaded_plan(self):
+        factory = CountingFactory()
+        plans = self.registry(factory)
+
+        self.assertIs(plans.get(1), plans.get(1))
+        self.assertEqual(factory.built, {1: 1})
+        self.assertIs(plans.peek(1), plans.get(1))
+        self.assertIsNone(plans.peek(2))
+
+    def test_least_recently_used_plan_is_evicted(self):
+        factory = CountingFactory()
+        plans = self.registry(factory, max_active=2)
+
+        plans.get(0)
+        plans.get(1)
+        plans.get(0)
+        plans.get(2)
+
+        self.assertEqual(list(plans.active), [0, 2])
+        self.assertNotIn(1, plans.last_used)
+
+    def test_idle_plans_are_evicted(self):
+        plans = self.registry(CountingFactory(), idle_timeout=60)
+        plans.get(0)
+        plans.get(1)
+        plans.last_used[0] -= 120
+
+        self.assertEqual(plans.evict_idle(), [0])
+        self.assertIsNone(plans.peek(0))
+        self.assertIsNotNone(plans.peek(1))
+        # ein verworfener Plan bleibt registriert
+        self.assertIn(0, plans)
+
+    def test_concurrent_first_queries_build_once(self):
+        factory = CountingFactory(delay=0.05)
+        plans = self.registry(factory)
+        results = []
+
+        threads = [threading.Thread(target=lambda: results.append(plans.get(3)))
+                   for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(factory.built, {3: 1})
+        self.assertEqual(len(results), 8)
+        self.assertTrue(all(plan is results[0] for plan in results))
+
+    def test_failed_build_is_retried(self):
+        calls = []
+
+        def factory(url, page_struct):
+            calls.append(url)
+            if len(calls) == 1:
+                raise OSError('nicht erreichbar')
+            return object()
+
+        plans = self.registry(factory)
+        with self.assertRaises(OSError):
+            plans.get(0)
+        self.assertIsNotNone(plans.get(0))
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(plans.building, {})
+
+    def test_evict_idle_while_plans_are_loaded(self):
+        plans = self.registry(CountingFactory(delay=0.001), idle_timeout=0,
+                              max_active=2)
+        errors = []
+
+        def load():
+            try:
+                for round_ in range(200):
+                    plans.get(round_ % 4)
+            except Exception as error:
+                errors.append(error)
+
+        threads = [threading.Thread(target=load) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        while any(thread.is_alive() for thread in threads):
+            plans.evict_idle()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertLessEqual(len(plans.active), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+'''Tests für das Zählen der Vertretungen über das Archiv'''
+import tempfile
+import unittest
+from datetime import date
+
+from plan_archive import PlanArchive
+from plan_stats import PlanStats
+
+
+MONDAY = date(2024, 3, 4)
+TUESDAY = date(2024, 3, 5)
+
+
+def event(lesson: str, teacher: str, type_of_replacement: str = None,
+          type_: str = None) -> dict:
+    return {'lesson': lesson, 'teacher': teacher,
+            'type_of_replacement': type_of_replacement, 'type': type_}
+
+
+class PlanStatsTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.archive = PlanArchive(self.directory.name)
+        self.stats = PlanStats(self.archive)
+
+    def tearDown(self):
+        self.archive.database.close()
+        self.directory.cleanup()
+
+    def test_type_fallback(self):
+        # Untis mit dem DEFAULT_MAPPER: die Art steht nur in type
+        self.archive.append(1, MONDAY, None, {
+            '5a': [event('1', 'Mü', type_='Entfall'),
+                   event('2', 'Sc', 'Vertretung', 'Entfall'),
+                   event('3', 'Mü', 'Entfall')]
+        })
+        self.assertEqual(self.stats.count(1, 'stunde', 'entfall'), [('1', 1), ('3', 1)])
+        self.assertEqual(self.stats.count(1, 'stunde', 'vertretung'), [('2', 1)])
+
+    def test_shared_rows_counted_once(self):
+        shared = event('1', 'Mü', 'Entfall')
+        self.archive.append(1, MONDAY, None, {'5a': [shared], '5b': [shared]})
+        self.assertEqual(self.stats.count(1, 'lehrer'), [('Mü', 1)])
+        self.assertEqual(sorted(self.stats.count(1, 'klasse')), [('5a', 1), ('5b', 1)])
+
+    def test_only_latest_version(self):
+        self.archive.append(1, MONDAY, None, {'5a': [event('1', 'Mü', 'Entfall')]})
+        self.assertEqual(self.stats.count(1, 'lehrer'), [('Mü', 1)])
+
+        # der neue Stand ersetzt den alten & die Spalten werden neu geladen
+        self.archive.append(1, MONDAY, None, {'5a': [event('1', 'Sc', 'Entfall')]})
+        self.assertEqual(self.stats.count(1, 'lehrer'), [('Sc', 1)])
+
+    def test_period(self):
+        self.archive.append(1, MONDAY, None, {'5a': [event('1', 'Mü')]})
+        self.archive.append(1, TUESDAY, None, {'5a': [event('1', 'Mü')]})
+        self.assertEqual(self.stats.count(1, 'wochentag'), [('Montag', 1), ('Dienstag', 1)])
+        self.assertEqual(self.stats.count(1, 'wochentag', start=TUESDAY),
+                         [('Dienstag', 1)])
+        self.assertEqual(self.stats.count(1, 'wochentag', end=TUESDAY), [('Montag', 1)])
+
+    def test_empty_plan(self):
+        self.assertEqual(self.stats.count(1, 'klasse', 'entfall'), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
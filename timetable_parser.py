@@ -1,24 +1,31 @@
 '''Parser for various Timetables'''
 
+from __future__ import annotations
+
 import urllib.request
 import os
-# import platform
-# import io
-import json
+import zlib
+import threading
+import time
+from functools import lru_cache
 from itertools import zip_longest
-from typing import Union, Final, Tuple, List, Dict
-from datetime import datetime
-# from discord import File
-from lxml import html, etree
-# from preview_factory import create_html_preview
-from replacement_types import ReplacementType, PlanPreview
+from typing import TYPE_CHECKING, Union, Final, Iterator, Optional, Tuple, List, Dict
+from datetime import date, datetime
+from replacement_types import Replacement, ReplacementType, PlanPreview
 from attachment_database import ImageDatabase
-from dsbapi import DSBApi
+from config import load_pages, today
+from circuit_breaker import CircuitOpenError, DEFAULT_TIMEOUT, breaker_for, is_transient
+from plan_index import ClassTrie, PlanIndex, lookup_classes
+from plan_renderer import preview_key
+
+# lxml & die DSBApi (bs4, requests) werden erst geladen, wenn ein Plan des
+# jeweiligen Typs abgefragt wird
+if TYPE_CHECKING:
+    from lxml import etree
 
 
 # Read the Timetable Data
-with open('pages.json', 'r', encoding='utf-8') as page_json:
-    PAGES: Final[dict] = json.loads(page_json.read())['keys']
+PAGES: Final[dict] = load_pages()['keys']
 
 # Keys for the Timetable Types
 UNTIS_HTML: Final = 0
@@ -30,6 +37,147 @@ WILLI_URL: Final[str] = tuple(PAGES.keys())[1]
 DEFAULT_MAPPER: Final = ('type', 'class', 'lesson','subject', 'room',
                          'new_subject', 'new_teacher', 'teacher')
 
+EMPTY_PAGE: Final[str] = '<html><body><center></body></html>'
+
+# Bytes, die je Lesevorgang an den Parser gehen
+FEED_CHUNK_SIZE: Final[int] = 16 * 1024
+# Untis Übersicht & Klassenpläne stehen in den ersten beiden Tabellen im <center>
+UNTIS_TABLES: Final[int] = 2
+
+# Sekunden, die der Tages-Index ohne neue Abfrage verwendet wird
+INDEX_MAX_AGE: Final[float] = 5 * 60
+# Sekunden, die vorab geladene Klassenseiten (siehe Page.prefetch) gültig sind,
+# kürzer als die 5 Minuten der Prefetch-Schleife in main.py, sonst wären sie bis zu 10 Minuten alt
+PREFETCH_MAX_AGE: Final[float] = 4 * 60
+# Sekunden, die ein gerade abgefragter Plan ohne Abfrage beantwortet wird (siehe Page.cached_plan_for_class)
+FRESH_MAX_AGE: Final[float] = 60
+
+
+@lru_cache(maxsize=64)
+def parse_dsb_date(date_str: str) -> date:
+    '''Parst ein DSBMobile Datum (dd.mm.yyyy), jedes nur einmal'''
+    return datetime.strptime(date_str, '%d.%m.%Y').date()
+
+
+
+def content_decoder(encoding: Optional[str], first_chunk: bytes):
+    '''Gibt einen Dekompressor für das Content-Encoding zurück (None: unkomprimiert)'''
+    encoding = (encoding or '').strip().lower()
+    if encoding in ('gzip', 'x-gzip'):
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if encoding == 'deflate':
+        # manche Server schicken deflate ohne den zlib-Header
+        has_header = len(first_chunk) >= 2 and first_chunk[0] & 0x0f == 8 \
+            and int.from_bytes(first_chunk[:2], 'big') % 31 == 0
+        return zlib.decompressobj(zlib.MAX_WBITS if has_header else -zlib.MAX_WBITS)
+    return None
+
+
+def parse_untis_stream(response, tables: int = UNTIS_TABLES) -> etree.ElementTree:
+    '''Parst eine Untis Seite, während sie noch geladen wird
+    Die dekomprimierten Blöcke gehen direkt an einen inkrementellen Parser,
+    sind die ersten Tabellen im <center> vollständig, wird nicht weiter gelesen'''
+    from lxml import etree, html
+
+    parser = etree.HTMLPullParser(events=('start', 'end'), tag='table',
+                                  encoding=response.headers.get_content_charset())
+    parser.set_element_class_lookup(html.HtmlElementClassLookup())
+
+    decoder = None
+    needed: list = []
+    finished: int = 0
+
+    chunk = response.read(FEED_CHUNK_SIZE)
+    if chunk:
+        decoder = content_decoder(response.headers.get('Content-Encoding'), chunk)
+
+    while chunk and finished < tables:
+        parser.feed(chunk if decoder is None else decoder.decompress(chunk))
+
+        for event, element in parser.read_events():
+            if event == 'start':
+                if len(needed) < tables and any(
+                        parent.tag == 'center' for parent in element.iterancestors()):
+                    needed.append(element)
+            elif any(element is table for table in needed):
+                finished += 1
+
+        chunk = response.read(FEED_CHUNK_SIZE)
+
+    return etree.ElementTree(parser.close())
+
+
+def untis_class_links(page: etree.ElementTree) -> Optional[Dict[str, str]]:
+    '''Liest die Klassen & die Links zu ihren Plänen aus der Untis Übersicht'''
+    # 2. Tabelle auswählen
+    tables = page.findall('//center//table')
+    if len(tables) <= 1:
+        return None
+
+    return {cell.text_content(): cell.get('href')
+            for cell in tables[1].iterfind('.//td/a')}
+
+
+def untis_stand(page: etree.ElementTree) -> str:
+    '''Liest den Stand aus dem Plan einer Klasse'''
+    return page.xpath(
+        '(((.//center//table)[1])/tr[2])/td[last()]')[0].text_content()
+
+
+def parse_untis_rows(page: etree.ElementTree, mapper: tuple) -> List[ReplacementType]:
+    '''Extrahiert alle Vertretungen aus dem Untis Plan einer Klasse'''
+    none_cases = ('\xa0', '+', '---')
+
+    replacements = []
+    for event in page.xpath('(.//center//table)[2]/tr[position()>1]'):
+        cells: list = [item.text_content().strip('\n ').replace('\xa0', ' ')
+                       if not item.text_content().strip('\n ') in none_cases else None
+                       for item in event.xpath('(.//td)[position()>1]')]
+        replacements.append(Replacement.from_pairs(zip_longest(mapper, cells)))
+
+    return replacements
+
+
+def group_by_class(plan: List[ReplacementType]) -> Dict[str, List[ReplacementType]]:
+    '''Ordnet die DSBMobile Zeilen ihren Klassen zu
+    Zeilen für mehrere Klassen werden nur referenziert'''
+    classes: Dict[str, List[ReplacementType]] = {}
+    for event in plan:
+        for class_ in event['classes']:
+            if not class_ in classes:
+                classes[class_] = [event]
+            else:
+                classes[class_].append(event)
+    return classes
+
+
+def parse_type_from_info(events: List[ReplacementType], event_cases: Dict[str, List[str]]):
+    '''Bestimmt die Art der Vertretung aus dem Infotext (siehe event_cases in der pages.json)'''
+    for event in events:
+        if event.get('info_text') is None:
+            continue
+
+        info_text = event['info_text']
+        lower_info: str = event['info_text'].casefold()
+        for case, values in event_cases.items():
+            for value in values:
+                if lower_info == value:
+                    event.pop('info_text')
+                elif lower_info.startswith(value):
+                    if info_text[len(value)] == ',':
+                        event['info_text'] = info_text[len(value):].strip(' ,')
+                    elif len(lower_info) - len(value) == 1 and not lower_info[-1].isalnum():
+                        event.pop('info_text')
+                else:
+                    continue
+
+                event['type_of_replacement'] = case
+                break
+            else:
+                continue
+            break
+
+    return events
 
 
 def load_credentials(id: str):
@@ -48,80 +196,133 @@ class Page:
     '''Klasse für Vertetungsplan Webseiten
     Extrahiert Vertretungen & produziert Previews'''
 
-    def __init__(self, url: str = DEFAULT_URL, database: ImageDatabase = None):
+    def __init__(self, url: str = DEFAULT_URL, database: ImageDatabase = None,
+                 page_struct: dict = None):
         self.url: Final = url
 
         self.replacements: dict = {}
         self.times: dict = {}
+        # Index aller veröffentlichten Tage: Datum -> Klasse -> Vertretungen
+        self.days: Dict[date, Dict[str, List[ReplacementType]]] = {}
+        self.day_times: Dict[date, str] = {}
+        # DSBMobile Tage, deren Zeilen noch nicht eingelesen wurden
+        self.pending_days: Dict[date, list] = {}
+        self.indexes: Dict[date, PlanIndex] = {}
+        self.indexed: float = 0.0
+        self.indexes_built: float = 0.0
+        # alle jemals gesehenen Klassen, für die Autovervollständigung
+        self.known_classes: set = set()
+        self.active_classes: set = set()
+        self.class_trie: Optional[ClassTrie] = None
+        # vorab geladene Untis Klassenseiten: Klasse -> Zeitpunkt der Abfrage
+        self.prefetched: Dict[str, float] = {}
+        # zuletzt abgefragte Untis Klassenseiten: Klasse -> Zeitpunkt der Abfrage
+        self.class_fetched: Dict[str, float] = {}
         # self.previews: dict = {}
 
         self.database = database
 
-        self.page_struct: dict = PAGES.get(url)
+        # Pläne aus der Datenbank bringen ihre Struktur selbst mit
+        self.page_struct: dict = PAGES.get(url) if page_struct is None else page_struct
         if self.page_struct is None:
             raise KeyError(url)
 
         self.mapper: tuple = self.page_struct.get('mapper', DEFAULT_MAPPER)
+        self.timeout: float = self.page_struct.get('timeout', DEFAULT_TIMEOUT)
+
+        # ist die Seite nicht erreichbar, wird der letzte Stand weiter verwendet
+        self.last_fetched: Optional[float] = None
+        self.stale_since: Optional[float] = None
+        self.lock = threading.RLock()
 
 
         # den Websitetypen bestimmen
-        self.page_type: int = self.page_struct['id']
+        self.page_type: int = self.page_struct['type']
 
         if self.page_type is not None:
             self.extract_data()
 
 
-    def extract_data(self, key: str = None, keys_only: bool = False) -> Union[Tuple[str, List[ReplacementType]], Dict[str, List[ReplacementType]], None]:
-        '''Führt die Funktionen für den jeweiligen Websitetypen aus'''
-        self.refresh_page()
-        if self.page_type is None:
-            return None
-        elif self.page_type == UNTIS_HTML:
-            return self.parse_untis_html(key, keys_only)
-        elif self.page_type == DSB_MOBILE:
-            return self.parse_dsb_entries(key, keys_only)
-
-
-    def parse_untis_html(self, key: str = None, keys_only: bool = False) -> Union[Tuple[str, List[ReplacementType]], Dict[str, List[ReplacementType]], None]:
+    def extract_data(self, key: str = None, keys_only: bool = False, stream: bool = False) -> Union[Tuple[str, List[ReplacementType]], Dict[str, List[ReplacementType]], Iterator[Tuple[str, List[ReplacementType]]], None]:
+        '''Führt die Funktionen für den jeweiligen Websitetypen aus
+        Mit stream werden die Klassen einzeln zurückgegeben, sobald sie eingelesen sind'''
+        # die Befehle fragen aus mehreren Threads ab
+        with self.lock:
+            self.refresh_page()
+            self.indexed = time.monotonic()
+            if self.page_type is None:
+                return None
+            elif self.page_type == UNTIS_HTML:
+                # Untis zeigt nur den aktuellen Tag
+                self.days = {today(): self.replacements}
+                return self.parse_untis_html(key, keys_only, stream)
+            elif self.page_type == DSB_MOBILE:
+                result = self.parse_dsb_entries(key, keys_only)
+                # DSBMobile liefert die ganze Schule in einem Dokument
+                return iter(self.replacements.items()) if stream else result
+
+
+    def parse_untis_html(self, key: str = None, keys_only: bool = False, stream: bool = False) -> Union[Tuple[str, List[ReplacementType]], Dict[str, List[ReplacementType]], Iterator[Tuple[str, List[ReplacementType]]], None]:
         '''Extrahiert die Klassen & Links aus der Webseite'''
-        # 2. Tabelle auswählen
-        tables = self.page.findall('//center//table')
-        if len(tables) <= 1:
+        data_cells = untis_class_links(self.page)
+        if data_cells is None:
             return None
 
-        # Daten aus den Zellen extrahieren
-        data_cells = {cell.text_content(): cell.get('href')
-                      for cell in tables[1].iterfind('.//td/a')}
+        self.update_class_trie(data_cells)
 
         # nur die Klassen mit Vertretungen zurückgeben!
         if keys_only:
             return data_cells.keys()
 
-        key_dict = {item.lower(): item for item in data_cells} if key else None
         # Vplan für einzelne Klasse konstruieren
         if key is not None:
-            if key_dict is None: return None
+            key_dict = {item.lower(): item for item in data_cells}
+            return self.untis_class_plan(data_cells, key_dict, key)
+        # die Vertretungen für die alle Klassen ermitteln
+        if stream:
+            return self.iter_untis_tables(data_cells)
 
-            key: str = key_dict.get(key.lower())
+        for _ in self.iter_untis_tables(data_cells):
+            pass
 
-            if key is None: return None
 
-            return key, self.parse_untis_html_table(key, data_cells[key])
-
-        del key_dict, key
-        # die Vertretungen für die alle Klassen ermitteln
-        for kv in data_cells.items():
-            self.parse_untis_html_table(*kv, False)
+    def untis_class_plan(self, data_cells: Dict[str, str], key_dict: Dict[str, str],
+                         key: str) -> Optional[Tuple[str, List[ReplacementType]]]:
+        '''Gibt den Plan einer Klasse der Übersicht zurück (Groß-/Kleinschreibung egal)'''
+        key = key_dict.get(key.lower())
+        if key is None:
+            return None
 
+        # häufig abgefragte Klassen wurden schon vorab geladen
+        if key in self.replacements and \
+                time.monotonic() - self.prefetched.get(key, 0.0) < PREFETCH_MAX_AGE:
+            return key, self.replacements[key]
+
+        return key, self.parse_untis_html_table(key, data_cells[key])
+
+
+    def iter_untis_tables(self, data_cells: Dict[str, str]) -> Iterator[Tuple[str, List[ReplacementType]]]:
+        '''Liest die Pläne der Klassen nacheinander ein & gibt jeden sofort zurück
+        Der Generator läuft über mehrere Threads (run_blocking), die Sperre
+        wird daher je Klasse genommen & nie über ein yield gehalten'''
+        for key, link in data_cells.items():
+            with self.lock:
+                plan = self.parse_untis_html_table(key, link)
+            yield key, plan
+
+        with self.lock:
+            # nicht mehr vorkommene Elemente löschen
+            if len(data_cells) != len(self.replacements):
+                for class_repl in list(self.replacements):
+                    if not class_repl in data_cells:
+                        self.replacements.pop(class_repl)
+                        # self.previews.pop(class_repl)
+                    else:
+                        continue
 
-        # nicht mehr vorkommene Elemente löschen
-        if len(data_cells) != len(self.replacements):
-            for class_repl in self.replacements:
-                if not class_repl in data_cells:
-                    self.replacements.pop(class_repl)
-                    # self.previews.pop(class_repl)
-                else:
-                    continue
+            # die Indizes brauchen alle Klassen, also nur hier neu bauen
+            self.indexes = {today(): PlanIndex(self.replacements)}
+            self.indexes_built = time.monotonic()
 
 
     def parse_untis_html_table(self, key, link, single: bool = True) -> List[ReplacementType]:
@@ -129,37 +330,25 @@ class Page:
         # den Link zum Plan konstruieren
         if link.count('/') == 0:  # deal with relative Links
             link = self.url.rsplit('/', 1)[0] + '/' + link
-        with urllib.request.urlopen(link) as web_page:
-            page = html.parse(web_page)
+        try:
+            page = self.fetch_html(link)
+        except (CircuitOpenError, OSError) as error:
+            # den letzten bekannten Stand der Klasse verwenden
+            self.mark_stale(error)
+            return self.replacements.get(key, []) if single else None
 
 
+        self.class_fetched[key] = time.monotonic()
         # Abfragen, ob der Plan neuer ist als der in unserer Datenbank
-        time_data = page.xpath(
-            '(((.//center//table)[1])/tr[2])/td[last()]')[0].text_content()
+        time_data = untis_stand(page)
         if self.times.get(key) == time_data and key in self.replacements:
             # überspringen, vorherigen Wert zurückgeben
             # return self.replacements[key], self.previews.get(key, self.get_plan_preview(key, time_data))
             return self.replacements[key]
 
         self.times[key] = time_data  # Datum eintragen
-        events = page.xpath('(.//center//table)[2]/tr[position()>1]')
-
-        self.replacements[key] = []
-
-        none_cases = ('\xa0', '+', '---')
-
         # Alle Vertretungen aus der Tabelle extrahieren
-        for event in events:
-            cells: list = [item.text_content().strip('\n ').replace('\xa0', ' ')
-                           if not item.text_content().strip('\n ') in none_cases else None
-                           for item in event.xpath('(.//td)[position()>1]')]
-            replacement: ReplacementType = {k:v for k, v in
-                dict(zip_longest(self.mapper, cells)).items() if v is not None}
-
-
-
-
-            self.replacements[key].append(replacement)
+        self.replacements[key] = parse_untis_rows(page, self.mapper)
 
         if single:
             # return self.replacements[key], self.get_plan_preview(key)
@@ -170,28 +359,48 @@ class Page:
 
 
     def parse_dsb_entries(self, key: str, keys_only: bool):
-        '''Extrahiert den DSBMobile Vertretungsplan für ganze Schule'''
-        FORMAT: str = '%d.%m.%Y'
-        plan_dates: list = [datetime.strptime(day[0]['date'], FORMAT) for day in self.dsbentries]
-
-        plan = self.dsbentries[plan_dates.index(max(plan_dates))]
-        plan_updated = plan[0]['updated']
-
-        if self.times.get('all') != plan_updated:
-            if not 'type_of_replacement' in self.mapper:
-                plan = self.parse_type_from_dsb_info(plan)
+        '''Extrahiert den DSBMobile Vertretungsplan für ganze Schule
+        Alle veröffentlichten Tage werden nach Datum & Klasse indiziert,
+        self.replacements enthält den neuesten Tag'''
+        # die Tage nur anhand ihres Kopfes (Datum & Stand) einordnen
+        handles: Dict[date, list] = {}
+        for handle in self.dsbentries:
+            day = parse_dsb_date(handle.date)
+            if not day in handles:
+                handles[day] = [handle]
+            else:
+                handles[day].append(handle)
+
+        for day, day_handles in handles.items():
+            plan_updated = day_handles[0].updated
+            # ohne Stand lässt sich keine Änderung erkennen, also neu einlesen
+            if plan_updated is not None and self.day_times.get(day) == plan_updated:
+                continue
 
+            # geänderte Tage werden erst bei Bedarf eingelesen
+            self.pending_days[day] = day_handles
+            self.day_times[day] = plan_updated
+            self.days.pop(day, None)
+            self.indexes.pop(day, None)
 
-            self.replacements.clear()
+        # nicht mehr veröffentlichte Tage löschen
+        for day in list(self.day_times):
+            if not day in handles:
+                self.day_times.pop(day)
+                self.days.pop(day, None)
+                self.indexes.pop(day, None)
+                self.pending_days.pop(day, None)
+        self.indexes_built = time.monotonic()
 
-            for event in plan:
-                class_ = event.pop('class')
-                if not class_ in self.replacements:
-                    self.replacements[class_] = [event]
-                else:
-                    self.replacements[class_].append(event)
+        if self.day_times:
+            newest = max(self.day_times)
+            self.replacements = self.get_day(newest)
+            self.times['all'] = self.day_times[newest]
+        else:
+            self.replacements = {}
+            self.times.pop('all', None)
 
-            self.times['all'] = plan_updated
+        self.update_class_trie(self.replacements)
 
 
 
@@ -217,42 +426,21 @@ class Page:
         #     self.previews[key] = self.get_plan_preview(key, 'all')
 
 
-    def get_plan_preview(self, key: str, time_key: str = None) -> PlanPreview:
-        '''Produziert die Preview für den Vertretungsplan'''
-        return ''
-        # plan_img_url: str = self.database.get_plan(key, self.times[key] if time_key is None else time_key)
-        # if plan_img_url is not None:
-        #     self.previews[key] = plan_img_url  # put the value to the dict
-        #     return plan_img_url
-
-        # # Nach HTML konvertieren & newlines entfernen, die extra Spaces erzeugen
-        # html_code: str = create_html_preview(self.replacements[key])
-
-        # filename = f'{key}_plan.png'
-        # options: Final = {'quiet': None, 'width': 500, 'transparent': None,
-        #                   'enable-local-file-access': None, 'format': 'png',
-        #                   'encoding': "UTF-8"}
-
-        # try:
-        #     conf = imgkit.config()
-        #     if platform.system() == 'Linux':
-        #         try:
-        #             conf.get_wkhtmltoimage()
-        #         except:
-        #             conf.wkhtmltoimage = "./.apt/usr/local/bin/wkhtmltoimage"
-        #     else:
-        #         conf.wkhtmltoimage = "C:/Program Files/wkhtmltopdf/bin/wkhtmltoimage.exe"
-        #     config: Final = {
-        #         'options': options,
-        #         'config': conf
-        #     }
-
-        #     buf = io.BytesIO(imgkit.from_string(html_code, False, **config))
-        #     buf.seek(0)
-        # except:
-        #     buf = io.BytesIO()
-
-        # return File(buf, filename=filename)
+    def get_plan_preview(self, key: str, replacements: List[ReplacementType]) -> Optional[PlanPreview]:
+        '''Gibt den Link zum Bild des Plans zurück, falls es für den aktuellen
+        Stand schon hochgeladen wurde (sonst wird es mit plan_renderer gezeichnet)'''
+        if self.database is None:
+            return None
+
+        image_key, stand = preview_key(self.page_struct['id'], key, replacements, self.times)
+        return None if stand is None else self.database.get_plan(image_key, stand)
+
+
+    def set_plan_preview(self, key: str, replacements: List[ReplacementType], link: str):
+        '''Merkt sich die CDN-URL des hochgeladenen Bildes für den aktuellen Stand'''
+        image_key, stand = preview_key(self.page_struct['id'], key, replacements, self.times)
+        if self.database is not None and stand is not None:
+            self.database.set_attachment(image_key, link, stand)
 
 
     def get_plan_for_class(self, key: str) -> Tuple[str, List[ReplacementType]]:
@@ -260,6 +448,210 @@ class Page:
         return self.extract_data(key)
 
 
+    def get_day(self, day: date) -> Optional[Dict[str, List[ReplacementType]]]:
+        '''Gibt die Vertretungen des Tages nach Klassen zurück
+        Noch nicht eingelesene DSBMobile Tage werden jetzt erst eingelesen'''
+        with self.lock:
+            if day in self.pending_days:
+                plan = [event for handle in self.pending_days.pop(day)
+                        for event in handle.entries]
+
+                if not 'type_of_replacement' in self.mapper:
+                    plan = self.parse_type_from_dsb_info(plan)
+
+                classes = group_by_class(plan)
+
+                self.days[day] = classes
+                self.indexes[day] = PlanIndex(classes)
+
+            return self.days.get(day)
+
+
+    def get_all_days(self) -> Dict[date, Dict[str, List[ReplacementType]]]:
+        '''Liest alle veröffentlichten Tage ein & gibt den Index zurück'''
+        with self.lock:
+            for day in list(self.pending_days):
+                self.get_day(day)
+            return dict(self.days)
+
+
+    def is_fresh(self) -> bool:
+        '''Die Seite wurde gerade erst erfolgreich abgefragt'''
+        return self.stale_since is None and self.last_fetched is not None \
+            and time.time() - self.last_fetched < FRESH_MAX_AGE
+
+
+    def cached_plan_for_class(self, key: str) -> Optional[Tuple[str, List[ReplacementType]]]:
+        '''Gibt den Plan der Klasse ohne Abfrage zurück, wenn er gerade erst
+        abgefragt wurde, sonst (oder während einer Abfrage) None'''
+        if not self.lock.acquire(blocking=False):
+            return None
+        try:
+            if not self.is_fresh():
+                return None
+            if self.page_type != UNTIS_HTML:
+                return lookup_classes(self.replacements, [key])[key]
+
+            data_cells = untis_class_links(self.page)
+            if data_cells is None:
+                return None
+            key = {item.lower(): item for item in data_cells}.get(key.lower())
+            if key is None or not key in self.replacements:
+                return None
+
+            now = time.monotonic()
+            if now - self.class_fetched.get(key, 0.0) < FRESH_MAX_AGE or \
+                    now - self.prefetched.get(key, 0.0) < PREFETCH_MAX_AGE:
+                return key, self.replacements[key]
+            return None
+        finally:
+            self.lock.release()
+
+
+    def cached_classes(self) -> Optional[list]:
+        '''Gibt die Klassen mit Vertretungen ohne Abfrage zurück (siehe cached_plan_for_class)'''
+        if not self.lock.acquire(blocking=False):
+            return None
+        try:
+            if not self.is_fresh():
+                return None
+            if self.page_type != UNTIS_HTML:
+                return list(self.replacements)
+            data_cells = untis_class_links(self.page)
+            return None if data_cells is None else list(data_cells)
+        finally:
+            self.lock.release()
+
+
+    def cached_plan_for_all(self) -> Optional[Dict[str, List[ReplacementType]]]:
+        '''Gibt den Plan der ganzen Schule ohne Abfrage zurück, wenn er gerade
+        erst vollständig abgefragt wurde'''
+        if not self.lock.acquire(blocking=False):
+            return None
+        try:
+            if not self.is_fresh() or (self.page_type == UNTIS_HTML and
+                    time.monotonic() - self.indexes_built >= FRESH_MAX_AGE):
+                return None
+            return dict(self.replacements)
+        finally:
+            self.lock.release()
+
+
+    def get_plans_for_classes(self, classes: List[str]) -> Dict[str, Optional[Tuple[str, List[ReplacementType]]]]:
+        '''Gibt die Pläne mehrerer Klassen zurück, die Seite wird dafür nur
+        einmal abgefragt (wie get_plan_for_class, None ohne Vertretungen)'''
+        with self.lock:
+            if self.page_type != UNTIS_HTML:
+                self.extract_data(keys_only=True)
+                return lookup_classes(self.replacements, classes)
+
+            self.refresh_page()
+            self.indexed = time.monotonic()
+            data_cells = untis_class_links(self.page)
+            if data_cells is None:
+                return dict.fromkeys(classes)
+            self.update_class_trie(data_cells)
+
+            key_dict = {item.lower(): item for item in data_cells}
+            return {class_: self.untis_class_plan(data_cells, key_dict, class_)
+                    for class_ in classes}
+
+
+    def prefetch(self, classes: List[str]) -> int:
+        '''Lädt die Seiten der gegebenen (häufig abgefragten) Klassen vorab,
+        Abfragen dieser Klassen brauchen dann nur noch die Übersichtsseite
+        Gibt die Anzahl der geladenen Klassen zurück'''
+        if self.page_type != UNTIS_HTML:
+            return 0
+
+        with self.lock:
+            self.refresh_page()
+            data_cells = untis_class_links(self.page)
+            if data_cells is None:
+                return 0
+            self.update_class_trie(data_cells)
+
+            key_dict = {item.lower(): item for item in data_cells}
+            count = 0
+            for class_ in classes:
+                key = key_dict.get(class_.lower())
+                if key is None:
+                    continue
+                self.parse_untis_html_table(key, data_cells[key])
+                # war die Seite nicht erreichbar, wird die Klasse wieder normal abgefragt
+                if self.stale_since is None:
+                    self.prefetched[key] = time.monotonic()
+                    count += 1
+            return count
+
+
+    def get_plan_for_day(self, key: str, day: date) -> Optional[Tuple[str, List[ReplacementType]]]:
+        '''Gibt den Vertretungsplan der Klasse für den Tag aus dem Index zurück
+        Die Seite wird nur abgefragt, wenn der Tag fehlt oder der Index veraltet ist'''
+        with self.lock:
+            if self.page_type == UNTIS_HTML:
+                return self.get_plan_for_class(key) if day == today() else None
+
+            if not day in self.day_times or time.monotonic() - self.indexed > INDEX_MAX_AGE:
+                self.extract_data(keys_only=True)
+
+            classes = self.get_day(day)
+            if classes is None:
+                return None
+
+            key_dict = {item.lower(): item for item in classes if item is not None}
+            key = key_dict.get(key.lower())
+            if key is None:
+                return None
+
+            return key, classes[key]
+
+
+    def update_class_trie(self, active_classes) -> None:
+        '''Baut den Präfixbaum der Klassen neu, wenn neue Klassen auftauchen
+        oder sich die Klassen mit Vertretungen ändern'''
+        active = {class_ for class_ in active_classes if class_ is not None}
+        known = self.known_classes | active
+        for classes in self.days.values():
+            known.update(class_ for class_ in classes if class_ is not None)
+
+        if self.class_trie is not None and known == self.known_classes \
+                and active == self.active_classes:
+            return
+
+        self.known_classes, self.active_classes = known, active
+        self.class_trie = ClassTrie(known, active)
+
+
+    def get_index(self, day: date = None) -> Optional[PlanIndex]:
+        '''Gibt die Lehrer- & Raum-Indizes für den Tag (sonst den neuesten) zurück'''
+        with self.lock:
+            if self.page_type == UNTIS_HTML:
+                day = today()
+                known = self.indexes  # erst nach dem Abfragen aller Klassen da
+            else:
+                known = self.day_times
+
+            if (day not in known if day is not None else not known) \
+                    or time.monotonic() - self.indexes_built > INDEX_MAX_AGE:
+                self.extract_data()
+
+            if day is None:
+                day = max(known, default=None)
+            if day is not None:
+                self.get_day(day)
+
+            return self.indexes.get(day)
+
+
+    def iter_plan_for_all(self) -> Iterator[Tuple[str, List[ReplacementType]]]:
+        '''Gibt den Vertretungsplan aller Klassen Klasse für Klasse zurück,
+        jede sobald sie eingelesen ist, abgefragt wird erst beim ersten next()'''
+        plan = self.extract_data(stream=True)
+        if plan is not None:
+            yield from plan
+
+
     def get_plan_for_all(self) -> Dict[str, List[ReplacementType]]:
         '''Gibt den Vertretungsplan für alle Klassen der Seite zurück!'''
         self.extract_data()
@@ -269,54 +661,81 @@ class Page:
     def refresh_page(self):
         '''Url abfragen, Code laden!'''
         if self.page_type == UNTIS_HTML:
+            from lxml import html, etree
+
             try:
-                with urllib.request.urlopen(self.url) as web_page:
-                    self.page: etree.ElementTree = html.parse(web_page)
-            except urllib.error.HTTPError:
-                self.page: etree.ElementTree = etree.ElementTree(html.fromstring('<html><body><center></body></html>'))
+                self.page: etree.ElementTree = self.fetch_html(self.url)
+            except (CircuitOpenError, OSError) as error:
+                if isinstance(error, urllib.error.HTTPError) and not is_transient(error):
+                    # kein Plan veröffentlicht
+                    self.page: etree.ElementTree = etree.ElementTree(html.fromstring(EMPTY_PAGE))
+                    self.mark_fresh()
+                else:
+                    self.mark_stale(error)
+                    if not hasattr(self, 'page'):
+                        self.page: etree.ElementTree = etree.ElementTree(html.fromstring(EMPTY_PAGE))
+            else:
+                self.mark_fresh()
         elif self.page_type == DSB_MOBILE:
+            from dsbapi import DSBApi, DSBError
+
             if not hasattr(self, 'dsbclient'):
-                self.dsbclient = DSBApi(*load_credentials(self.page_struct['id']),
+
+                credentials = (self.page_struct['username'], self.page_struct['password']) \
+                    if 'username' in self.page_struct else load_credentials(self.page_struct['id'])
+                self.dsbclient = DSBApi(*credentials,
                                    tablemapper=self.mapper,
-                                   inline_header=self.page_struct.get('inline_header', False))
+                                   inline_header=self.page_struct.get('inline_header', False),
+                                   timeout=self.timeout,
+                                   data_url=self.page_struct.get('data_url'))
 
             # refresh Entries
-            self.dsbentries = self.dsbclient.fetch_entries()
+            try:
+                self.dsbentries = breaker_for(self.dsbclient.DATA_URL).call(
+                    self.dsbclient.fetch_entries)
+            except (CircuitOpenError, OSError, DSBError) as error:
+                # auch abgelehnte Zugangsdaten zeigen den letzten Stand
+                self.mark_stale(error)
+                if not hasattr(self, 'dsbentries'):
+                    self.dsbentries = []
+            else:
+                self.mark_fresh()
 
 
+    def fetch_html(self, link: str) -> etree.ElementTree:
+        '''Lädt & parst eine Untis Seite, mit Timeout, Wiederholungen & Circuit Breaker
+        Die Seite kommt komprimiert & wird schon beim Laden geparst'''
+        request = urllib.request.Request(
+            link, headers={'Accept-Encoding': 'gzip, deflate'})
 
+        def fetch():
+            with urllib.request.urlopen(request, timeout=self.timeout) as web_page:
+                return parse_untis_stream(web_page)
 
-    def get_classes(self) -> list:
-        '''Gibt alle Klassen mit Vertretungen zurück'''
-        return self.extract_data(keys_only=True)
+        return breaker_for(link).call(fetch)
 
-    def parse_type_from_dsb_info(self, events: List[dict]):
-        for event in events:
-            if event.get('info_text') is None:
-                continue
 
-            info_text = event['info_text']
-            lower_info: str = event['info_text'].casefold()
-            for case, values in self.page_struct['event_cases'].items():
-                for value in values:
-                    if lower_info == value:
-                        event.pop('info_text')
-                    elif lower_info.startswith(value):
-                        if info_text[len(value)] == ',':
-                            event['info_text'] = info_text[len(value):].strip(' ,')
-                        elif len(lower_info) - len(value) == 1 and not lower_info[-1].isalnum():
-                            event.pop('info_text')
-                    else:
-                        continue
+    def mark_fresh(self):
+        '''Die Seite wurde gerade erfolgreich abgefragt'''
+        self.last_fetched = time.time()
+        self.stale_since = None
 
-                    event['type_of_replacement'] = case
-                    break
-                else:
-                    continue
-                break
 
-        return events
+    def mark_stale(self, error: Exception):
+        '''Die Seite ist nicht erreichbar, der letzte Stand wird weiter verwendet'''
+        print(f'{self.url} nicht erreichbar, verwende den letzten Stand:', repr(error))
+        if self.stale_since is None:
+            self.stale_since = self.last_fetched or time.time()
+
+
+
+
+    def get_classes(self) -> list:
+        '''Gibt alle Klassen mit Vertretungen zurück'''
+        return self.extract_data(keys_only=True)
 
+    def parse_type_from_dsb_info(self, events: List[ReplacementType]):
+        return parse_type_from_info(events, self.page_struct.get('event_cases', {}))
 
 
 if __name__ == '__main__':
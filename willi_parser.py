@@ -52,10 +52,11 @@ def load_credentials(path: str):
     return uname.strip(), password.strip()
 
 
-dsbclient = dsbapi.DSBApi(*load_credentials('willi_secret'), tablemapper=TABLE_KEYS,
-                          inline_header=True)
-entries: list[dict[str, str]] = dsbclient.fetch_entries() # Rückgabe einer JSON Liste an Arrays
-print(entries)
-for day in entries:
-    for event in parse_willi_infos(day):
-        print(event)
+if __name__ == '__main__':
+    dsbclient = dsbapi.DSBApi(*load_credentials('willi_secret'), tablemapper=TABLE_KEYS,
+                              inline_header=True)
+    entries: list[dsbapi.DSBDay] = dsbclient.fetch_entries() # ein Eintrag pro Tag
+    print(entries)
+    for day in entries:
+        for event in parse_willi_infos(day.entries):
+            print(event)